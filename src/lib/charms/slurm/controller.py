@@ -1,6 +1,295 @@
+import os
+import zlib
+import json
+import base64
+import time
+import socket
+import hashlib
+import subprocess
 import collections
+import collections.abc
 import charms.leadership as leadership
 import charmhelpers.core.hookenv as hookenv
+import charmhelpers.core.host as host
+import charmhelpers.core.unitdata as unitdata
+import charms.slurm.health as health
+import charms.slurm.fragments as fragments
+import charms.slurm.hostlist as hostlist
+import charms.slurm.tuning as tuning
+import charms.slurm.topology as topology
+import charms.slurm.weights as weights
+import charms.slurm.inventory as inventory
+
+# unit kv key holding the fingerprint of the last applied controller config
+FINGERPRINT_KEY = 'slurm-controller.config_fingerprint'
+# unit kv key holding the last applied controller context
+APPLIED_CONTEXT_KEY = 'slurm-controller.applied_context'
+# context keys that change on every run without changing the effective config
+VOLATILE_KEYS = ('slurm_config_updated',)
+
+# Context keys whose slurm.conf parameters slurmctld only picks up on a
+# restart. Keys not listed here, in RECONFIGURE_KEYS or in CHARM_ONLY_KEYS
+# (e.g. the prefixed network details of either controller role) are treated
+# the same way.
+RESTART_KEYS = frozenset([
+    'clustername',
+    'configless',
+    'slurmctld_parameters',
+    'max_job_count',
+    'scheduler_type',
+    'select_type',
+    'select_type_parameters',
+    'slurm_user',
+    'slurmctld_pid_file',
+    'slurmctld_port',
+    'slurmd_pid_file',
+    'slurmd_port',
+    'slurmd_spool_dir',
+    'state_save_location',
+    'dbd_host',
+    'dbd_port',
+    'dbd_ipaddr',
+    'munge_key',
+    'jobcomp_type',
+    'jobcomp_loc',
+    'topology_plugin',
+])
+# Context keys that a running slurmctld applies on `scontrol reconfigure`.
+# Changes to 'nodes' are only live if the set of node names stays the same,
+# see needs_restart().
+RECONFIGURE_KEYS = frozenset([
+    'scheduler_parameters',
+    'message_timeout',
+    'tree_width',
+    'performance_profile',
+    'kill_wait',
+    'min_job_age',
+    'mpi_default',
+    'node_weight_criteria',
+    'partitions',
+    'topology_conf',
+    'slurmctld_debug',
+    'slurmctld_log_file',
+    'slurmctld_timeout',
+    'slurmd_debug',
+    'slurmd_log_file',
+    'slurmd_timeout',
+])
+# slurm.conf parameters of the include fragments that a running slurmctld
+# applies on `scontrol reconfigure`, in lower case. A change to any other
+# parameter of the fragments (e.g. SlurmctldPort or a NodeName line) needs
+# a restart, see needs_restart().
+RECONFIGURE_PARAMETERS = frozenset([
+    'schedulerparameters',
+    'messagetimeout',
+    'treewidth',
+    'killwait',
+    'minjobage',
+    'mpidefault',
+    'partitionname',
+    'debugflags',
+    'inactivelimit',
+    'overtimelimit',
+    'waittime',
+    'slurmctlddebug',
+    'slurmctldlogfile',
+    'slurmctldtimeout',
+    'slurmddebug',
+    'slurmdlogfile',
+    'slurmdtimeout',
+])
+# Charm options that only steer the charm itself and are not rendered.
+# Whatever effect they have shows in other context keys (e.g.
+# node_feature_rules in 'nodes', the topology options in topology_plugin and
+# topology_conf), so they are left out of the digests and
+# changing them alone neither restarts nor reconfigures slurmctld.
+CHARM_ONLY_KEYS = frozenset([
+    'config_publish_mode',
+    'compress_hostlists',
+    'node_batch_max_wait',
+    'node_batch_settle',
+    'node_weight_buckets',
+    'debug_log_file',
+    'profile_handlers',
+    'slurmctld_port_range',
+    'expected_submit_rate',
+    'failover_probe_failures',
+    'failover_probe_timeout',
+    'state_save_replication',
+    'state_save_replication_interval',
+    'jobcomp_file',
+    'jobcomp_index',
+    'jobcomp_batch_size',
+    'jobcomp_flush_interval',
+    'metrics_textfile',
+    'metrics_history_size',
+    'ready_timeout',
+    'node_feature_rules',
+    'topology',
+    'topology_map',
+    'topology_subnet_prefix',
+])
+
+# Context keys the layer:slurm slurm.conf template does not render, with
+# their slurm.conf parameter. They are written to the include text instead,
+# see managed_include().
+MANAGED_PARAMETERS = collections.OrderedDict([
+    ('slurmctld_parameters', 'SlurmctldParameters'),
+    ('scheduler_parameters', 'SchedulerParameters'),
+    ('max_job_count', 'MaxJobCount'),
+    ('message_timeout', 'MessageTimeout'),
+    ('tree_width', 'TreeWidth'),
+    ('jobcomp_type', 'JobCompType'),
+    ('jobcomp_loc', 'JobCompLoc'),
+    ('topology_plugin', 'TopologyPlugin'),
+])
+
+# unit kv keys used for delta publishing on the slurm-cluster relation
+PUBLISHED_KEY = 'slurm-controller.published'
+GENERATION_KEY = 'slurm-controller.config_generation'
+# names of all keys published in either mode, to clear the ones that go away
+PUBLISHED_NAMES_KEY = 'slurm-controller.published_names'
+# keys that grow with the cluster size and are published compressed
+COMPRESSED_KEYS = ('nodes', 'partitions', 'include', 'topology_conf')
+COMPRESSED_PREFIX = 'zlib+b64:'
+# keys published to nodes in configless mode, next to the prefixed network
+# details of both controller roles; slurmd fetches everything else from
+# slurmctld
+CONFIGLESS_KEYS = ('clustername', 'configless', 'munge_key', 'slurmctld_port',
+                   'slurm_config_updated')
+# unit kv keys tracking a batch of joining nodes and the node units
+# goal-state expected when the last batch closed, see node_batch_pending()
+NODE_BATCH_KEY = 'slurm-controller.node_batch'
+NODE_BATCH_EXPECTED_KEY = 'slurm-controller.node_batch_expected'
+
+# unit kv key holding the ports opened for slurmctld
+OPENED_PORTS_KEY = 'slurm-controller.opened_ports'
+# unit kv key holding the failed health probes of the active controller,
+# only kept on the leader
+HEALTH_KEY = 'slurm-controller.health'
+# unit kv key caching the slurm.conf include fragments, see fragments.py
+FRAGMENTS_KEY = 'slurm-controller.include_fragments'
+# unit kv keys of the readiness gate after a slurmctld restart
+RESTARTED_KEY = 'slurm-controller.restarted'
+READY_LATENCY_KEY = 'slurm-controller.ready_latency'
+# unit kv keys of the dirty-tracking apply model, see mark_dirty()
+DIRTY_KEY = 'slurm-controller.dirty'
+SECTIONS_KEY = 'slurm-controller.sections'
+# context sections in the order they are merged into the rendering context
+SECTIONS = ('config', 'include', 'nodes', 'tuning', 'topology', 'munge',
+            'network', 'dbd', 'jobcomp')
+# sections built from other sections, rebuilt whenever those are
+SECTION_DEPENDS = {'tuning': ('config', 'nodes'),
+                   'topology': ('config', 'nodes'),
+                   'jobcomp': ('config',)}
+
+# systemd service shipping job completions to Elasticsearch, see jobcomp.py
+JOBCOMP_SERVICE = 'slurm-jobcomp-export'
+JOBCOMP_UNIT_FILE = '/etc/systemd/system/%s.service' % JOBCOMP_SERVICE
+JOBCOMP_STATE_FILE = '/var/lib/slurm-controller/jobcomp-export.json'
+JOBCOMP_UNIT = '''# Managed by the slurm-controller charm
+[Unit]
+Description=Export Slurm job completions to Elasticsearch
+After=network-online.target
+
+[Service]
+ExecStart=/usr/bin/python3 {script} --url {url} --file {file} \\
+    --state-file {state_file} --index {index} --batch-size {batch_size} \\
+    --flush-interval {flush_interval}
+Restart=always
+RestartSec=10
+
+[Install]
+WantedBy=multi-user.target
+'''
+
+# Hook-scoped caches. Every hook runs in a fresh process, so these start
+# empty in each hook and config can only change between hooks.
+_hook_cache = {}
+# agent round-trips made by this hook, per hook tool
+_agent_calls = collections.Counter()
+# callbacks already scheduled to run at the end of this hook
+_scheduled = set()
+
+
+def _count_agent_call(tool):
+    if not _agent_calls:
+        hookenv.atexit(report_agent_calls)
+    _agent_calls[tool] += 1
+
+
+def agent_calls():
+    '''Return the agent round-trips made so far in this hook by hook tool.'''
+    return dict(_agent_calls)
+
+
+def report_agent_calls():
+    hookenv.log('{} made {} agent calls: {}'.format(
+        hookenv.hook_name(), sum(_agent_calls.values()),
+        ', '.join('{}={}'.format(tool, count)
+                  for tool, count in sorted(_agent_calls.items()))))
+
+
+def invalidate(*keys):
+    '''Drop cached agent reads, all of them if no keys are given.'''
+    if not keys:
+        _hook_cache.clear()
+    for key in keys:
+        _hook_cache.pop(key, None)
+
+
+def config():
+    '''Read-through cached hookenv.config().'''
+    if 'config' not in _hook_cache:
+        _count_agent_call('config-get')
+        _hook_cache['config'] = hookenv.config()
+    return _hook_cache['config']
+
+
+def leader_get(attribute=None):
+    """Read-through cached leadership settings.
+
+    All settings are fetched with a single leader-get on first use in a
+    hook, later reads are served from memory until leader_set() is called.
+    """
+    if 'leader' not in _hook_cache:
+        _count_agent_call('leader-get')
+        _hook_cache['leader'] = leadership.leader_get() or {}
+    if attribute is None:
+        return dict(_hook_cache['leader'])
+    return _hook_cache['leader'].get(attribute)
+
+
+def leader_set(settings=None, **kwargs):
+    '''Change leadership settings and invalidate the cached ones.'''
+    _count_agent_call('leader-set')
+    leadership.leader_set(settings, **kwargs)
+    invalidate('leader')
+
+
+def inventory_index(endpoint):
+    """Return the node inventory index, refreshed once per hook.
+
+    Only node units whose relation data may have changed are read, see
+    charms.slurm.inventory.
+    """
+    if 'inventory' not in _hook_cache:
+        index = inventory.InventoryIndex()
+        index.update(endpoint)
+        index.save()
+        if index.read:
+            _agent_calls['relation-get'] += index.read
+        _hook_cache['inventory'] = index
+    return _hook_cache['inventory']
+
+
+def network_details(endpoint):
+    '''Read-through cached network details of an endpoint.'''
+    key = 'network_details.{}'.format(endpoint.endpoint_name)
+    if key not in _hook_cache:
+        _count_agent_call('network-get')
+        _hook_cache[key] = endpoint.network_details()
+    return _hook_cache[key]
 
 
 def get_partitions(node_data):
@@ -34,6 +323,23 @@ def get_partitions(node_data):
     return dict(part_dict)
 
 
+def compress_nodes(nodes, partitions):
+    """Return nodes and partitions with hostnames as Slurm hostlist ranges.
+
+    Nodes with identical definitions are merged into one ranged NodeName
+    entry and partition host lists are compressed, e.g. node001..node512
+    becomes node[001-512]. The input is left untouched; use
+    hostlist.expand_nodes() and hostlist.expand() to get flat lists back.
+
+    :rtype: tuple
+    """
+    compressed = {}
+    for name, partition in partitions.items():
+        compressed[name] = dict(partition,
+                                hosts=hostlist.compress(partition['hosts']))
+    return hostlist.group_nodes(nodes), compressed
+
+
 def add_key_prefix(d, prefix):
     return {'{key_prefix}_{key}'
             .format(key_prefix=prefix, key=k): d[k]
@@ -41,44 +347,766 @@ def add_key_prefix(d, prefix):
 
 
 def is_active_controller():
-    return leadership.leader_get('active_controller') == hookenv.local_unit()
+    return leader_get('active_controller') == hookenv.local_unit()
+
+
+class DecisionLog(object):
+    """Collect per-node decisions and log them as a single summary.
+
+    Every hookenv.log() call forks a juju-log process, which on large
+    clusters dominates the hook runtime when done per node. Decisions are
+    counted per outcome instead and written with one call on flush(). If
+    a detail_file is given, the per-node details are appended to that local
+    file rather than to the agent log. Once the file exceeds
+    MAX_DETAIL_BYTES it is rotated to detail_file.1, replacing an older
+    one, so at most two files are kept.
+
+    Example::
+
+        decisions = DecisionLog('weights', detail_file='/tmp/weights.log')
+        decisions.record('node1', 'Weight=2', 'RealMemory=64000')
+        decisions.missing('node2', 'RealMemory')
+        decisions.flush()
+
+    """
+
+    # number of node names listed in the summary for missing values
+    MAX_LISTED = 10
+    # size of the detail file after which it is rotated
+    MAX_DETAIL_BYTES = 10 * 1024 * 1024
+
+    def __init__(self, topic, detail_file=None):
+        self.topic = topic
+        self.detail_file = detail_file
+        self.outcomes = collections.Counter()
+        self.missing_nodes = collections.defaultdict(list)
+        self.details = []
+
+    def record(self, node, outcome, detail=None):
+        self.outcomes[outcome] += 1
+        if self.detail_file:
+            self.details.append('{}: {}{}'.format(
+                node, outcome, ' ({})'.format(detail) if detail else ''))
 
+    def missing(self, node, key):
+        self.missing_nodes[key].append(node)
+        if self.detail_file:
+            self.details.append('{}: no {} value'.format(node, key))
 
-def set_node_weight_criteria(node_weight_criteria, nodes):
+    def summary(self):
+        parts = ['{} {} nodes'.format(outcome, count)
+                 for outcome, count in sorted(self.outcomes.items())]
+        for key, nodes in sorted(self.missing_nodes.items()):
+            listed = ', '.join(nodes[:self.MAX_LISTED])
+            if len(nodes) > self.MAX_LISTED:
+                listed += ', ...'
+            parts.append('{} nodes missing {}: {}'.format(
+                len(nodes), key, listed))
+        return '{}: {}'.format(self.topic, '; '.join(parts) or 'nothing')
 
-    criteria_allowed = ['RealMemory', 'CPUs', 'CoresPerSocket']
-    if not node_weight_criteria in criteria_allowed:
-        hookenv.status_set('blocked', 'Incorrect charm "node_weight_criteria=%s" '
-                'configuration, aborting charm configuration!' % node_weight_criteria)
+    def flush(self):
+        hookenv.log(self.summary())
+        if self.detail_file and self.details:
+            if (os.path.exists(self.detail_file) and
+                    os.path.getsize(self.detail_file) >=
+                    self.MAX_DETAIL_BYTES):
+                os.replace(self.detail_file, self.detail_file + '.1')
+            with open(self.detail_file, 'a') as f:
+                f.write('# {} {} {}\n'.format(
+                    time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    hookenv.hook_name(), self.topic))
+                f.write('\n'.join(self.details) + '\n')
+        self.outcomes.clear()
+        self.missing_nodes.clear()
+        self.details = []
+
+
+def set_node_weight_criteria(node_weight_criteria, nodes, detail_file=None,
+                             node_weight_buckets=None):
+    """Set the Weight of every node from its inventory.
+
+    :param node_weight_criteria: ordered, comma separated criteria, e.g.
+        'RealMemory,CPUs'
+    :param nodes: nodes whose inventory gets a 'Weight'
+    :param detail_file: local file for per-node details, see DecisionLog
+    :param node_weight_buckets: bucket specification, see
+        charms.slurm.weights.parse_buckets()
+    :return: False if the configuration is incorrect
+    :rtype: bool
+    """
+    try:
+        criteria = weights.parse_criteria(node_weight_criteria)
+        buckets = weights.parse_buckets(node_weight_buckets, criteria)
+    except ValueError as e:
+        hookenv.status_set('blocked', 'Incorrect charm "node_weight_criteria=%s '
+                           'node_weight_buckets=%s" configuration (%s), aborting '
+                           'charm configuration!' % (node_weight_criteria,
+                                                     node_weight_buckets, e))
         return False
 
-    weightsizes = {}
-    for n in nodes:
-        # Don't just assume the criteria is available for every node.
-        # If not, store lowest weight 1 (default anyway) so it will get the lowest weight
-        try:
-            hookenv.log('Saving %s=%s for node %s' %
-                    (node_weight_criteria, n['inventory'][node_weight_criteria], n['inventory']['NodeName']))
-            weightsizes[int(n['inventory'][node_weight_criteria])] = "x"
-        except KeyError as e:
-            hookenv.log('No %s value found for node %s, will set node weight 1' % (node_weight_criteria, n['inventory']['NodeName']))
-            weightsizes[1] = "x"
-
-    weightindex = 1
-    # note: sorted(weightsizes, reverse=True) is for reverse sorting, but does it really make
-    # sense to put weights in reverse order?
-    for size in sorted(weightsizes):
-        weightsizes[size] = weightindex
-        hookenv.log('Adding weight %d to %s=%d\n' % (weightindex, node_weight_criteria, size))
-        weightindex += 1
-
-    for n in nodes:
-        try:
-            n['inventory'].update({'Weight' : str(weightsizes[int(n['inventory'][node_weight_criteria])])})
-        except KeyError as e:
-            n['inventory'].update({'Weight' : '1'})
+    decisions = DecisionLog('Node weights by %s' % ','.join(criteria),
+                            detail_file=detail_file)
+    node_weights, missing = weights.compute_weights(nodes, criteria, buckets)
+    for n, weight in zip(nodes, node_weights):
+        n['inventory']['Weight'] = str(weight)
+        decisions.record(n['inventory'].get('NodeName', n.get('hostname')),
+                         'Weight=%d' % weight)
+    for criterion, names in missing.items():
+        for name in names:
+            decisions.missing(name, criterion)
+    decisions.flush()
+    return True
+
+
+class LayeredContext(collections.abc.Mapping):
+    """Read-only rendering context made of layers, later layers win.
+
+    The layers (context sections) are held by reference, so putting the
+    context together copies neither the node list nor the partitions no
+    matter how large the cluster is. dict() gives a shallow copy where a
+    real dictionary is needed.
+    """
+
+    def __init__(self, *layers):
+        self._chain = collections.ChainMap(*reversed(layers))
+
+    def __getitem__(self, key):
+        return self._chain[key]
+
+    def __iter__(self):
+        return iter(self._chain)
+
+    def __len__(self):
+        return len(self._chain)
+
+
+def context_digests(context):
+    """Return a content hash per context key, leaving out VOLATILE_KEYS and
+    CHARM_ONLY_KEYS.
+
+    Each value is serialized once here; the fingerprint and the restart
+    decision both work on these hashes.
+
+    :rtype: dict
+    """
+    return {k: _digest(v) for k, v in context.items()
+            if k not in VOLATILE_KEYS and k not in CHARM_ONLY_KEYS}
+
+
+def config_fingerprint(digests, active_controller):
+    """Return a content hash of a rendering context.
+
+    The context fully determines the rendered slurm.conf and the state save
+    location, so hashing it together with the controller role is enough to
+    tell whether anything slurmctld or the nodes care about has changed.
+
+    :param digests: result of context_digests()
+    :rtype: str
+    """
+    payload = json.dumps([active_controller, digests], sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def fingerprint_changed(fingerprint):
+    return unitdata.kv().get(FINGERPRINT_KEY) != fingerprint
+
+
+def applied_context():
+    """Return what needs_restart() needs to know about the applied context:
+    the hashes of its keys and of its include parameters and its
+    (compressed) node names.
+
+    :rtype: dict
+    """
+    return unitdata.kv().get(APPLIED_CONTEXT_KEY)
+
+
+def save_applied_config(fingerprint, digests, context):
+    kv = unitdata.kv()
+    kv.set(FINGERPRINT_KEY, fingerprint)
+    # the context itself is kept in the sections already
+    kv.set(APPLIED_CONTEXT_KEY, {
+        'digests': digests,
+        'node_names': hostlist.compress(_node_names(context.get('nodes'))),
+        'include_parameters': _include_digests(context.get('include')),
+    })
+
+
+def forget_applied_config():
+    '''Forget the last applied config so that the next run rebuilds and
+    applies it with a full slurmctld restart.'''
+    kv = unitdata.kv()
+    kv.unset(FINGERPRINT_KEY)
+    kv.unset(APPLIED_CONTEXT_KEY)
+    kv.unset(SECTIONS_KEY)
+    kv.unset(FRAGMENTS_KEY)
+
+
+def stale_sections(dirty, sections):
+    """Return the sections that need rebuilding, in SECTIONS order.
+
+    :param dirty: names of sections marked as stale
+    :param sections: sections built by earlier applies
+    :rtype: list
+    """
+    stale = []
+    for name in SECTIONS:
+        if (name in dirty or name not in sections or
+                set(SECTION_DEPENDS.get(name, ())).intersection(stale)):
+            stale.append(name)
+    return stale
+
+
+def node_count(partitions):
+    '''Number of nodes in (possibly compressed) partitions.'''
+    return len(set(hostlist.expand(
+        [host for p in partitions.values() for host in p['hosts']])))
+
+
+def mark_dirty(*parts):
+    """Mark context sections as stale so that the next apply rebuilds them.
+
+    Dirty sections are kept in unit kv until an apply succeeds, so nothing
+    is lost when applying has to wait (e.g. for joining nodes).
+
+    :param parts: names from SECTIONS, or 'all'
+    """
+    if 'all' in parts:
+        parts = SECTIONS
+    kv = unitdata.kv()
+    kv.set(DIRTY_KEY, sorted(set(kv.get(DIRTY_KEY) or []) | set(parts)))
+
+
+def dirty_parts():
+    return set(unitdata.kv().get(DIRTY_KEY) or [])
+
+
+def clear_dirty():
+    unitdata.kv().unset(DIRTY_KEY)
+
+
+def context_sections():
+    '''Return the context sections built by earlier applies.'''
+    return unitdata.kv().get(SECTIONS_KEY) or {}
+
+
+def save_context_sections(sections):
+    unitdata.kv().set(SECTIONS_KEY, sections)
+
+
+def schedule_apply(callback):
+    """Run callback once, after all handlers of this hook have run.
+
+    Handlers only mark what is stale, so however many triggers fire during
+    a dispatch, the config is built, rendered and applied a single time.
+    """
+    if callback.__name__ in _scheduled:
+        return
+    _scheduled.add(callback.__name__)
+    hookenv.atexit(callback)
 
+
+def _node_names(nodes):
+    # entries may be ranged, see compress_nodes()
+    return sorted(hostlist.expand([
+        n['inventory'].get('NodeName', n.get('hostname'))
+        for n in nodes or []]))
+
+
+def _include_digests(include):
+    return {name: _digest(value) for name, value in
+            fragments.parameters(include or '').items()}
+
+
+def needs_restart(old, new, digests=None):
+    """Tell whether going from the old to the new context needs a
+    slurmctld restart or can be applied with `scontrol reconfigure`.
+
+    :param old: applied_context() or None if nothing was applied yet
+    :param new: context that is about to be applied
+    :param digests: context_digests() of the new context, if known
+    :rtype: bool
+    """
+    if not old or 'digests' not in old:
+        return True
+    if digests is None:
+        digests = context_digests(new)
+    for key in (set(old['digests']) | set(digests)) - CHARM_ONLY_KEYS:
+        if old['digests'].get(key) == digests.get(key):
+            continue
+        if key == 'nodes':
+            # adding or removing nodes requires a restart of slurmctld
+            # expand() gives numeric order, _node_names() string order
+            if (set(hostlist.expand(old['node_names'])) !=
+                    set(_node_names(new.get(key)))):
+                hookenv.log('Node set changed, slurmctld restart required')
+                return True
+        elif key == 'include':
+            # the fragments may set any parameter, only some are live
+            if 'include_parameters' not in old:
+                return True
+            params = _include_digests(new.get(key))
+            changed = sorted(
+                name for name in set(old['include_parameters']) | set(params)
+                if old['include_parameters'].get(name) != params.get(name) and
+                name.split('=', 1)[0] not in RECONFIGURE_PARAMETERS)
+            if changed:
+                hookenv.log('Include parameters changed ({}), slurmctld '
+                            'restart required'.format(', '.join(changed)))
+                return True
+        elif key not in RECONFIGURE_KEYS:
+            hookenv.log('Option {} changed ({}), slurmctld restart '
+                        'required'.format(key, 'restart only'
+                                          if key in RESTART_KEYS
+                                          else 'unclassified'))
+            return True
+    return False
+
+
+def open_slurmctld_ports(port):
+    """Open every port of a SlurmctldPort value and close the ones that
+    are no longer part of it.
+
+    :param port: single port or range, e.g. 6817-6820
+    """
+    kv = unitdata.kv()
+    wanted = set(tuning.ports(port))
+    opened = set(kv.get(OPENED_PORTS_KEY) or [])
+    for p in sorted(wanted - opened):
+        _count_agent_call('open-port')
+        hookenv.open_port(p)
+    for p in sorted(opened - wanted):
+        _count_agent_call('close-port')
+        hookenv.close_port(p)
+    kv.set(OPENED_PORTS_KEY, sorted(wanted))
+
+
+def topology_context(index, conf):
+    """Build the topology.conf context for the topology option.
+
+    :param index: inventory index with the attributes of the nodes
+    :param conf: charm config
+    :return: topology_plugin and topology_conf keys, empty if disabled
+    :raises ValueError: on an unknown mode or a malformed topology_map
+    :rtype: dict
+    """
+    mode = conf.get('topology') or 'none'
+    if mode not in topology.MODES:
+        raise ValueError('unknown topology mode {}'.format(mode))
+    if mode == 'none':
+        return {}
+    attributes = index.attributes
+    prefix_length = conf.get('topology_subnet_prefix')
+    mapping = None
+    if mode == 'map':
+        mapping = topology.parse_map(conf.get('topology_map'))
+    leaves, parents = topology.build(
+        attributes,
+        lambda node: topology.leaf_switch(attributes[node], prefix_length),
+        mapping)
+    return {'topology_plugin': 'topology/tree',
+            'topology_conf': topology.render(leaves, parents)}
+
+
+def write_topology(config_dir, conf):
+    '''Write or remove topology.conf next to slurm.conf.'''
+    path = os.path.join(config_dir, 'topology.conf')
+    if conf.get('topology_conf'):
+        host.write_file(path, conf['topology_conf'].encode('utf-8'),
+                        perms=0o644)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def scan_include_fragments(config_dir):
+    """Check the include fragments for changes, reading only the ones
+    whose size or modification time changed.
+
+    :return: (paths, cache, changed) as for fragments.scan()
+    :rtype: tuple
+    """
+    kv = unitdata.kv()
+    paths = fragments.fragment_paths(config_dir, config().get('clustername'))
+    cache, changed = fragments.scan(paths, kv.get(FRAGMENTS_KEY) or {})
+    kv.set(FRAGMENTS_KEY, cache)
+    return paths, cache, changed
+
+
+def include_context(config_dir):
+    '''The include context key built from the cached fragments.'''
+    paths, cache, _ = scan_include_fragments(config_dir)
+    if not paths:
+        return {}
+    return {'include': fragments.include_text(paths, cache)}
+
+
+def managed_include(conf):
+    """Return the include context key with the MANAGED_PARAMETERS set in
+    conf as slurm.conf lines.
+
+    The lines come before the include fragments, so that a parameter an
+    operator sets in a fragment still wins.
+
+    :return: dictionary with the include key, empty if no such parameter
+        is set
+    :rtype: dict
+    """
+    lines = ['{}={}'.format(parameter, conf[key])
+             for key, parameter in MANAGED_PARAMETERS.items()
+             if conf.get(key) not in (None, '')]
+    if not lines:
+        return {}
+    return {'include': '# managed by the slurm-controller charm\n' +
+            '\n'.join(lines) + '\n' + (conf.get('include') or '')}
+
+
+def reconfigure_slurmctld():
+    """Ask a running slurmctld to re-read slurm.conf.
+
+    :return: True on success, False if a restart is needed instead.
+    :rtype: bool
+    """
+    try:
+        subprocess.check_call(['scontrol', 'reconfigure'])
+    except (OSError, subprocess.CalledProcessError) as e:
+        hookenv.log('scontrol reconfigure failed: {}'.format(e),
+                    hookenv.WARNING)
+        return False
+    return True
+
+
+def ping_slurmctld(timeout):
+    """Ask the configured controllers whether they respond.
+
+    :param timeout: seconds to wait for scontrol ping
+    :return: result of health.parse_ping, empty if scontrol timed out and
+        None if it could not be run
+    :rtype: dict
+    """
+    try:
+        output = subprocess.check_output(['scontrol', 'ping'],
+                                         stderr=subprocess.STDOUT,
+                                         timeout=timeout)
+    except subprocess.TimeoutExpired:
+        hookenv.log('scontrol ping timed out after {}s'.format(timeout),
+                    hookenv.WARNING)
+        return {}
+    except subprocess.CalledProcessError as e:
+        # non-zero exit when a controller is down, the output still tells
+        output = e.output
+    except OSError as e:
+        hookenv.log('scontrol ping failed: {}'.format(e), hookenv.WARNING)
+        return None
+    return health.parse_ping(output.decode('utf-8', 'replace'))
+
+
+def record_restart():
+    '''Remember when slurmctld was restarted, see wait_until_ready().'''
+    unitdata.kv().set(RESTARTED_KEY, time.time())
+
+
+def slurmctld_ready(port, role, timeout=2):
+    """Return True if the local slurmctld accepts connections and answers
+    scontrol ping in its role.
+
+    :param port: SlurmctldPort value, the first port of a range is checked
+    :param role: 'primary' or 'backup'
+    :rtype: bool
+    """
+    try:
+        socket.create_connection(('127.0.0.1', tuning.ports(port)[0]),
+                                 timeout).close()
+    except OSError:
+        return False
+    result = ping_slurmctld(timeout)
+    return bool(result and result.get(role, {}).get('up'))
+
+
+def wait_until_ready(port, role, timeout, delay=0.5, max_delay=10):
+    """Wait with exponential backoff until a restarted slurmctld is ready.
+
+    slurmctld only answers once it has recovered its state save, so nodes
+    and users should not be pointed at it before.
+
+    :param timeout: seconds to wait at most, 0 checks only once
+    :return: seconds from the last restart until ready, None on timeout
+    """
+    deadline = time.time() + timeout
+    while not slurmctld_ready(port, role):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
+    kv = unitdata.kv()
+    latency = round(time.time() - (kv.get(RESTARTED_KEY) or time.time()), 1)
+    kv.set(READY_LATENCY_KEY, latency)
+    kv.unset(RESTARTED_KEY)
+    hookenv.log('slurmctld ready {}s after restart'.format(latency))
+    return latency
+
+
+def ready_status():
+    '''Status message of a ready controller with its last restart latency.'''
+    latency = unitdata.kv().get(READY_LATENCY_KEY)
+    if latency is None:
+        return 'Ready'
+    return 'Ready (slurmctld up {}s after restart)'.format(latency)
+
+
+def probe_active_controller(backup_unit, threshold, timeout):
+    """Probe the active controller and promote backup_unit once it failed
+    threshold consecutive probes while the backup still responds.
+
+    :return: True if the backup unit was promoted
+    :rtype: bool
+    """
+    result = ping_slurmctld(timeout)
+    if result is None:
+        return False
+    kv = unitdata.kv()
+    primary_up = result.get('primary', {}).get('up', False)
+    backup_up = any(status['up'] for role, status in result.items()
+                    if role.startswith('backup'))
+    state = health.update_state(kv.get(HEALTH_KEY), primary_up, time.time())
+    kv.set(HEALTH_KEY, state)
+    if state['failures']:
+        hookenv.log('Active controller failed {}/{} health probes'.format(
+            state['failures'], threshold), hookenv.WARNING)
+    if not health.should_fail_over(state, threshold, backup_up):
+        return False
+    fail_over(backup_unit, state['since'])
     return True
 
 
+def fail_over(new_active, detected):
+    """Make new_active the active controller and record how long it took
+    from the first failed probe in the last_failover leader setting."""
+    now = time.time()
+    failover = {
+        'from': leader_get('active_controller'),
+        'to': new_active,
+        'detected': detected,
+        'promoted': now,
+        'seconds': round(now - detected, 3),
+    }
+    leader_set(active_controller=new_active,
+               last_failover=json.dumps(failover, sort_keys=True))
+    unitdata.kv().unset(HEALTH_KEY)
+    hookenv.log('Failed over active controller from {} to {} after '
+                '{}s'.format(failover['from'], new_active,
+                             failover['seconds']), hookenv.WARNING)
+
+
+def encode_value(value):
+    '''Encode a large value as compressed JSON for relation data.'''
+    raw = json.dumps(value, sort_keys=True, default=str).encode('utf-8')
+    return COMPRESSED_PREFIX + base64.b64encode(
+        zlib.compress(raw, 9)).decode('ascii')
+
+
+def decode_value(value):
+    '''Reverse encode_value(), leaving plain values untouched.'''
+    if not (isinstance(value, str) and value.startswith(COMPRESSED_PREFIX)):
+        return value
+    raw = base64.b64decode(value[len(COMPRESSED_PREFIX):])
+    return json.loads(zlib.decompress(raw).decode('utf-8'))
+
+
+def _digest(value):
+    return hashlib.sha1(json.dumps(value, sort_keys=True, default=str)
+                        .encode('utf-8')).hexdigest()
+
+
+def _relation_ids(endpoint):
+    return sorted(r.relation_id for r in endpoint.relations)
+
+
+def publish_controller_config(endpoint, conf, delta=False):
+    """Publish the controller config to the slurm-cluster relation.
+
+    In delta mode only keys that changed since the last publish are sent,
+    large keys are compressed and a monotonically increasing
+    'config_generation' is added so that nodes can tell one update from
+    another. Keys that disappeared from the config are cleared. A full
+    publish is done whenever the set of relations changes, as a new
+    relation has nothing published on it yet.
+
+    :param endpoint: slurm-cluster endpoint
+    :param conf: controller config, values of None clear a key
+    :param delta: publish only the changes
+    :return: number of keys sent
+    :rtype: int
+    """
+    kv = unitdata.kv()
+    published = kv.get(PUBLISHED_KEY) or {}
+    relation_ids = _relation_ids(endpoint)
+    # keys published before that are gone now, e.g. after switching modes
+    removed = set(kv.get(PUBLISHED_NAMES_KEY) or []) - set(conf)
+    kv.set(PUBLISHED_NAMES_KEY, sorted(conf))
+    if not delta:
+        payload = dict(conf)
+        payload.update((k, None) for k in removed)
+        if published:
+            # clear what delta publishing left behind
+            payload.update({'config_generation': None,
+                            'config_compressed_keys': None})
+            kv.unset(PUBLISHED_KEY)
+        endpoint.send_controller_config(payload)
+        return len(payload)
+
+    digests = {}
+    payload = {}
+    full = published.get('relation_ids') != relation_ids
+    for key, value in conf.items():
+        if key in COMPRESSED_KEYS and value is not None:
+            value = encode_value(value)
+        digests[key] = _digest(value)
+        if full or published.get('keys', {}).get(key) != digests[key]:
+            payload[key] = value
+    for key in removed.union(published.get('keys', {})):
+        if key not in conf:
+            payload[key] = None
+    if not payload:
+        return 0
+
+    generation = kv.get(GENERATION_KEY, 0) + 1
+    payload.update({
+        'config_generation': generation,
+        'config_compressed_keys': [k for k in COMPRESSED_KEYS if k in conf],
+    })
+    endpoint.send_controller_config(payload)
+    kv.set(GENERATION_KEY, generation)
+    kv.set(PUBLISHED_KEY, {'relation_ids': relation_ids, 'keys': digests})
+    hookenv.log('Published config generation {} ({} of {} keys)'.format(
+        generation, len(payload) - 2, len(conf)))
+    return len(payload)
+
+
+def clear_controller_config(endpoint, conf):
+    """Clear everything this unit published on the slurm-cluster relation,
+    e.g. after it stopped being the active controller."""
+    kv = unitdata.kv()
+    published = kv.get(PUBLISHED_KEY)
+    keys = set(conf).union(kv.get(PUBLISHED_NAMES_KEY) or [])
+    if published:
+        keys.update(published.get('keys', {}))
+        keys.update(('config_generation', 'config_compressed_keys'))
+        kv.unset(PUBLISHED_KEY)
+    kv.unset(PUBLISHED_NAMES_KEY)
+    endpoint.send_controller_config({k: None for k in keys})
+
+
+def configless_config(conf):
+    """Return the part of the controller config nodes need in configless
+    mode: how to reach slurmctld and the munge key.
+
+    The size of this does not depend on the size of the cluster.
+
+    :rtype: dict
+    """
+    prefixes = tuple(role + '_' for role in ROLES.values())
+    return {k: v for k, v in conf.items()
+            if k in CONFIGLESS_KEYS or k.startswith(prefixes)}
+
+
+def expected_node_units():
+    """Return how many node units goal-state expects on slurm-cluster.
+
+    :return: number of units that are not going away, or None if
+        goal-state is not available.
+    """
+    _count_agent_call('goal-state')
+    try:
+        goal = hookenv.goal_state()
+    except (NotImplementedError, OSError, subprocess.CalledProcessError):
+        return None
+    units = goal.get('relations', {}).get('slurm-cluster', {})
+    # application entries are listed next to their units
+    return len([unit for unit, info in units.items()
+                if '/' in unit and
+                info.get('status') not in ('dying', 'dead')])
+
+
+def node_batch_pending(reported, expected, max_wait, settle, now=None):
+    """Tell whether configuration should wait for more nodes to report.
+
+    Joining nodes are applied in one batch once all units expected by
+    goal-state have reported their inventory. A batch is cut short when it
+    has been open for max_wait seconds or when no new node reported for
+    settle seconds, so that a stuck unit does not hold back the cluster.
+    A batch is only opened when goal-state expects more units than when the
+    last batch closed, so a unit that never reports does not defer every
+    later change again.
+
+    :param reported: number of nodes that provided their data
+    :param expected: number of node units expected by goal-state or None
+    :param max_wait: maximum seconds to wait, 0 disables batching
+    :param settle: seconds without progress after which to stop waiting
+    :rtype: bool
+    """
+    kv = unitdata.kv()
+    batch = kv.get(NODE_BATCH_KEY)
+    if not max_wait or expected is None or reported >= expected:
+        return _close_node_batch(expected)
+    if batch is None and expected <= (kv.get(NODE_BATCH_EXPECTED_KEY) or 0):
+        # no scale-out since the last batch
+        return _close_node_batch(expected)
+
+    now = time.time() if now is None else now
+    batch = batch or {'started': now, 'changed': now, 'reported': reported}
+    if batch['reported'] != reported:
+        batch.update(reported=reported, changed=now)
+    if now - batch['started'] >= max_wait:
+        hookenv.log('Gave up waiting for {}/{} nodes after {}s'.format(
+            reported, expected, max_wait), hookenv.WARNING)
+    elif settle and now - batch['changed'] >= settle:
+        hookenv.log('No new nodes for {}s, applying {}/{} nodes'.format(
+            settle, reported, expected), hookenv.WARNING)
+    else:
+        kv.set(NODE_BATCH_KEY, batch)
+        return True
+    return _close_node_batch(expected)
+
+
+def _close_node_batch(expected):
+    kv = unitdata.kv()
+    kv.unset(NODE_BATCH_KEY)
+    if expected is not None:
+        kv.set(NODE_BATCH_EXPECTED_KEY, expected)
+    return False
+
+
+def enable_jobcomp_export(url, conf):
+    """Install and (re)start the service shipping the jobcomp file to
+    Elasticsearch.
+
+    :param url: Elasticsearch base URL
+    :param conf: charm config with the jobcomp_* options
+    """
+    unit = JOBCOMP_UNIT.format(
+        script=os.path.join(hookenv.charm_dir(), 'lib', 'charms', 'slurm',
+                            'jobcomp.py'),
+        url=url, file=conf.get('jobcomp_file'),
+        state_file=JOBCOMP_STATE_FILE,
+        index=conf.get('jobcomp_index'),
+        batch_size=conf.get('jobcomp_batch_size'),
+        flush_interval=conf.get('jobcomp_flush_interval'))
+    host.mkdir(os.path.dirname(JOBCOMP_STATE_FILE))
+    host.write_file(JOBCOMP_UNIT_FILE, unit.encode('utf-8'))
+    subprocess.check_call(['systemctl', 'daemon-reload'])
+    subprocess.check_call(['systemctl', 'enable', JOBCOMP_SERVICE])
+    host.service_restart(JOBCOMP_SERVICE)
+    hookenv.log('Exporting job completions to {}'.format(url))
+
+
+def disable_jobcomp_export():
+    if not os.path.exists(JOBCOMP_UNIT_FILE):
+        return
+    subprocess.check_call(['systemctl', 'disable', '--now', JOBCOMP_SERVICE])
+    os.remove(JOBCOMP_UNIT_FILE)
+    subprocess.check_call(['systemctl', 'daemon-reload'])
+    hookenv.log('Stopped exporting job completions')
+
+
 ROLES = {True: 'active_controller', False: 'backup_controller'}
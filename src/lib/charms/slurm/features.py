@@ -0,0 +1,117 @@
+"""Node Features derived from the node inventory.
+
+Slurm Features let users pick hardware with ``--constraint`` inside one
+large partition instead of a partition per hardware class, which keeps a
+single queue for the backfill scheduler. The node_feature_rules option
+holds whitespace separated rules of the form ``<key><op><value>:<feature>``
+or ``<key>:<feature>``:
+
+- ``RealMemory>=262144:bigmem`` adds bigmem to nodes with at least 256 GiB,
+  the operators >=, <=, >, <, = and != compare numbers (or strings for =
+  and !=)
+- ``cpu_model~EPYC:epyc`` adds epyc if the value contains EPYC, case
+  insensitive, e.g. for the CPU model or flags reported by the node
+- ``CoresPerSocket:cores{}`` adds a class feature named after the value,
+  e.g. cores16
+
+Keys are looked up in the node attributes first, then in the inventory.
+"""
+import re
+import operator
+import collections
+
+_RULE = re.compile(r'^(?P<key>[\w-]+)(?:(?P<op>>=|<=|!=|=|>|<|~)'
+                   r'(?P<value>[^:]+))?:(?P<feature>[\w.{}-]+)$')
+_NUMERIC = {
+    '>=': operator.ge,
+    '<=': operator.le,
+    '>': operator.gt,
+    '<': operator.lt,
+    '=': operator.eq,
+    '!=': operator.ne,
+}
+_INVALID = re.compile(r'[^A-Za-z0-9_.-]+')
+
+Rule = collections.namedtuple('Rule', 'key op value feature')
+
+
+def parse_rules(text):
+    """Parse the node_feature_rules option.
+
+    :raises ValueError: on a malformed rule
+    :rtype: list
+    """
+    rules = []
+    for entry in (text or '').split():
+        match = _RULE.match(entry)
+        if not match:
+            raise ValueError('bad node feature rule "{}"'.format(entry))
+        feature = match.group('feature')
+        if '{}' not in feature and ('{' in feature or '}' in feature):
+            raise ValueError('bad node feature name "{}"'.format(feature))
+        rules.append(Rule(match.group('key'), match.group('op'),
+                          match.group('value'), feature))
+    return rules
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _matches(rule, value):
+    if rule.op is None:
+        return True
+    if rule.op == '~':
+        return rule.value.lower() in str(value).lower()
+    left, right = _number(value), _number(rule.value)
+    if left is None or right is None:
+        if rule.op in ('=', '!='):
+            return _NUMERIC[rule.op](str(value), rule.value)
+        return False
+    return _NUMERIC[rule.op](left, right)
+
+
+def node_features(values, rules):
+    """Return the features of a node.
+
+    :param values: attributes and inventory of the node
+    :rtype: list
+    """
+    features = []
+    for rule in rules:
+        value = values.get(rule.key)
+        if value is None or value == '' or not _matches(rule, value):
+            continue
+        feature = rule.feature
+        if '{}' in feature:
+            feature = feature.replace('{}', _INVALID.sub('_', str(value)))
+        if feature not in features:
+            features.append(feature)
+    return features
+
+
+def set_features(nodes, attributes, rules):
+    """Add the inventory Features of nodes from the rules, next to the
+    features a node already reported.
+
+    :param nodes: node dictionaries, changed in place
+    :param attributes: node name -> optional node attributes
+    :return: number of nodes that got any feature
+    :rtype: int
+    """
+    count = 0
+    for node in nodes:
+        inventory = node['inventory']
+        name = inventory.get('NodeName', node['hostname'])
+        values = dict(inventory, **attributes.get(name, {}))
+        reported = [f for f in str(inventory.get('Features') or '')
+                    .split(',') if f]
+        features = reported + [f for f in node_features(values, rules)
+                               if f not in reported]
+        if features:
+            inventory['Features'] = ','.join(features)
+            count += 1
+    return count
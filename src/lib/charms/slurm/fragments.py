@@ -0,0 +1,100 @@
+"""slurm.conf include fragments.
+
+Operators can add slurm.conf lines in ``slurm-<clustername>.conf`` and in
+``*.conf`` fragments of the ``slurm.conf.d`` drop-in directory, both in the
+Slurm config directory. The fragments are included in name order after the
+cluster file. A cache of the size, modification time and content hash of
+every fragment is kept between hooks, so unchanged fragments are neither
+read nor hashed again, and a change is only reported if the content of a
+fragment actually differs.
+"""
+import os
+import re
+import glob
+import hashlib
+
+DROP_IN_DIR = 'slurm.conf.d'
+# parameters starting a line that defines an entity rather than a setting
+ENTITY_PARAMETERS = ('nodename', 'partitionname', 'frontendname', 'nodeset',
+                     'downnodes', 'switchname')
+_PARAMETER = re.compile(r'(\w+)=("[^"]*"|\S+)')
+
+
+def fragment_paths(config_dir, clustername):
+    """Return the include fragments in include order.
+
+    :rtype: list
+    """
+    paths = []
+    cluster_file = os.path.join(config_dir, 'slurm-%s.conf' % clustername)
+    if os.path.isfile(cluster_file):
+        paths.append(cluster_file)
+    paths.extend(sorted(path for path in glob.glob(
+        os.path.join(config_dir, DROP_IN_DIR, '*.conf'))
+        if os.path.isfile(path)))
+    return paths
+
+
+def scan(paths, cache):
+    """Bring the fragment cache up to date.
+
+    :param paths: fragments as returned by fragment_paths()
+    :param cache: previous result, or an empty dictionary
+    :return: (cache, changed) with the new cache, mapping each path to its
+        stat, sha256 and text, and the paths that were added, changed or
+        removed
+    :rtype: tuple
+    """
+    new_cache = {}
+    changed = set(cache) - set(paths)
+    for path in paths:
+        st = os.stat(path)
+        stat = [st.st_mtime_ns, st.st_size]
+        entry = cache.get(path)
+        if entry and entry['stat'] == stat:
+            new_cache[path] = entry
+            continue
+        with open(path, 'rb') as f:
+            raw = f.read()
+        sha = hashlib.sha256(raw).hexdigest()
+        if not entry or entry['sha'] != sha:
+            changed.add(path)
+        new_cache[path] = {'stat': stat, 'sha': sha,
+                           'text': raw.decode('utf-8', 'replace')}
+    return new_cache, sorted(changed)
+
+
+def include_text(paths, cache):
+    '''Join the cached fragments in include order.'''
+    texts = []
+    for path in paths:
+        text = cache[path]['text']
+        texts.append(text if text.endswith('\n') else text + '\n')
+    return ''.join(texts)
+
+
+def parameters(text):
+    """Return the slurm.conf parameters set by include text.
+
+    Parameter names are case insensitive and returned in lower case. A line
+    defining an entity is returned as a whole under its entity parameter
+    and name, e.g. ``partitionname=batch``. Lines that are not parameters
+    (e.g. an Include line) are returned under their first word.
+
+    :return: dictionary of parameter to value
+    :rtype: dict
+    """
+    params = {}
+    for line in text.splitlines():
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        pairs = _PARAMETER.findall(line)
+        if not pairs:
+            params[line.split()[0].lower()] = line
+        elif pairs[0][0].lower() in ENTITY_PARAMETERS:
+            params['{}={}'.format(pairs[0][0].lower(), pairs[0][1])] = line
+        else:
+            for name, value in pairs:
+                params[name.lower()] = value
+    return params
@@ -0,0 +1,101 @@
+"""Health probes of the active controller for automatic failover.
+
+The leader pings slurmctld periodically (from update-status). A failover to
+the backup controller is only done after a configurable number of
+consecutive failed probes of the primary, and only if the backup answers,
+so that a single slow response does not move the cluster.
+
+Run as a script, it exits with 0 only if the local slurmctld is the one in
+control, which gates the state save replication, see replication.py.
+"""
+import re
+import sys
+import socket
+import subprocess
+
+# e.g. "Slurmctld(primary) at ctl0 is UP" or, on older releases,
+# "Slurmctld(primary/backup) at ctl0/ctl1 is UP/DOWN"
+PING_RE = re.compile(r'Slurmctld\((?P<roles>[\w/]+)\) at (?P<hosts>\S+) '
+                     r'is (?P<states>[\w/]+)')
+
+
+def parse_ping(output):
+    """Parse the output of scontrol ping.
+
+    :return: dictionary of role (primary, backup, backup1, ...) to a
+        dictionary with host and up
+    :rtype: dict
+    """
+    result = {}
+    for match in PING_RE.finditer(output):
+        roles = match.group('roles').split('/')
+        hosts = match.group('hosts').split('/')
+        states = match.group('states').split('/')
+        for role, host, state in zip(roles, hosts, states):
+            result[role] = {'host': host, 'up': state.upper() == 'UP'}
+    return result
+
+
+def update_state(state, primary_up, now):
+    """Account one probe of the primary controller.
+
+    :param state: previous state as returned by this function, or None
+    :param primary_up: probe result, None if the probe itself timed out
+    :param now: time of the probe
+    :return: new state with the number of consecutive failures and the
+        time of the first of them
+    :rtype: dict
+    """
+    if primary_up:
+        return {'failures': 0, 'since': None}
+    state = dict(state or {'failures': 0, 'since': None})
+    state['failures'] += 1
+    if state['since'] is None:
+        state['since'] = now
+    return state
+
+
+def should_fail_over(state, threshold, backup_up):
+    """Return True if the backup controller should be promoted.
+
+    :param threshold: consecutive failed probes needed, 0 disables failover
+    :param backup_up: whether the backup controller answered the probe
+    :rtype: bool
+    """
+    return bool(threshold and backup_up and
+                state['failures'] >= threshold)
+
+
+def in_control(result, hostname):
+    """Return True if the slurmctld on hostname is the one in control, i.e.
+    the responding primary or, while the primary is down, the first
+    responding backup.
+
+    :param result: result of parse_ping()
+    :rtype: bool
+    """
+    def same(host):
+        return host.split('.')[0] == hostname.split('.')[0]
+
+    primary = result.get('primary')
+    if primary and primary['up']:
+        return same(primary['host'])
+    for role in sorted(r for r in result if r.startswith('backup')):
+        if result[role]['up']:
+            return same(result[role]['host'])
+    return False
+
+
+def main():
+    try:
+        output = subprocess.run(['scontrol', 'ping'], timeout=30,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT).stdout
+    except (OSError, subprocess.TimeoutExpired):
+        sys.exit(1)
+    result = parse_ping(output.decode('utf-8', 'replace'))
+    sys.exit(0 if in_control(result, socket.gethostname()) else 1)
+
+
+if __name__ == '__main__':
+    main()
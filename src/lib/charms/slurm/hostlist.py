@@ -0,0 +1,190 @@
+"""Slurm hostlist expressions.
+
+Turns lists of hostnames into the compact range syntax understood by Slurm
+(``node[001-512]``) and back, and merges nodes with identical definitions
+into a single ranged NodeName entry.
+"""
+import re
+import itertools
+import collections
+
+_NUMBERED = re.compile(r'^(.*?)(\d+)(\D*)$')
+_BRACKETS = re.compile(r'^([^\[]*)\[([^\]]+)\](.*)$')
+
+
+def _split(hostname):
+    """Split a hostname into prefix, number, suffix and zero-padded width.
+
+    The width is 0 for numbers without leading zeros.
+    """
+    match = _NUMBERED.match(hostname)
+    if not match:
+        return None
+    prefix, digits, suffix = match.groups()
+    width = len(digits) if digits.startswith('0') and len(digits) > 1 else 0
+    return prefix, int(digits), suffix, width, len(digits)
+
+
+def _ranges(numbers, width):
+    """Collapse sorted unique numbers into Slurm range notation."""
+    runs = []
+    for _, run in itertools.groupby(enumerate(numbers),
+                                    lambda pair: pair[1] - pair[0]):
+        run = [n for _, n in run]
+        first = str(run[0]).zfill(width)
+        if len(run) == 1:
+            runs.append(first)
+        else:
+            runs.append('{}-{}'.format(first, str(run[-1]).zfill(width)))
+    return ','.join(runs)
+
+
+def compress(hostnames):
+    """Compress hostnames into a list of Slurm hostlist expressions.
+
+    Hostnames sharing a prefix, a suffix and zero padding are merged into
+    one bracketed range. Names without a number are returned unchanged.
+
+    Example::
+
+        >>> compress(['node001', 'node002', 'node003', 'gpu7', 'login'])
+        ['gpu7', 'login', 'node[001-003]']
+
+    :rtype: list
+    """
+    groups = collections.defaultdict(set)
+    plain = set()
+    parsed = []
+    for name in set(hostnames):
+        parts = _split(name)
+        if parts is None:
+            plain.add(name)
+        else:
+            parsed.append(parts)
+    padded = {(p, s, w) for p, _, s, w, _ in parsed if w}
+    for prefix, number, suffix, width, length in parsed:
+        # an unpadded number as long as a padded group joins that group,
+        # e.g. node100 goes with node[001-099]
+        if not width and (prefix, suffix, length) in padded:
+            width = length
+        groups[(prefix, suffix, width)].add(number)
+
+    result = list(plain)
+    for (prefix, suffix, width), numbers in groups.items():
+        numbers = sorted(numbers)
+        if len(numbers) == 1:
+            result.append('{}{}{}'.format(
+                prefix, str(numbers[0]).zfill(width), suffix))
+        else:
+            result.append('{}[{}]{}'.format(
+                prefix, _ranges(numbers, width), suffix))
+    return sorted(result)
+
+
+def _split_top_level(hostlist):
+    """Split a hostlist on commas that are not inside brackets."""
+    items, depth, start = [], 0, 0
+    for i, char in enumerate(hostlist):
+        if char == '[':
+            depth += 1
+        elif char == ']':
+            depth -= 1
+        elif char == ',' and not depth:
+            items.append(hostlist[start:i])
+            start = i + 1
+    items.append(hostlist[start:])
+    return [item.strip() for item in items if item.strip()]
+
+
+def _expand_item(item):
+    match = _BRACKETS.match(item)
+    if not match:
+        return [item]
+    prefix, ranges, rest = match.groups()
+    names = []
+    for part in ranges.split(','):
+        first, _, last = part.partition('-')
+        width = len(first) if first.startswith('0') else 0
+        for number in range(int(first), int(last or first) + 1):
+            head = '{}{}'.format(prefix, str(number).zfill(width))
+            # the remainder may hold further bracketed ranges
+            names.extend(head + tail for tail in _expand_item(rest))
+    return names
+
+
+def expand(hostlist):
+    """Expand a hostlist expression (or a list of them) into hostnames.
+
+    Example::
+
+        >>> expand('node[001-003],gpu7')
+        ['node001', 'node002', 'node003', 'gpu7']
+
+    :rtype: list
+    """
+    if isinstance(hostlist, str):
+        hostlist = [hostlist]
+    names = []
+    for expression in hostlist:
+        for item in _split_top_level(expression):
+            names.extend(_expand_item(item))
+    return names
+
+
+def _group_key(node):
+    inventory = {k: v for k, v in node['inventory'].items()
+                 if k != 'NodeName'}
+    rest = {k: v for k, v in node.items()
+            if k not in ('hostname', 'inventory')}
+    return repr(sorted(inventory.items())), repr(sorted(rest.items()))
+
+
+def group_nodes(nodes):
+    """Merge nodes with identical definitions into ranged entries.
+
+    Nodes are merged when everything but their names is the same, i.e. the
+    inventory (CPUs, RealMemory, CoresPerSocket, Weight, ...) as well as
+    partition settings. The merged entry keeps the node dictionary layout
+    with 'hostname' and inventory 'NodeName' set to a hostlist expression.
+    Nodes whose NodeName differs from their hostname keep an entry of their
+    own, as the two lists are compressed separately and would no longer
+    pair up.
+
+    :param nodes: node dictionaries as returned by get_node_data()
+    :rtype: list
+    """
+    groups = collections.OrderedDict()
+    for node in nodes:
+        name = node['inventory'].get('NodeName', node['hostname'])
+        if name == node['hostname']:
+            key = _group_key(node)
+        else:
+            key = ('unpaired', name, node['hostname'])
+        groups.setdefault(key, []).append(node)
+
+    grouped = []
+    for members in groups.values():
+        names = ','.join(compress(
+            n['inventory'].get('NodeName', n['hostname']) for n in members))
+        hosts = ','.join(compress(n['hostname'] for n in members))
+        entry = dict(members[0])
+        entry['hostname'] = hosts
+        entry['inventory'] = dict(members[0]['inventory'], NodeName=names)
+        grouped.append(entry)
+    return grouped
+
+
+def expand_nodes(grouped):
+    """Reverse group_nodes(), giving one dictionary per node.
+
+    :rtype: list
+    """
+    nodes = []
+    for entry in grouped:
+        names = expand(entry['inventory'].get('NodeName', entry['hostname']))
+        hosts = expand(entry['hostname'])
+        for name, host in zip(names, hosts):
+            node = dict(entry, hostname=host)
+            node['inventory'] = dict(entry['inventory'], NodeName=name)
+            nodes.append(node)
+    return nodes
@@ -0,0 +1,193 @@
+"""Persistent, incrementally updated index of the slurm-node inventory.
+
+Rebuilding the node list from relation data means a relation-get and a JSON
+parse for every node unit in every hook. The index keeps the parsed node
+data in unit kv storage, keyed by unit, together with a content hash of the
+unit's raw relation data. Only units that joined, changed (the remote unit
+of a slurm-cluster relation hook) or departed are looked at again, and the
+partitions are updated from that diff. A relation hook that does not get
+to update the index (e.g. munge is not configured yet) records its remote
+unit with mark_stale(), so the change is picked up by a later hook.
+"""
+import json
+import bisect
+import hashlib
+
+import charmhelpers.core.hookenv as hookenv
+import charmhelpers.core.unitdata as unitdata
+
+INDEX_KEY = 'slurm-controller.inventory'
+# units whose relation hook ran since the index was last saved
+STALE_KEY = 'slurm-controller.inventory_stale'
+# bump when the stored layout changes to force a rebuild
+INDEX_VERSION = 3
+# relation data published by slurm-node units that makes up a node
+NODE_KEYS = ('hostname', 'partition', 'default', 'timelimit', 'inventory')
+# optional relation data that is not part of the node definition: the
+# location of a node in the network (see topology.py) and its CPU model and
+# flags (see features.py)
+ATTRIBUTE_KEYS = ('switch', 'rack', 'ingress-address', 'cpu_model',
+                  'cpu_flags')
+
+
+def _hash(raw):
+    return hashlib.sha1(json.dumps(raw, sort_keys=True)
+                        .encode('utf-8')).hexdigest()
+
+
+def parse_unit(received):
+    """Build a node dictionary from the data received from a node unit.
+
+    :return: node dictionary or None if the unit did not provide its
+        hostname, partition and inventory yet.
+    """
+    node = {key: received.get(key) for key in NODE_KEYS}
+    if not all(node[key] for key in ('hostname', 'partition', 'inventory')):
+        return None
+    return node
+
+
+def node_attributes(received_raw):
+    """Return the optional ATTRIBUTE_KEYS data a node unit provided.
+
+    Takes the raw relation data as ingress-address is set by Juju and not
+    JSON encoded like the data the node charm publishes.
+    """
+    attributes = {}
+    for key in ATTRIBUTE_KEYS:
+        value = received_raw.get(key)
+        if not value:
+            continue
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+        attributes[key] = str(value)
+    return attributes
+
+
+class InventoryIndex(object):
+    """Node inventory and partitions kept up to date across hooks.
+
+    Example::
+
+        index = InventoryIndex()
+        index.update(cluster_endpoint)
+        nodes, partitions = index.nodes, index.partitions
+        index.save()
+
+    """
+
+    def __init__(self):
+        self._kv = unitdata.kv()
+        data = self._kv.get(INDEX_KEY) or {}
+        if data.get('version') != INDEX_VERSION:
+            data = {}
+        # unit name -> {'hash': ..., 'node': {...}, 'attributes': {...}}
+        self.units = data.get('units', {})
+        # partition name -> {'hosts': [...], 'default': ..., 'timelimit': ...}
+        self.partitions = data.get('partitions', {})
+        self.stale = set(self._kv.get(STALE_KEY) or [])
+        self.changed = set()
+        self.departed = set()
+        # units whose relation data was read by the last update
+        self.read = 0
+
+    @property
+    def nodes(self):
+        '''Nodes of all units that provided their data, by hostname.'''
+        nodes = [entry['node'] for entry in self.units.values()
+                 if entry['node']]
+        return sorted(nodes, key=lambda node: node['hostname'])
+
+    @property
+    def attributes(self):
+        '''Optional attributes of all nodes, by node name.'''
+        return {entry['node']['inventory'].get('NodeName',
+                                               entry['node']['hostname']):
+                entry['attributes']
+                for entry in self.units.values() if entry['node']}
+
+    def _stale_units(self, endpoint, joined):
+        stale = (set(joined) - set(self.units)) | (self.stale & set(joined))
+        if (hookenv.relation_type() == endpoint.endpoint_name and
+                hookenv.remote_unit() in joined):
+            stale.add(hookenv.remote_unit())
+        return stale
+
+    def update(self, endpoint, full=False):
+        """Refresh the index from the slurm-cluster endpoint.
+
+        :param endpoint: slurm-cluster endpoint
+        :param full: re-check every unit, not only the ones that changed
+        :return: True if any node was added, changed or removed
+        :rtype: bool
+        """
+        joined = {unit.unit_name: unit for unit in endpoint.all_joined_units}
+        stale = set(joined) if full else self._stale_units(endpoint, joined)
+        self.changed, self.departed = set(), set(self.units) - set(joined)
+        self.read = len(stale)
+
+        for name in self.departed:
+            self._remove(self.units.pop(name)['node'])
+        for name in stale:
+            unit = joined[name]
+            raw = unit.received_raw
+            digest = _hash(raw)
+            entry = self.units.get(name)
+            if entry and entry['hash'] == digest:
+                continue
+            node = parse_unit(unit.received)
+            if entry:
+                self._remove(entry['node'])
+            self._add(node)
+            self.units[name] = {'hash': digest, 'node': node,
+                                'attributes': node_attributes(raw)}
+            self.changed.add(name)
+
+        if self.changed or self.departed:
+            hookenv.log('Inventory index: {} changed, {} departed, {} '
+                        'units'.format(len(self.changed), len(self.departed),
+                                       len(self.units)))
+        return bool(self.changed or self.departed)
+
+    def _add(self, node):
+        if not node:
+            return
+        partition = self.partitions.setdefault(node['partition'],
+                                               {'hosts': []})
+        bisect.insort(partition['hosts'], node['hostname'])
+        partition['default'] = node['default']
+        partition['timelimit'] = node['timelimit']
+
+    def _remove(self, node):
+        if not node:
+            return
+        partition = self.partitions.get(node['partition'])
+        if not partition:
+            return
+        hosts = partition['hosts']
+        i = bisect.bisect_left(hosts, node['hostname'])
+        if i < len(hosts) and hosts[i] == node['hostname']:
+            del hosts[i]
+        if not hosts:
+            del self.partitions[node['partition']]
+
+    def save(self):
+        self._kv.set(INDEX_KEY, {
+            'version': INDEX_VERSION,
+            'units': self.units,
+            'partitions': self.partitions,
+        })
+        self._kv.unset(STALE_KEY)
+
+
+def mark_stale(unit_name):
+    '''Have the next update read unit_name again.'''
+    kv = unitdata.kv()
+    kv.set(STALE_KEY, sorted(set(kv.get(STALE_KEY) or []) | {unit_name}))
+
+
+def forget():
+    '''Drop the index so that the next update rebuilds it.'''
+    unitdata.kv().unset(INDEX_KEY)
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""Batched export of job completion records to Elasticsearch.
+
+slurmctld writes one line per finished job with jobcomp/filetxt. The
+shipper follows that file and sends the records with the Elasticsearch bulk
+API, at most batch_size records per request and at least every
+flush_interval seconds while records are pending, so that a burst of
+finished jobs becomes a few bulk requests instead of one request per job.
+The file offset of the last shipped record is saved after every successful
+request; records are sent again after a failure rather than lost. Each
+record is indexed under its JobId and StartTime, so records sent again
+overwrite their earlier copy instead of being duplicated. Records that
+Elasticsearch rejects as invalid (4xx) are logged and dropped, only those
+refused for load (429) or by a server error (5xx) are retried.
+
+Runs as a service installed by the charm::
+
+    jobcomp.py --url http://es:9200 --file /var/log/slurm/jobcomp.log
+
+Only the standard library is used so that it runs outside of the charm.
+"""
+import os
+import re
+import json
+import time
+import argparse
+import urllib.request
+
+DEFAULT_INDEX = 'slurm-jobs'
+# a record is a line of space separated Key=Value pairs, values may
+# contain spaces (e.g. WorkDir)
+FIELD_RE = re.compile(r'(?:^| )(\w+)=')
+# fields that hold numbers in the jobcomp records
+INT_FIELDS = ('JobId', 'NodeCnt', 'ProcCnt')
+# item status of a record refused for load, retried like server errors
+RETRY_STATUS = 429
+
+
+def parse_record(line):
+    """Parse a jobcomp/filetxt line.
+
+    :return: dictionary of the record fields, empty for a blank line
+    :rtype: dict
+    """
+    line = line.strip()
+    matches = list(FIELD_RE.finditer(line))
+    record = {}
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(line)
+        record[match.group(1)] = line[match.end():end]
+    for key in INT_FIELDS:
+        if record.get(key, '').isdigit():
+            record[key] = int(record[key])
+    return record
+
+
+def document_id(record):
+    '''Return the stable document id of a record, None without JobId.'''
+    if 'JobId' not in record:
+        return None
+    return '{}-{}'.format(record['JobId'], record.get('StartTime', ''))
+
+
+def retryable(status):
+    '''Return True if a record failed with an item status worth retrying.'''
+    return status == RETRY_STATUS or status >= 500
+
+
+def bulk_body(records, index):
+    '''Return the bulk API request body indexing records into index.'''
+    lines = []
+    for record in records:
+        action = {'_index': index}
+        doc_id = document_id(record)
+        if doc_id is not None:
+            action['_id'] = doc_id
+        lines.append(json.dumps({'index': action}, sort_keys=True))
+        lines.append(json.dumps(record, sort_keys=True))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+class BulkShipper(object):
+    """Buffer records and send them with the bulk API.
+
+    :param url: Elasticsearch base URL
+    :param index: index the records are written to
+    :param batch_size: maximum number of records per bulk request
+    :param flush_interval: seconds a record may wait for a full batch
+    :param retries: bulk requests sent again for records failing with 429
+        or 5xx before giving up
+    :param retry_delay: seconds before the first retry, doubled each time
+    """
+
+    def __init__(self, url, index=DEFAULT_INDEX, batch_size=500,
+                 flush_interval=10, timeout=30, retries=3, retry_delay=1):
+        self.url = url.rstrip('/') + '/_bulk'
+        self.index = index
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.pending = []
+        self.first_pending = None
+        self.requests = 0
+        self.rejected = 0
+
+    def add(self, record):
+        '''Buffer a record, return True if the batch is full.'''
+        if not self.pending:
+            self.first_pending = time.time()
+        self.pending.append(record)
+        return len(self.pending) >= self.batch_size
+
+    def due(self, now=None):
+        '''Return True if pending records waited for flush_interval.'''
+        if not self.pending:
+            return False
+        now = time.time() if now is None else now
+        return now - self.first_pending >= self.flush_interval
+
+    def _send(self, records):
+        '''Send records in one bulk request, return the result.'''
+        request = urllib.request.Request(
+            self.url, data=bulk_body(records, self.index),
+            headers={'Content-Type': 'application/x-ndjson'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as resp:
+            result = json.loads(resp.read().decode('utf-8') or '{}')
+        self.requests += 1
+        return result
+
+    def _failed(self, records, result):
+        '''Drop the records rejected with a 4xx, return those to retry.'''
+        if not result.get('errors'):
+            return []
+        items = result.get('items')
+        if not items or len(items) != len(records):
+            # without a result per record, send them all again
+            return list(records)
+        retry = []
+        for record, item in zip(records, items):
+            item = item.get('index', {})
+            status = item.get('status', 200)
+            if status < 300:
+                continue
+            if retryable(status):
+                retry.append(record)
+                continue
+            self.rejected += 1
+            print('jobcomp record {} rejected ({}): {}'.format(
+                document_id(record), status, item.get('error')), flush=True)
+        return retry
+
+    def flush(self):
+        """Send the pending records in one bulk request.
+
+        Records rejected as invalid are dropped, records failing with 429
+        or 5xx are sent again up to retries times.
+
+        :raises IOError: if the request fails or records still fail with
+            429 or 5xx, those records then stay pending
+        """
+        if not self.pending:
+            return
+        records = self.pending
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            records = self._failed(records, self._send(records))
+            self.pending = records
+            if not records:
+                break
+        else:
+            raise IOError('bulk request to {} failed for {} records'.format(
+                self.url, len(records)))
+        self.first_pending = None
+
+
+class JobcompFile(object):
+    """Read complete records appended to a jobcomp file since the saved
+    offset. Starts over if the file was rotated or truncated."""
+
+    def __init__(self, path, state_file):
+        self.path = path
+        self.state_file = state_file
+        self.offset = 0
+        self.inode = None
+        if os.path.exists(state_file):
+            with open(state_file) as f:
+                state = json.load(f)
+            self.offset, self.inode = state['offset'], state['inode']
+
+    def read(self):
+        """Return a list of (end offset, record) for the new lines.
+
+        :rtype: list
+        """
+        if not os.path.exists(self.path):
+            return []
+        stat = os.stat(self.path)
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            self.offset, self.inode = 0, stat.st_ino
+        records = []
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            offset = self.offset
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # slurmctld is still writing this one
+                    break
+                offset += len(line)
+                record = parse_record(line.decode('utf-8', 'replace'))
+                if record:
+                    records.append((offset, record))
+        return records
+
+    def commit(self, offset):
+        '''Save offset as shipped.'''
+        self.offset = offset
+        tmp = self.state_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'offset': offset, 'inode': self.inode}, f)
+        os.rename(tmp, self.state_file)
+
+
+def ship(source, shipper, final=False):
+    """Ship the records added to source since the last call.
+
+    Full batches are sent right away, a partial batch only once it is due
+    or if final is set. The offset is committed after every request.
+
+    :return: number of records shipped
+    :rtype: int
+    """
+    shipped = 0
+    offset = None
+    for offset_end, record in source.read():
+        if shipper.add(record):
+            count = len(shipper.pending)
+            shipper.flush()
+            source.commit(offset_end)
+            shipped += count
+            offset = None
+        else:
+            offset = offset_end
+    if offset is not None:
+        source.offset = offset
+    if shipper.pending and (final or shipper.due()):
+        count = len(shipper.pending)
+        shipper.flush()
+        source.commit(source.offset)
+        shipped += count
+    return shipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', required=True)
+    parser.add_argument('--file', required=True)
+    parser.add_argument('--state-file', required=True)
+    parser.add_argument('--index', default=DEFAULT_INDEX)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--flush-interval', type=float, default=10)
+    parser.add_argument('--poll-interval', type=float, default=1)
+    args = parser.parse_args()
+
+    shipper = BulkShipper(args.url, args.index, args.batch_size,
+                          args.flush_interval)
+    while True:
+        source = JobcompFile(args.file, args.state_file)
+        try:
+            while True:
+                ship(source, shipper)
+                time.sleep(args.poll_interval)
+        except (IOError, OSError, ValueError) as e:
+            # start over from the last committed offset
+            print('jobcomp export failed: {}'.format(e), flush=True)
+            shipper.pending, shipper.first_pending = [], None
+            time.sleep(max(args.flush_interval, args.poll_interval))
+
+
+if __name__ == '__main__':
+    main()
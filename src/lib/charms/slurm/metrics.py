@@ -0,0 +1,298 @@
+"""slurmctld load metrics from sdiag.
+
+collect() runs ``sdiag`` and ``scontrol show config``, writes the results as
+a Prometheus textfile (e.g. for the node exporter textfile collector) and
+appends them to a small ring buffer of snapshots. summarize() turns that
+history into the trends shown by the controller-metrics action.
+"""
+import os
+import re
+import json
+import time
+import subprocess
+import collections
+
+METRICS_DIR = '/var/lib/slurm-controller/metrics'
+HISTORY_FILE = os.path.join(METRICS_DIR, 'history.json')
+
+# sdiag "Name: value" lines outside of the cycle sections
+_GAUGES = collections.OrderedDict([
+    ('Server thread count', 'server_threads'),
+    ('Agent queue size', 'agent_queue_size'),
+    ('Agent count', 'agent_count'),
+    ('Agent thread count', 'agent_threads'),
+    ('DBD Agent queue size', 'dbd_agent_queue_size'),
+    ('Jobs submitted', 'jobs_submitted_total'),
+    ('Jobs started', 'jobs_started_total'),
+    ('Jobs completed', 'jobs_completed_total'),
+    ('Jobs canceled', 'jobs_canceled_total'),
+    ('Jobs failed', 'jobs_failed_total'),
+    ('Jobs pending', 'jobs_pending'),
+    ('Jobs running', 'jobs_running'),
+])
+# lines of the main schedule and backfill sections with their divisor,
+# times are in microseconds
+_CYCLES = collections.OrderedDict([
+    ('Last cycle', ('cycle_last_seconds', 1e6)),
+    ('Max cycle', ('cycle_max_seconds', 1e6)),
+    ('Mean cycle', ('cycle_mean_seconds', 1e6)),
+    ('Total cycles', ('cycles_total', 1)),
+    ('Last queue length', ('queue_length', 1)),
+    ('Total backfilled jobs (since last slurm start)', ('jobs_total', 1)),
+])
+_LINE = re.compile(r'^\s*([^:]+?):\s+(\d+)\s*$')
+_RPC = re.compile(r'^\s*(\S+)\s+\(\s*\d+\)\s+count:(\d+)\s+ave_time:(\d+)\s+'
+                  r'total_time:(\d+)')
+_CONFIG = re.compile(r'^(\w+)\s+=\s+(\d+)(?:\s+sec)?$')
+
+# metric name -> (type, help), counters end in _total as Prometheus expects
+METRICS = {
+    'slurmctld_server_threads': ('gauge', 'slurmctld server threads'),
+    'slurmctld_agent_queue_size': ('gauge', 'Outgoing RPCs queued'),
+    'slurmctld_agent_count': ('gauge', 'Agents sending RPCs'),
+    'slurmctld_agent_threads': ('gauge', 'Threads used by agents'),
+    'slurmctld_dbd_agent_queue_size': ('gauge', 'Messages queued for '
+                                                'slurmdbd'),
+    'slurmctld_jobs_submitted_total': (
+        'counter', 'Jobs submitted since the stats reset'),
+    'slurmctld_jobs_started_total': (
+        'counter', 'Jobs started since the stats reset'),
+    'slurmctld_jobs_completed_total': (
+        'counter', 'Jobs completed since the stats reset'),
+    'slurmctld_jobs_canceled_total': (
+        'counter', 'Jobs canceled since the stats reset'),
+    'slurmctld_jobs_failed_total': (
+        'counter', 'Jobs failed since the stats reset'),
+    'slurmctld_jobs_pending': ('gauge', 'Pending jobs'),
+    'slurmctld_jobs_running': ('gauge', 'Running jobs'),
+    'slurmctld_schedule_cycle_last_seconds': ('gauge', 'Last main '
+                                                       'scheduling cycle'),
+    'slurmctld_schedule_cycle_max_seconds': ('gauge', 'Longest main '
+                                                      'scheduling cycle'),
+    'slurmctld_schedule_cycle_mean_seconds': ('gauge', 'Mean main '
+                                                       'scheduling cycle'),
+    'slurmctld_schedule_cycles_total': ('counter', 'Main scheduling cycles'),
+    'slurmctld_schedule_queue_length': ('gauge', 'Queue length of the last '
+                                                 'main scheduling cycle'),
+    'slurmctld_backfill_cycle_last_seconds': ('gauge', 'Last backfill '
+                                                       'cycle'),
+    'slurmctld_backfill_cycle_max_seconds': ('gauge', 'Longest backfill '
+                                                      'cycle'),
+    'slurmctld_backfill_cycle_mean_seconds': ('gauge', 'Mean backfill '
+                                                       'cycle'),
+    'slurmctld_backfill_cycles_total': ('counter', 'Backfill cycles'),
+    'slurmctld_backfill_queue_length': ('gauge', 'Queue length of the last '
+                                                 'backfill cycle'),
+    'slurmctld_backfill_jobs_total': (
+        'counter', 'Jobs started by backfill since slurmctld started'),
+    'slurmctld_rpc_total': ('counter', 'RPCs by message type'),
+    'slurmctld_rpc_seconds_total': (
+        'counter', 'Time spent in RPCs by message type'),
+    'slurmctld_rpc_user_total': ('counter', 'RPCs by user'),
+    'slurmctld_rpc_user_seconds_total': ('counter', 'Time spent in RPCs by '
+                                                    'user'),
+    'slurmctld_config': ('gauge', 'Numeric slurmctld configuration values'),
+    'slurmctld_collect_timestamp_seconds': ('gauge', 'Time of the last '
+                                                     'collection'),
+}
+
+
+def _key(metric, **labels):
+    '''Sample key, e.g. slurmctld_rpc_total{type="REQUEST_PING"}.'''
+    if not labels:
+        return metric
+    return '{}{{{}}}'.format(metric, ','.join(
+        '{}="{}"'.format(k, labels[k]) for k in sorted(labels)))
+
+
+def metric_name(key):
+    return key.split('{', 1)[0]
+
+
+def parse_sdiag(output):
+    """Parse sdiag output.
+
+    :return: dictionary of sample key to value
+    :rtype: dict
+    """
+    samples = {}
+    section = None
+    for line in output.splitlines():
+        stripped = line.strip()
+        if stripped.startswith('Main schedule statistics'):
+            section = 'schedule'
+            continue
+        if stripped.startswith('Backfilling stats'):
+            section = 'backfill'
+            continue
+        if stripped.startswith('Remote Procedure Call statistics by '
+                               'message type'):
+            section = 'rpc_type'
+            continue
+        if stripped.startswith('Remote Procedure Call statistics by user'):
+            section = 'rpc_user'
+            continue
+        if stripped.startswith('Pending RPC statistics'):
+            section = None
+            continue
+
+        if section in ('rpc_type', 'rpc_user'):
+            match = _RPC.match(line)
+            if not match:
+                continue
+            name, count, _, total = match.groups()
+            if section == 'rpc_type':
+                labels, prefix = {'type': name}, 'slurmctld_rpc'
+            else:
+                labels, prefix = {'user': name}, 'slurmctld_rpc_user'
+            samples[_key(prefix + '_total', **labels)] = int(count)
+            samples[_key(prefix + '_seconds_total', **labels)] = (
+                int(total) / 1e6)
+            continue
+
+        match = _LINE.match(line)
+        if not match:
+            continue
+        label, value = match.group(1), int(match.group(2))
+        if section in ('schedule', 'backfill') and label in _CYCLES:
+            suffix, divisor = _CYCLES[label]
+            samples['slurmctld_{}_{}'.format(section, suffix)] = (
+                value / divisor if divisor != 1 else value)
+        elif section is None and label in _GAUGES:
+            samples['slurmctld_' + _GAUGES[label]] = value
+    return samples
+
+
+def parse_show_config(output):
+    '''Numeric settings of scontrol show config as slurmctld_config samples.'''
+    samples = {}
+    for line in output.splitlines():
+        match = _CONFIG.match(line.strip())
+        if match:
+            samples[_key('slurmctld_config', name=match.group(1))] = int(
+                match.group(2))
+    return samples
+
+
+def textfile(samples):
+    '''Format samples in the Prometheus text exposition format.'''
+    lines = []
+    seen = set()
+    for key in sorted(samples, key=lambda k: (metric_name(k), k)):
+        name = metric_name(key)
+        if name not in seen:
+            seen.add(name)
+            kind, description = METRICS.get(name, ('untyped', name))
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+        lines.append('{} {}'.format(key, repr(float(samples[key]))
+                                    if isinstance(samples[key], float)
+                                    else samples[key]))
+    return '\n'.join(lines) + '\n'
+
+
+def _write_atomic(path, content):
+    # the textfile collector must never see a partially written file
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(content)
+    os.rename(tmp, path)
+
+
+def load_history(path=HISTORY_FILE):
+    '''Return the snapshots of the ring buffer, oldest first.'''
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def append_history(samples, size, now=None, path=HISTORY_FILE):
+    '''Add a snapshot to the ring buffer, keeping the last size ones.'''
+    history = collections.deque(load_history(path), maxlen=max(1, size))
+    history.append({'time': time.time() if now is None else now,
+                    'samples': samples})
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _write_atomic(path, json.dumps(list(history)))
+
+
+def collect(textfile_path, history_size, timeout=30):
+    """Run sdiag and scontrol show config, write the textfile and add a
+    snapshot to the history.
+
+    :return: the collected samples
+    :raises subprocess.CalledProcessError: if sdiag fails
+    :rtype: dict
+    """
+    samples = parse_sdiag(subprocess.check_output(
+        ['sdiag'], timeout=timeout).decode('utf-8', 'replace'))
+    samples.update(parse_show_config(subprocess.check_output(
+        ['scontrol', 'show', 'config'],
+        timeout=timeout).decode('utf-8', 'replace')))
+    now = time.time()
+    samples['slurmctld_collect_timestamp_seconds'] = int(now)
+    if textfile_path:
+        os.makedirs(os.path.dirname(textfile_path), exist_ok=True)
+        _write_atomic(textfile_path, textfile(samples))
+    append_history(samples, history_size, now)
+    return samples
+
+
+def summarize(history, top=5):
+    """Summarize the trends in the history.
+
+    Gauges are reported with their last, minimum and maximum value and
+    counters with their rate per minute over the window. Counters restart
+    with slurmctld and at the daily sdiag reset, such drops are skipped.
+    The RPC types with the most calls in the window come with their mean
+    latency.
+
+    :param history: snapshots as returned by load_history()
+    :param top: number of RPC types to list
+    :rtype: dict
+    """
+    if not history:
+        return {'snapshots': 0}
+    first, last = history[0], history[-1]
+    minutes = max((last['time'] - first['time']) / 60.0, 1e-9)
+
+    def increase(key):
+        total, previous = 0, None
+        for snapshot in history:
+            value = snapshot['samples'].get(key)
+            if value is None:
+                continue
+            if previous is not None and value >= previous:
+                total += value - previous
+            previous = value
+        return total
+
+    summary = {'snapshots': len(history),
+               'minutes': round((last['time'] - first['time']) / 60.0, 1),
+               'gauges': {}, 'rates_per_minute': {}, 'top_rpcs': []}
+    for key, value in sorted(last['samples'].items()):
+        name = metric_name(key)
+        kind = METRICS.get(name, ('untyped',))[0]
+        if '{' in key or name == 'slurmctld_collect_timestamp_seconds':
+            continue
+        if kind == 'counter':
+            summary['rates_per_minute'][name] = round(
+                increase(key) / minutes, 3)
+        else:
+            values = [s['samples'][key] for s in history
+                      if key in s['samples']]
+            summary['gauges'][name] = {'last': value, 'min': min(values),
+                                       'max': max(values)}
+    rpcs = []
+    for key in last['samples']:
+        if metric_name(key) != 'slurmctld_rpc_total':
+            continue
+        count = increase(key)
+        seconds = increase(key.replace('slurmctld_rpc_total',
+                                       'slurmctld_rpc_seconds_total', 1))
+        rpcs.append({'type': key.split('"')[1], 'count': count,
+                     'mean_ms': round(1000.0 * seconds / count, 3)
+                     if count else 0.0})
+    rpcs.sort(key=lambda rpc: rpc['count'], reverse=True)
+    summary['top_rpcs'] = rpcs[:top]
+    return summary
@@ -0,0 +1,191 @@
+"""Per-handler timing of reactive dispatch.
+
+With the profile_handlers option set, install() hooks into the
+charms.reactive dispatcher so that every handler invocation is recorded
+with its wall time and the number of agent calls it made, i.e. the calls
+made through charms.slurm.controller plus the juju-log, status-set and
+relation-set calls made through hookenv. The time spent testing handler
+predicates (e.g. the file hashing of when_file_changed) is summed per
+handler and recorded once per hook. Records are appended as JSON lines to a
+rotating file in PROFILE_DIR and a cProfile dump is written for every
+invocation. slowest() summarizes them for the hook-profile action. Without
+the option nothing is instrumented or written.
+"""
+import os
+import glob
+import json
+import time
+import cProfile
+import collections
+import logging
+import logging.handlers
+
+import charmhelpers.core.hookenv as hookenv
+import charms.slurm.controller as controller
+
+PROFILE_DIR = '/var/lib/slurm-controller/profile'
+PROFILE_LOG = os.path.join(PROFILE_DIR, 'handlers.jsonl')
+PROFILE_LOG_BYTES = 1024 * 1024
+PROFILE_LOG_BACKUPS = 3
+# number of cProfile dumps kept in PROFILE_DIR
+PROFILE_DUMPS = 50
+# predicate test times below this many seconds per hook are not recorded
+MIN_TEST_SECONDS = 0.001
+# hookenv functions counted as agent calls, next to the ones counted by
+# charms.slurm.controller
+HOOKENV_TOOLS = {'log': 'juju-log', 'status_set': 'status-set',
+                 'relation_set': 'relation-set'}
+
+_logger = None
+_test_seconds = collections.Counter()
+_hookenv_calls = collections.Counter()
+
+
+def _log():
+    global _logger
+    if _logger is None:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        _logger = logging.getLogger('slurm-controller.profile')
+        _logger.propagate = False
+        _logger.setLevel(logging.INFO)
+        handler = logging.handlers.RotatingFileHandler(
+            PROFILE_LOG, maxBytes=PROFILE_LOG_BYTES,
+            backupCount=PROFILE_LOG_BACKUPS)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        _logger.addHandler(handler)
+    return _logger
+
+
+def record(handler, seconds, agent_calls=None, kind='invoke'):
+    _log().info(json.dumps({
+        'time': time.time(),
+        'hook': hookenv.hook_name(),
+        'handler': handler,
+        'kind': kind,
+        'seconds': round(seconds, 6),
+        'agent_calls': agent_calls,
+    }))
+
+
+def _dump_profile(profiler, handler):
+    name = '{}-{}-{}.prof'.format(int(time.time() * 1000),
+                                  hookenv.hook_name(),
+                                  handler.split(':')[-1])
+    profiler.dump_stats(os.path.join(PROFILE_DIR, name))
+    dumps = sorted(glob.glob(os.path.join(PROFILE_DIR, '*.prof')))
+    for old in dumps[:-PROFILE_DUMPS]:
+        os.remove(old)
+
+
+def _handler_name(handler):
+    action = getattr(handler, '_action', None)
+    if action is None:
+        return handler.id()
+    return '{}:{}'.format(action.__module__, action.__name__)
+
+
+def _count_hookenv_calls():
+    for attr, tool in HOOKENV_TOOLS.items():
+        def counted(*args, _func=getattr(hookenv, attr), _tool=tool,
+                    **kwargs):
+            _hookenv_calls[_tool] += 1
+            return _func(*args, **kwargs)
+        setattr(hookenv, attr, counted)
+
+
+def agent_calls():
+    '''Agent round-trips counted so far in this hook.'''
+    return (sum(controller.agent_calls().values()) +
+            sum(_hookenv_calls.values()))
+
+
+def _flush_test_times():
+    for handler, seconds in _test_seconds.items():
+        if seconds >= MIN_TEST_SECONDS:
+            record(handler, seconds, kind='test')
+    _test_seconds.clear()
+
+
+def install():
+    """Instrument charms.reactive handler tests and invocations if the
+    profile_handlers option is set.
+
+    Safe to call more than once.
+    """
+    from charms.reactive.bus import Handler
+    if (getattr(Handler, '_slurm_profiling', False) or
+            not controller.config().get('profile_handlers')):
+        return
+    invoke, test = Handler.invoke, Handler.test
+    _count_hookenv_calls()
+
+    def timed_invoke(self, *args, **kwargs):
+        name = _handler_name(self)
+        calls = agent_calls()
+        profiler = cProfile.Profile()
+        start = time.time()
+        try:
+            return profiler.runcall(invoke, self, *args, **kwargs)
+        finally:
+            record(name, time.time() - start, agent_calls() - calls)
+            _dump_profile(profiler, name)
+
+    def timed_test(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return test(self, *args, **kwargs)
+        finally:
+            _test_seconds[_handler_name(self)] += time.time() - start
+
+    Handler.invoke = timed_invoke
+    Handler.test = timed_test
+    Handler._slurm_profiling = True
+    hookenv.atexit(_flush_test_times)
+
+
+def load_records():
+    '''Return all recorded entries, oldest first.'''
+    paths = ['{}.{}'.format(PROFILE_LOG, i)
+             for i in range(PROFILE_LOG_BACKUPS, 0, -1)] + [PROFILE_LOG]
+    records = []
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+def slowest(count=10, handler=None):
+    """Summarize the recorded handlers, slowest first.
+
+    :param count: number of handlers to return
+    :param handler: only consider handlers containing this string
+    :return: list of dictionaries with handler, kind, calls, max, mean and
+        total seconds, mean agent calls and the hook of the slowest run
+    :rtype: list
+    """
+    stats = {}
+    for entry in load_records():
+        if handler and handler not in entry['handler']:
+            continue
+        key = (entry['handler'], entry['kind'])
+        stat = stats.setdefault(key, {
+            'handler': entry['handler'], 'kind': entry['kind'], 'calls': 0,
+            'total': 0.0, 'max': 0.0, 'agent_calls': 0, 'slowest_hook': None,
+        })
+        stat['calls'] += 1
+        stat['total'] += entry['seconds']
+        stat['agent_calls'] += entry.get('agent_calls') or 0
+        if entry['seconds'] >= stat['max']:
+            stat['max'] = entry['seconds']
+            stat['slowest_hook'] = entry['hook']
+    summary = []
+    for stat in stats.values():
+        stat['mean'] = round(stat['total'] / stat['calls'], 6)
+        stat['mean_agent_calls'] = round(
+            stat.pop('agent_calls') / stat['calls'], 1)
+        stat['total'] = round(stat['total'], 6)
+        summary.append(stat)
+    summary.sort(key=lambda stat: stat['max'], reverse=True)
+    return summary[:count]
@@ -0,0 +1,220 @@
+"""Replication of the slurmctld StateSaveLocation to the HA peer.
+
+Instead of a shared file system, the state directory stays on local disk
+and is pushed to the peer controller with rsync over ssh from a systemd
+timer. rsync compares file checksums, so job state files that did not
+change are skipped, and only the changed blocks of the others are sent.
+Each controller publishes the public key it pushes with and its ssh host
+key in its slurm-controller-ha peer data, authorizes the key of its peer
+and trusts the host key of its peer, so that no host key is accepted
+blindly. The peer key is restricted to rrsync writing into the
+StateSaveLocation, so it does not give the peer a shell.
+
+Both controllers run the timer, and each push first checks with scontrol
+ping that the local slurmctld is the one in control. The direction thus
+follows Slurm rather than the charm: a backup slurmctld that took over
+after SlurmctldTimeout is not overwritten, and its state is pushed back to
+the primary even without a failover of the charm.
+"""
+import os
+import gzip
+import subprocess
+
+import charmhelpers.core.hookenv as hookenv
+import charmhelpers.core.host as host
+
+SSH_DIR = '/root/.ssh'
+KEY_FILE = os.path.join(SSH_DIR, 'slurm_state_sync')
+KNOWN_HOSTS = os.path.join(SSH_DIR, 'slurm_state_sync_known_hosts')
+AUTHORIZED_KEYS = os.path.join(SSH_DIR, 'authorized_keys')
+# host keys of this unit in order of preference
+HOST_KEYS = ('/etc/ssh/ssh_host_ed25519_key.pub',
+             '/etc/ssh/ssh_host_rsa_key.pub')
+# marks the authorized_keys entry managed here
+KEY_COMMENT = 'slurm-controller-state-sync'
+# restricted rsync the peer key is forced to run, older rsync packages
+# only ship it as an example script
+RRSYNC = '/usr/bin/rrsync'
+RRSYNC_EXAMPLE = '/usr/share/doc/rsync/scripts/rrsync.gz'
+LOCAL_RRSYNC = '/usr/local/sbin/rrsync'
+
+SCRIPT = '/usr/local/sbin/slurm-state-sync'
+UNIT = 'slurm-state-sync'
+UNIT_DIR = '/etc/systemd/system'
+
+SCRIPT_TEMPLATE = """#!/bin/sh
+# Managed by the slurm-controller charm, changes will be overwritten.
+# Push the slurmctld state to the peer controller, skipping unchanged
+# files by checksum. Only the controller whose slurmctld is in control
+# pushes.
+/usr/bin/python3 {health} || exit 0
+exec rsync --archive --checksum --delete --delay-updates \\
+    --rsh 'ssh -i {key} -o BatchMode=yes -o ConnectTimeout=10 \\
+-o StrictHostKeyChecking=yes -o UserKnownHostsFile={known_hosts}' \\
+    {state_dir}/ root@{peer}:./
+"""
+SERVICE_TEMPLATE = """# Managed by the slurm-controller charm
+[Unit]
+Description=Push slurmctld state to the peer controller
+After=network-online.target
+
+[Service]
+Type=oneshot
+Nice=10
+IOSchedulingClass=idle
+ExecStart={script}
+"""
+TIMER_TEMPLATE = """# Managed by the slurm-controller charm
+[Unit]
+Description=Periodic slurmctld state push to the peer controller
+
+[Timer]
+OnActiveSec={interval}
+OnUnitInactiveSec={interval}
+AccuracySec=1
+
+[Install]
+WantedBy=timers.target
+"""
+
+
+def _read(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read()
+
+
+def _write_if_changed(path, content, perms=0o644):
+    '''Write content to path unless it is already there, return True if
+    the file was written.'''
+    if _read(path) == content:
+        return False
+    host.write_file(path, content.encode('utf-8'), perms=perms)
+    return True
+
+
+def public_key():
+    """Return the public key this unit pushes with, creating the key pair
+    on first use.
+
+    :rtype: str
+    """
+    if not os.path.exists(KEY_FILE):
+        host.mkdir(SSH_DIR, perms=0o700)
+        subprocess.check_call(['ssh-keygen', '-q', '-t', 'ed25519', '-N', '',
+                               '-C', KEY_COMMENT, '-f', KEY_FILE])
+    return _read(KEY_FILE + '.pub').strip()
+
+
+def host_key():
+    """Return the ssh host key of this unit as "<type> <key>".
+
+    :return: the key, None if the unit has no host key
+    :rtype: str
+    """
+    for path in HOST_KEYS:
+        key = _read(path)
+        if key:
+            return ' '.join(key.split()[:2])
+    return None
+
+
+def trust_peer(address, key):
+    '''Make the pushes to address only accept the host key of the peer.'''
+    host.mkdir(SSH_DIR, perms=0o700)
+    _write_if_changed(KNOWN_HOSTS, '{} {}\n'.format(
+        address, ' '.join(key.split()[:2])), perms=0o600)
+
+
+def rrsync():
+    """Return the path of rrsync, installing the example script shipped
+    with older rsync packages if needed.
+
+    :return: the path, None if rrsync is not available, e.g. on images
+        without /usr/share/doc
+    :rtype: str
+    """
+    if os.path.exists(RRSYNC):
+        return RRSYNC
+    if not os.path.exists(LOCAL_RRSYNC) and os.path.exists(RRSYNC_EXAMPLE):
+        with gzip.open(RRSYNC_EXAMPLE) as f:
+            host.write_file(LOCAL_RRSYNC, f.read(), perms=0o755)
+    return LOCAL_RRSYNC if os.path.exists(LOCAL_RRSYNC) else None
+
+
+def authorize_peer(key, state_dir, address=None):
+    """Allow the peer controller to push its state to this unit.
+
+    Replaces a previously authorized peer key. The key may only be used
+    from the peer address, without a tty or forwarding, and only runs
+    rrsync restricted to writing into state_dir.
+
+    :param key: public key from the peer data
+    :param state_dir: StateSaveLocation
+    :param address: peer address for the from= restriction
+    :raises OSError: if rrsync is not available, the peer key is then not
+        authorized
+    """
+    command = rrsync()
+    if not command:
+        raise OSError('rrsync not found in {} or {}'.format(
+            RRSYNC, RRSYNC_EXAMPLE))
+    options = 'restrict'
+    if address:
+        options += ',from="{}"'.format(address)
+    options += ',command="{} -wo {}"'.format(command, state_dir.rstrip('/'))
+    entry = '{} {}'.format(options, ' '.join(key.split()[:2] +
+                                             [KEY_COMMENT]))
+    lines = [line for line in (_read(AUTHORIZED_KEYS) or '').splitlines()
+             if not line.endswith(' ' + KEY_COMMENT)]
+    host.mkdir(SSH_DIR, perms=0o700)
+    _write_if_changed(AUTHORIZED_KEYS, '\n'.join(lines + [entry]) + '\n',
+                      perms=0o600)
+
+
+def _systemctl(*args):
+    subprocess.check_call(['systemctl'] + list(args))
+
+
+def script(state_dir, peer):
+    '''Return the push script for state_dir and the peer address.'''
+    return SCRIPT_TEMPLATE.format(
+        health=os.path.join(hookenv.charm_dir(), 'lib', 'charms', 'slurm',
+                            'health.py'),
+        key=KEY_FILE, known_hosts=KNOWN_HOSTS,
+        state_dir=state_dir.rstrip('/'), peer=peer)
+
+
+def enable(state_dir, peer, interval):
+    """Install and start the timer that pushes state_dir to peer while
+    the local slurmctld is in control.
+
+    :param state_dir: StateSaveLocation
+    :param peer: address of the peer controller
+    :param interval: seconds between two pushes
+    """
+    changed = _write_if_changed(SCRIPT, script(state_dir, peer), perms=0o755)
+    changed |= _write_if_changed(
+        os.path.join(UNIT_DIR, UNIT + '.service'),
+        SERVICE_TEMPLATE.format(script=SCRIPT))
+    changed |= _write_if_changed(
+        os.path.join(UNIT_DIR, UNIT + '.timer'),
+        TIMER_TEMPLATE.format(interval=interval))
+    if changed:
+        hookenv.log('Replicating {} to {} every {}s'.format(
+            state_dir, peer, interval))
+        _systemctl('daemon-reload')
+        _systemctl('enable', UNIT + '.timer')
+        _systemctl('restart', UNIT + '.timer')
+
+
+def disable():
+    '''Stop pushing state, e.g. when replication is switched off.'''
+    timer = os.path.join(UNIT_DIR, UNIT + '.timer')
+    if not os.path.exists(timer):
+        return
+    hookenv.log('Stopping state save replication')
+    _systemctl('disable', '--now', UNIT + '.timer')
+    os.remove(timer)
+    _systemctl('daemon-reload')
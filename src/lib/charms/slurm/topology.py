@@ -0,0 +1,133 @@
+"""topology.conf generation for the topology/tree plugin.
+
+Leaf switches come either from the nodes themselves (a 'switch' attribute
+published by the node, or else the subnet of its ingress address) or from
+an operator mapping in the topology_map option. Knowing which nodes share a
+switch lets slurmctld place multi-node jobs on as few switches as possible.
+Node and switch lists are written as compressed hostlist expressions.
+"""
+import re
+import ipaddress
+import collections
+
+import charms.slurm.hostlist as hostlist
+
+MODES = ('none', 'auto', 'map')
+# leaf switch of nodes without topology information
+UNASSIGNED = 'unassigned'
+# switch joining all top level switches
+ROOT = 'root'
+_INVALID = re.compile(r'[^A-Za-z0-9_-]+')
+
+
+def switch_name(value):
+    '''Make a Slurm switch name from a node attribute or subnet.'''
+    return _INVALID.sub('-', str(value)).strip('-') or UNASSIGNED
+
+
+def leaf_switch(attributes, prefix_length=24):
+    """Return the leaf switch of a node from its topology attributes.
+
+    :param attributes: dictionary with optional switch and ingress-address
+    :param prefix_length: subnet size used when only the address is known
+    :rtype: str
+    """
+    if attributes.get('switch'):
+        return switch_name(attributes['switch'])
+    address = attributes.get('ingress-address')
+    if address:
+        try:
+            network = ipaddress.ip_network(
+                '{}/{}'.format(address, prefix_length), strict=False)
+        except ValueError:
+            return UNASSIGNED
+        return switch_name('net-{}'.format(network.network_address))
+    return UNASSIGNED
+
+
+def parse_map(text):
+    """Parse the topology_map option.
+
+    Entries are separated by whitespace and map a switch to a hostlist
+    expression of nodes or of other switches, e.g.
+    ``leaf1=node[001-032] leaf2=node[033-064] spine=leaf[1-2]``.
+
+    :return: ordered dictionary of switch name to expanded members
+    :raises ValueError: on malformed entries
+    :rtype: collections.OrderedDict
+    """
+    switches = collections.OrderedDict()
+    for entry in (text or '').split():
+        name, sep, members = entry.partition('=')
+        if not sep or not name or not members:
+            raise ValueError('bad topology_map entry "{}"'.format(entry))
+        if switch_name(name) != name:
+            raise ValueError('bad switch name "{}"'.format(name))
+        switches.setdefault(name, []).extend(hostlist.expand(members))
+    return switches
+
+
+def build(nodes, switch_of, mapping=None):
+    """Build the switch hierarchy.
+
+    :param nodes: node names
+    :param switch_of: function returning the leaf switch of a node name,
+        used for nodes the mapping does not place
+    :param mapping: result of parse_map() or None
+    :return: (leaves, parents) where leaves maps a switch to its node names
+        and parents maps a switch to its child switches
+    :rtype: tuple
+    """
+    mapping = mapping or {}
+    nodes = set(nodes)
+    leaves = collections.defaultdict(list)
+    parents = {}
+    placed = set()
+    for name, members in mapping.items():
+        if all(member in mapping for member in members):
+            parents[name] = list(members)
+            continue
+        for member in members:
+            if member in nodes and member not in placed:
+                leaves[name].append(member)
+                placed.add(member)
+    for node in sorted(nodes - placed):
+        leaves[switch_of(node)].append(node)
+    # drop mapped switches whose nodes are all gone, then, bottom up, the
+    # parents left without any child
+    leaves = {name: members for name, members in leaves.items() if members}
+    while True:
+        pruned = {name: [child for child in children
+                         if child in leaves or child in parents]
+                  for name, children in parents.items()}
+        pruned = {name: children for name, children in pruned.items()
+                  if children}
+        if pruned == parents:
+            return leaves, parents
+        parents = pruned
+
+
+def render(leaves, parents):
+    """Return the topology.conf contents.
+
+    Top level switches are joined by a root switch so that every node is
+    reachable from every other one.
+
+    :rtype: str
+    """
+    lines = []
+    for name in sorted(leaves):
+        lines.append('SwitchName={} Nodes={}'.format(
+            name, ','.join(hostlist.compress(leaves[name]))))
+    children = set()
+    for name in sorted(parents):
+        if parents[name]:
+            children.update(parents[name])
+            lines.append('SwitchName={} Switches={}'.format(
+                name, ','.join(hostlist.compress(parents[name]))))
+    tops = sorted(set(leaves).union(n for n in parents if parents[n]) -
+                  children)
+    if len(tops) > 1 and ROOT not in tops:
+        lines.append('SwitchName={} Switches={}'.format(
+            ROOT, ','.join(hostlist.compress(tops))))
+    return '\n'.join(lines) + '\n'
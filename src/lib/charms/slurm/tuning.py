@@ -0,0 +1,163 @@
+"""slurmctld throughput settings derived from the cluster layout.
+
+The Slurm defaults suit small clusters with moderate job rates. The
+profiles here follow the Slurm high throughput and large cluster guides and
+scale the relevant parameters with the number of nodes and partitions.
+Explicit operator settings always take precedence over computed values.
+"""
+import math
+
+PROFILES = ('default', 'high-throughput', 'large-cluster')
+# Slurm's upper limit for TreeWidth
+MAX_TREE_WIDTH = 65533
+
+
+def _tree_width(node_count):
+    # fan-out close to the square root of the node count keeps both the
+    # depth and the width of the communication tree small
+    return min(MAX_TREE_WIDTH,
+               max(50, int(math.ceil(math.sqrt(max(node_count, 1))))))
+
+
+def _message_timeout(node_count, base):
+    # give slurmctld more time per thousand nodes it talks to
+    return min(60, base + 5 * (node_count // 1000))
+
+
+def profile_settings(profile, node_count, partition_count):
+    """Return the scheduling parameters of a performance profile.
+
+    :param profile: one of PROFILES
+    :param node_count: number of nodes in the cluster
+    :param partition_count: number of partitions
+    :return: dictionary with scheduler_parameters, max_job_count,
+        message_timeout, tree_width and slurmctld_port_count, empty for
+        the default profile
+    :raises ValueError: on an unknown profile
+    :rtype: dict
+    """
+    if profile not in PROFILES:
+        raise ValueError('unknown performance profile %s' % profile)
+    if profile == 'default':
+        return {}
+
+    partition_count = max(partition_count, 1)
+    if profile == 'high-throughput':
+        scheduler_parameters = [
+            'defer',
+            'sched_min_interval=2000000',
+            'bf_interval=60',
+            'bf_continue',
+            'bf_yield_interval=1000000',
+            'bf_max_job_test=%d' % max(1000, 200 * partition_count),
+            'bf_max_job_part=%d' % max(200, 1000 // partition_count),
+            'max_rpc_cnt=150',
+        ]
+        return {
+            'scheduler_parameters': ','.join(scheduler_parameters),
+            'max_job_count': max(100000, 100 * node_count),
+            'message_timeout': _message_timeout(node_count, 20),
+            'tree_width': _tree_width(node_count),
+            'slurmctld_port_count': 4,
+        }
+
+    scheduler_parameters = [
+        'sched_min_interval=1000000',
+        'bf_interval=60',
+        'bf_continue',
+        'bf_max_job_test=%d' % max(500, node_count // 2),
+        'bf_max_job_part=%d' % max(100, node_count // (2 * partition_count)),
+        'max_rpc_cnt=100',
+    ]
+    return {
+        'scheduler_parameters': ','.join(scheduler_parameters),
+        'max_job_count': max(10000, 20 * node_count),
+        'message_timeout': _message_timeout(node_count, 10),
+        'tree_width': _tree_width(node_count),
+        'slurmctld_port_count': 2,
+    }
+
+
+# upper bound for automatically sized SlurmctldPort ranges
+MAX_AUTO_PORTS = 8
+# job submissions per second one slurmctld port is assumed to absorb
+SUBMITS_PER_PORT = 250
+# nodes whose RPCs one slurmctld port is assumed to absorb
+NODES_PER_PORT = 2000
+
+
+def port_range(port, count):
+    '''Return a SlurmctldPort value for count ports starting at port.'''
+    port = int(str(port).split('-')[0])
+    if count <= 1:
+        return port
+    return '%d-%d' % (port, port + count - 1)
+
+
+def ports(value):
+    """Return the list of ports of a SlurmctldPort value.
+
+    :raises ValueError: on a malformed value
+    :rtype: list
+    """
+    first, _, last = str(value).partition('-')
+    first, last = int(first), int(last or first)
+    if not 0 < first <= last < 65536:
+        raise ValueError('bad port range %s' % value)
+    return list(range(first, last + 1))
+
+
+def auto_port_count(node_count, submit_rate):
+    """Size a SlurmctldPort range for the expected RPC load.
+
+    Each port gets its own listen queue, so bursts of job submissions and
+    node messages are spread over more of them.
+    """
+    count = (1 + int(math.ceil(max(submit_rate, 0) / SUBMITS_PER_PORT)) +
+             node_count // NODES_PER_PORT)
+    return min(MAX_AUTO_PORTS, count)
+
+
+def slurmctld_port(config, node_count, profile_count=1):
+    """Return the SlurmctldPort value to render.
+
+    An explicit slurmctld_port_range wins, 'auto' sizes the range from the
+    node count and expected_submit_rate, otherwise the performance profile
+    decides how many ports starting at slurmctld_port are used.
+
+    :raises ValueError: on a malformed slurmctld_port_range
+    """
+    explicit = (config.get('slurmctld_port_range') or '').strip()
+    if explicit == 'auto':
+        count = auto_port_count(node_count,
+                                config.get('expected_submit_rate') or 0)
+    elif explicit:
+        ports(explicit)
+        return explicit
+    else:
+        count = profile_count
+    return port_range(config.get('slurmctld_port'), count)
+
+
+def scheduling_context(config, node_count, partition_count):
+    """Return the context keys for the performance_profile option.
+
+    Explicitly configured scheduler_parameters, max_job_count,
+    message_timeout, tree_width and slurmctld_port_range win over the
+    profile.
+
+    :param config: charm config
+    :rtype: dict
+    """
+    settings = profile_settings(config.get('performance_profile') or
+                                'default', node_count, partition_count)
+    port_count = settings.pop('slurmctld_port_count', 1)
+    for key in ('scheduler_parameters', 'max_job_count', 'message_timeout',
+                'tree_width'):
+        if config.get(key):
+            settings[key] = config[key]
+    context = {k: v for k, v in settings.items() if v}
+    port = slurmctld_port(config, node_count, port_count)
+    if port != config.get('slurmctld_port'):
+        context['slurmctld_port'] = port
+    return context
@@ -0,0 +1,124 @@
+"""Node weights from one or more inventory criteria.
+
+Slurm allocates the nodes with the lowest Weight first, so weighing nodes
+by size makes small jobs land on small nodes. Nodes are ordered by a list
+of criteria (e.g. RealMemory, then CPUs) and values can be grouped into
+buckets so that a heterogeneous cluster ends up with a handful of weight
+levels instead of one per distinct value.
+"""
+import bisect
+
+CRITERIA_ALLOWED = ('RealMemory', 'CPUs', 'CoresPerSocket')
+# bucket index of nodes that did not report a criterion, sorts lowest
+MISSING = -1
+
+
+def parse_criteria(value):
+    """Parse an ordered, comma separated list of criteria.
+
+    :raises ValueError: on an empty list or an unknown criterion
+    :rtype: list
+    """
+    criteria = [c.strip() for c in (value or '').split(',') if c.strip()]
+    if not criteria:
+        raise ValueError('no node weight criteria given')
+    for criterion in criteria:
+        if criterion not in CRITERIA_ALLOWED:
+            raise ValueError('unknown node weight criterion %s' % criterion)
+    return criteria
+
+
+def parse_buckets(value, criteria):
+    """Parse a bucket specification for the given criteria.
+
+    An empty value keeps every distinct value apart. A number N splits
+    every criterion into N quantiles. Otherwise space separated
+    per-criterion entries are expected, each either ``<criterion>=qN`` for
+    quantiles or ``<criterion>=b1,b2,...`` for explicit lower bucket
+    boundaries, e.g. ``RealMemory=65536,262144 CPUs=q4``. Criteria that are
+    not mentioned keep their distinct values.
+
+    :return: criterion -> None (distinct values), int (quantiles) or list
+        of boundaries
+    :raises ValueError: on a malformed specification
+    :rtype: dict
+    """
+    buckets = dict.fromkeys(criteria)
+    value = (value or '').strip()
+    if not value:
+        return buckets
+    if value.isdigit():
+        return dict.fromkeys(criteria, _quantiles(value))
+    for entry in value.split():
+        criterion, _, spec = entry.partition('=')
+        if criterion not in buckets or not spec:
+            raise ValueError('bad node weight bucket entry %s' % entry)
+        if spec.startswith('q'):
+            buckets[criterion] = _quantiles(spec[1:])
+        else:
+            buckets[criterion] = sorted(int(b) for b in spec.split(','))
+    return buckets
+
+
+def _quantiles(value):
+    count = int(value)
+    if count < 1:
+        raise ValueError('quantile count must be positive')
+    return count
+
+
+def quantile_boundaries(values, count):
+    """Return lower boundaries splitting sorted values into count buckets.
+
+    :rtype: list
+    """
+    if not values or count < 2:
+        return []
+    boundaries = {values[len(values) * i // count] for i in range(1, count)}
+    return sorted(boundaries)
+
+
+def _value(inventory, criterion):
+    try:
+        return int(inventory[criterion])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def compute_weights(nodes, criteria, buckets=None):
+    """Compute a weight for every node.
+
+    Each node gets a key with one bucket index per criterion, in criteria
+    order. Distinct keys are ranked and the rank (starting at 1) is the
+    node weight, so nodes missing a criterion sort first.
+
+    :param nodes: node dictionaries with an 'inventory'
+    :param criteria: ordered list of inventory keys
+    :param buckets: as returned by parse_buckets()
+    :return: list of weights in node order, and criterion -> list of
+        names of nodes that did not report it
+    :rtype: tuple
+    """
+    buckets = buckets or dict.fromkeys(criteria)
+    # parse every value once, column by column
+    columns = [[_value(n['inventory'], c) for n in nodes] for c in criteria]
+    missing = {}
+    keyed = []
+    for criterion, column in zip(criteria, columns):
+        spec = buckets.get(criterion)
+        present = sorted(v for v in column if v is not None)
+        if isinstance(spec, int):
+            spec = quantile_boundaries(present, spec)
+        if spec is None:
+            keyed.append([MISSING if v is None else v for v in column])
+        else:
+            keyed.append([MISSING if v is None else bisect.bisect_right(spec, v)
+                          for v in column])
+        absent = [n['inventory'].get('NodeName', n.get('hostname'))
+                  for n, v in zip(nodes, column) if v is None]
+        if absent:
+            missing[criterion] = absent
+
+    keys = list(zip(*keyed)) if keyed else []
+    ranks = {key: rank for rank, key in enumerate(sorted(set(keys)), 1)}
+    return [ranks[key] for key in keys], missing
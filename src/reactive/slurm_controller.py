@@ -1,19 +1,31 @@
 import os
 import time
 #
-import copy
 import socket
-import charms.leadership as leadership
+import subprocess
+import collections
 import charms.reactive as reactive
 import charms.reactive.flags as flags
 import charmhelpers.core.hookenv as hookenv
 import charmhelpers.core.host as host
+import charmhelpers.core.unitdata as unitdata
 import charms.reactive.relations as relations
 import charms.slurm.helpers as helpers
+import charms.slurm.tuning as tuning
+import charms.slurm.features as features
+import charms.slurm.inventory as inventory
 import charms.slurm.controller as controller
+import charms.slurm.metrics as metrics
+import charms.slurm.profiling as profiling
+import charms.slurm.replication as replication
 from charms.reactive import endpoint_from_flag
 
 
+# record wall time and agent calls of every handler if profile_handlers is
+# set, see hook-profile action; deferred to the hook start so that importing
+# the layer reads no config
+hookenv.atstart(profiling.install)
+
 flags.register_trigger(
     when='munge.configured',
     set_flag='slurm-controller.munge_updated'
@@ -25,6 +37,9 @@ def upgrade_charm():
     # reconfigure on charm upgrade
     flags.set_flag('slurm-controller.reconfigure')
     flags.clear_flag('slurm-controller.configured')
+    # templates may have changed, so the next run must render again
+    controller.forget_applied_config()
+    inventory.forget()
 
 
 @reactive.when_not('endpoint.slurm-cluster.joined')
@@ -32,6 +47,7 @@ def missing_nodes():
     hookenv.status_set('blocked', 'Missing relation to slurm-node')
     flags.clear_flag('slurm-controller.configured')
     host.service_stop(helpers.SLURMCTLD_SERVICE)
+    controller.forget_applied_config()
 
 
 @reactive.when('leadership.is_leader')
@@ -41,8 +57,9 @@ def set_active_controller():
     until an operator decides to relocate an active controller
     to a different node via an action or doing a
     juju run --unit <leader-unit> "leader-set active_controller=''"
+    or the leader fails over automatically, see probe_active_controller.
     '''
-    leadership.leader_set(active_controller=hookenv.local_unit())
+    controller.leader_set(active_controller=hookenv.local_unit())
 
 
 # TODO: add slurm DBD to when_any as this is something that
@@ -55,29 +72,310 @@ def set_active_controller():
 @reactive.when('leadership.set.active_controller')
 def handle_ha(ha_endpoint):
     ''' Provide peer data in order to set up active-backup HA.'''
-    peer_data = {'hostname': socket.gethostname()}
+    peer_data = {'hostname': socket.gethostname(),
+                 'unit_name': hookenv.local_unit()}
+    if controller.config().get('state_save_replication'):
+        # lets the peer authorize state pushes from this unit
+        peer_data['state_sync_key'] = replication.public_key()
+        peer_data['state_sync_address'] = hookenv.unit_private_ip()
+        peer_data['state_sync_host_key'] = replication.host_key()
     ha_endpoint.provide_peer_data(peer_data)
 
 
+@reactive.when('endpoint.slurm-controller-ha.joined')
+@reactive.when('slurm-controller.configured')
+def replicate_state_save(ha_endpoint):
+    '''Push the StateSaveLocation to the peer controller if
+    state_save_replication is set. Both units run the push timer, each
+    push checks that the local slurmctld is the one in control, as Slurm
+    hands over to the backup well before the charm fails over.'''
+    config = controller.config()
+    peer = ha_endpoint.peer_data
+    if not config.get('state_save_replication') or not all(
+            peer.get(k) for k in ('state_sync_key', 'state_sync_host_key',
+                                  'hostname')):
+        flags.clear_flag('slurm-controller.rrsync_missing')
+        replication.disable()
+        return
+    try:
+        replication.authorize_peer(peer['state_sync_key'],
+                                   config.get('state_save_location'),
+                                   peer.get('state_sync_address'))
+    except OSError as e:
+        # the peer could not push its state here
+        hookenv.log('Cannot accept state pushes from the peer '
+                    'controller: {}'.format(e), hookenv.ERROR)
+        hookenv.status_set('blocked', 'State save replication needs '
+                           'rrsync, install the rsync documentation')
+        flags.set_flag('slurm-controller.rrsync_missing')
+    else:
+        flags.clear_flag('slurm-controller.rrsync_missing')
+    address = peer.get('state_sync_address') or peer['hostname']
+    replication.trust_peer(address, peer['state_sync_host_key'])
+    replication.enable(config.get('state_save_location'), address,
+                       config.get('state_save_replication_interval'))
+
+
+@reactive.hook('update-status')
+def probe_active_controller():
+    '''The leader probes the active controller on every update-status and
+    promotes the backup controller once the active one stopped responding
+    for failover_probe_failures probes in a row. Both roles are rendered
+    again in the same hook on the leader and on leader-settings-changed on
+    the other unit.
+
+    This does not wait for slurm-controller.configured, which is not set
+    e.g. while a restarted slurmctld does not come back, only for the peer
+    to be known.'''
+    # hook handlers cannot be combined with flag conditions
+    if not (flags.is_flag_set('leadership.is_leader') and
+            flags.is_flag_set('slurm.installed')):
+        return
+    threshold = controller.config().get('failover_probe_failures')
+    ha_endpoint = relations.endpoint_from_flag(
+        'endpoint.slurm-controller-ha.joined')
+    if not threshold or not ha_endpoint:
+        return
+    active = controller.leader_get('active_controller')
+    candidates = {hookenv.local_unit(),
+                  ha_endpoint.peer_data.get('unit_name')} - {active, None}
+    if not active or not candidates:
+        return
+    if controller.probe_active_controller(
+            sorted(candidates)[0], threshold,
+            controller.config().get('failover_probe_timeout')):
+        controller.mark_dirty('network')
+        flags.set_flag('slurm-controller.dirty')
+
+
+@reactive.hook('update-status')
+def collect_metrics():
+    '''Write slurmctld load metrics from sdiag to the metrics_textfile and
+    keep them for the controller-metrics action.'''
+    if not flags.is_flag_set('slurm-controller.configured'):
+        return
+    config = controller.config()
+    if not config.get('metrics_history_size') and not config.get(
+            'metrics_textfile'):
+        return
+    try:
+        metrics.collect(config.get('metrics_textfile'),
+                        config.get('metrics_history_size'))
+    except (OSError, subprocess.SubprocessError) as e:
+        # e.g. slurmctld is not responding, the probe handles that
+        hookenv.log('Collecting slurmctld metrics failed: {}'.format(e),
+                    hookenv.WARNING)
+
+
+@reactive.hook('slurm-cluster-relation-joined',
+               'slurm-cluster-relation-changed')
+def note_node_change():
+    '''Remember the node unit of this hook for the inventory index, as
+    applying may have to wait for a later hook with another remote unit.'''
+    inventory.mark_stale(hookenv.remote_unit())
+
+
+# flags that make configure_controller mark context sections as stale
+TRIGGERS = collections.OrderedDict([
+    ('endpoint.slurm-cluster.changed', ('nodes',)),
+    ('endpoint.slurm-cluster.departed', ('nodes',)),
+    ('endpoint.slurm-controller-ha.changed', ('network',)),
+    ('endpoint.slurm-controller-ha.departed', ('network',)),
+    ('config.changed', ('config', 'nodes')),
+    ('slurm-controller.reconfigure', ('all',)),
+    ('slurm-controller.munge_updated', ('munge',)),
+    ('slurm.dbd_host_updated', ('dbd',)),
+    # the leader shares the dbd settings and the munge key with the
+    # backup controller through leadership settings
+    ('leadership.changed.dbd_host', ('dbd',)),
+    ('leadership.changed.dbd_port', ('dbd',)),
+    ('leadership.changed.dbd_ipaddr', ('dbd',)),
+    ('endpoint.slurm-dbd-consumer.departed', ('dbd',)),
+    ('leadership.changed.munge_key', ('munge',)),
+    ('slurm-controller.node_batch_pending', ('nodes',)),
+    ('slurm-controller.dirty', ()),
+    # a failover swaps the roles, see probe_active_controller
+    ('leadership.changed.active_controller', ('network',)),
+    # publishing waits for a restarted slurmctld, see apply_controller_config
+    ('slurm-controller.publish_pending', ()),
+])
+# trigger flags that are consumed once their sections are marked
+CONSUMED_TRIGGERS = ('endpoint.slurm-cluster.changed',
+                     'slurm-controller.reconfigure',
+                     'slurm-controller.munge_updated',
+                     'slurm.dbd_host_updated',
+                     'endpoint.slurm-dbd-consumer.departed',
+                     'slurm-controller.dirty')
+# flags required to apply the controller config
+APPLY_FLAGS = ('slurm.installed', 'munge.configured',
+               'endpoint.slurm-cluster.joined',
+               'leadership.set.active_controller')
+
+
 @reactive.when('slurm.installed')
 @reactive.when('munge.configured')
 @reactive.when('endpoint.slurm-cluster.joined')
-@reactive.when_any('endpoint.slurm-cluster.changed',
-                   'endpoint.slurm-cluster.departed',
-                   'endpoint.slurm-controller-ha.changed',
-                   'endpoint.slurm-controller-ha.departed',
-                   'config.changed',
-                   'slurm-controller.reconfigure',
-                   'slurm-controller.munge_updated',
-                   'slurm.dbd_host_updated')
+@reactive.when_any(*TRIGGERS.keys())
 @reactive.when('leadership.set.active_controller')
 @reactive.when_not('config.changed.clustername')
 def configure_controller(*args):
     ''' A controller is only configured after leader election is
     performed. Cluster endpoint must be present for a controller to
-    proceed with initial configuration'''
+    proceed with initial configuration.
+
+    Other handlers may set more triggers later in the same dispatch, so
+    this only records which parts of the config are stale and leaves
+    building, rendering and restarting to a single apply step at the end
+    of the hook.'''
+    parts = set()
+    for flag, sections in TRIGGERS.items():
+        if flags.is_flag_set(flag):
+            parts.update(sections)
+    controller.mark_dirty(*parts)
+    for flag in CONSUMED_TRIGGERS:
+        flags.clear_flag(flag)
+    controller.schedule_apply(apply_controller_config)
+
+
+def _nodes_section(cluster_endpoint):
+    '''Build the nodes and partitions, or return None if the controller
+    cannot be configured with them yet.'''
+    # Get node configs from the inventory index which only re-reads
+    # the units that changed since the last hook
+    index = controller.inventory_index(cluster_endpoint)
+    nodes = index.nodes
+    partitions = index.partitions
+
+    # Implementation of automatic node weights
+    node_weight_criteria = controller.config().get('node_weight_criteria')
+    if node_weight_criteria != 'none':
+        config = controller.config()
+        weightres = controller.set_node_weight_criteria(
+            node_weight_criteria, nodes,
+            detail_file=config.get('debug_log_file') or None,
+            node_weight_buckets=config.get('node_weight_buckets'))
+        # If the weight configuration is incorrect, abort reconfiguration.
+        # Status will be set to blocked with an informative message. The
+        # controller charm will keep running.
+        if not weightres:
+            return None
+
+    # Features for --constraint from the inventory; nodes with the same
+    # features are still merged into one ranged NodeName entry
+    node_feature_rules = controller.config().get('node_feature_rules')
+    if node_feature_rules:
+        try:
+            rules = features.parse_rules(node_feature_rules)
+        except ValueError as e:
+            hookenv.status_set('blocked', 'Incorrect charm '
+                               '"node_feature_rules" configuration: '
+                               '{}'.format(e))
+            return None
+        hookenv.log('Node features set on {} of {} nodes'.format(
+            features.set_features(nodes, index.attributes, rules),
+            len(nodes)))
+
+    # relation-changed does not necessarily mean that data will be provided
+    if not partitions:
+        return None
+
+    # apply a scale-out in one go rather than once per joining unit;
+    # the pending flag makes later hooks (e.g. update-status) check again
+    expected = controller.expected_node_units()
+    if controller.node_batch_pending(
+            len(nodes), expected,
+            controller.config().get('node_batch_max_wait'),
+            controller.config().get('node_batch_settle')):
+        hookenv.status_set('waiting', 'Waiting for {}/{} nodes'.format(
+            len(nodes), expected))
+        flags.set_flag('slurm-controller.node_batch_pending')
+        return None
+    flags.clear_flag('slurm-controller.node_batch_pending')
+
+    if controller.config().get('compress_hostlists'):
+        nodes, partitions = controller.compress_nodes(nodes, partitions)
+    return {'nodes': nodes, 'partitions': partitions}
+
+
+def _tuning_section(nodes_section):
+    '''Scheduling parameters of the performance profile for the current
+    cluster size, or None if the profile or port range is invalid.'''
+    partitions = nodes_section['partitions']
+    try:
+        return tuning.scheduling_context(controller.config(),
+                                         controller.node_count(partitions),
+                                         len(partitions))
+    except ValueError as e:
+        hookenv.status_set('blocked', 'Incorrect charm "performance_profile" '
+                           'or "slurmctld_port_range" configuration: '
+                           '{}'.format(e))
+        return None
+
+
+def _topology_section(cluster_endpoint):
+    '''Switch hierarchy of the nodes, or None if the topology options are
+    invalid.'''
+    try:
+        return controller.topology_context(
+            controller.inventory_index(cluster_endpoint), controller.config())
+    except ValueError as e:
+        hookenv.status_set('blocked', 'Incorrect charm "topology" '
+                           'configuration: {}'.format(e))
+        return None
+
+
+def _include_section():
+    # the cluster include file and the drop-in fragments, only changed
+    # fragments are read again
+    return controller.include_context(helpers.SLURM_CONFIG_DIR)
+
+
+def _network_section(cluster_endpoint, role, peer_role):
+    # prefixed keys for network details based on a current unit role
+    # (active or backup)
+    section = controller.add_key_prefix(
+        controller.network_details(cluster_endpoint), role)
+    ha_endpoint = relations.endpoint_from_flag(
+        'endpoint.slurm-controller-ha.joined')
+    if ha_endpoint:
+        # add prefixed peer data
+        section.update(controller.add_key_prefix(
+            ha_endpoint.peer_data, peer_role))
+    return section
+
+
+def _dbd_section():
+    # If we have a DBD relation, extract endpoint data and configure DBD setup
+    # directly, regardless if the clustername gets accepted in the DBD or not
+    if flags.is_flag_set('endpoint.slurm-dbd-consumer.joined') and controller.leader_get('dbd_host'):
+        return {
+            'dbd_host': controller.leader_get('dbd_host'),
+            'dbd_port': controller.leader_get('dbd_port'),
+            'dbd_ipaddr': controller.leader_get('dbd_ipaddr')
+        }
+    return {}
+
+
+def _jobcomp_section():
+    # slurmctld writes job completions to a file that the export service
+    # ships to Elasticsearch in batches, see export_job_completions
+    if flags.is_flag_set('slurm-controller.jobcomp_export'):
+        return {'jobcomp_type': 'jobcomp/filetxt',
+                'jobcomp_loc': controller.config().get('jobcomp_file')}
+    return {}
+
+
+def apply_controller_config():
+    '''Rebuild the stale parts of the controller context, then render,
+    restart and publish it if the effective config changed. Runs once at
+    the end of a hook, see configure_controller.'''
+    # flags may have changed since configure_controller ran
+    if (not all(flags.is_flag_set(f) for f in APPLY_FLAGS) or
+            flags.is_flag_set('config.changed.clustername')):
+        hookenv.log('Not applying controller config, keeping {} '
+                    'stale'.format(sorted(controller.dirty_parts())))
+        return
     hookenv.status_set('maintenance', 'Configuring slurm-controller')
-    flags.clear_flag('slurm-controller.configured')
 
     # need to have a role determined here so that a controller context can
     # be uniformly prepared for consumption on the worker side as controller
@@ -91,124 +389,232 @@ def configure_controller(*args):
     # the endpoint is present as joined is required for this handler
     cluster_endpoint = relations.endpoint_from_flag(
         'endpoint.slurm-cluster.joined')
-    # Get node configs
-    nodes = cluster_endpoint.get_node_data()
-    partitions = controller.get_partitions(nodes)
 
-    # Implementation of automatic node weights
-    node_weight_criteria = hookenv.config().get('node_weight_criteria')
-    if node_weight_criteria != 'none':
-        weightres = controller.set_node_weight_criteria(node_weight_criteria, nodes)
-        # If the weight configuration is incorrect, abort reconfiguration. Status
-        # will be set to blocked with an informative message. The controller charm
-        # will keep running.
-        if not weightres:
+    # only rebuild the sections that were marked as stale (or were never
+    # built), the rest comes from the previous apply
+    dirty = controller.dirty_parts()
+    sections = controller.context_sections()
+    if sections.get('role') != role:
+        dirty.add('network')
+    stale = controller.stale_sections(dirty, sections)
+    hookenv.log('Rebuilding controller context sections: {}'.format(
+        ', '.join(stale) or 'none'))
+    for name in stale:
+        if name == 'config':
+            # the whole charm config will be sent to related nodes
+            # with some additional options added via dict update
+            sections[name] = dict(controller.config())
+            if sections[name].get('configless'):
+                sections[name]['slurmctld_parameters'] = 'enable_configless'
+        elif name == 'include':
+            sections[name] = _include_section()
+        elif name == 'nodes':
+            sections[name] = _nodes_section(cluster_endpoint)
+        elif name == 'tuning':
+            sections[name] = _tuning_section(sections['nodes'])
+        elif name == 'topology':
+            sections[name] = _topology_section(cluster_endpoint)
+        elif name == 'munge':
+            # for worker nodes
+            sections[name] = {'munge_key': controller.leader_get('munge_key')}
+        elif name == 'network':
+            sections[name] = _network_section(cluster_endpoint, role,
+                                              peer_role)
+        elif name == 'dbd':
+            sections[name] = _dbd_section()
+        elif name == 'jobcomp':
+            sections[name] = _jobcomp_section()
+        if sections[name] is None:
+            if not flags.is_flag_set('slurm-controller.node_batch_pending'):
+                # blocked on the charm config or no node data yet; while
+                # joining nodes are batched the applied config stays live
+                flags.clear_flag('slurm-controller.configured')
+            # stale sections stay marked until an apply succeeds
+            unitdata.kv().flush()
             return
+    sections['role'] = role
 
-    # relation-changed does not necessarily mean that data will be provided
-    if not partitions:
-        flags.clear_flag('endpoint.slurm-cluster.changed')
-        return
-
-    # the whole charm config will be sent to related nodes
-    # with some additional options added via dict update
-    controller_conf = copy.deepcopy(hookenv.config())
-    # if controller cluster config include file exists, add contents to controller_conf dict
-    slurmconf_include = '%s/slurm-%s.conf' % (helpers.SLURM_CONFIG_DIR, hookenv.config().get('clustername'))
-    if os.path.exists(slurmconf_include):
-        f = open(slurmconf_include, "r")
-        controller_conf.update({'include': f.read()})
-        f.close()
-    controller_conf.update({
-        'nodes': nodes,
-        'partitions': partitions,
-        # for worker nodes
-        'munge_key': hookenv.leader_get('munge_key'),
-    })
-
-    net_details = controller.add_key_prefix(
-        cluster_endpoint.network_details(), role)
-    # update the config dict used as a context in rendering to have prefixed
-    # keys for network details based on a current unit role (active or backup)
-    controller_conf.update(net_details)
-
-    ha_endpoint = relations.endpoint_from_flag(
-        'endpoint.slurm-controller-ha.joined')
-    if ha_endpoint:
-        # add prefixed peer data
-        peer_data = controller.add_key_prefix(
-            ha_endpoint.peer_data, peer_role)
-        controller_conf.update(peer_data)
-    else:
-        peer_data = None
-
-    # If we have a DBD relation, extract endpoint data and configure DBD setup
-    # directly, regardless if the clustername gets accepted in the DBD or not
-    if flags.is_flag_set('endpoint.slurm-dbd-consumer.joined') and leadership.leader_get('dbd_host'):
-        dbd_host = leadership.leader_get('dbd_host')
-        controller_conf.update({
-            'dbd_host': leadership.leader_get('dbd_host'),
-            'dbd_port': leadership.leader_get('dbd_port'),
-            'dbd_ipaddr': leadership.leader_get('dbd_ipaddr')
-        })
+    peer_data = any(k.startswith(peer_role + '_') for k in sections['network'])
 
     # In case we are here due to DBD join or charm config change, announce this to the nodes
     # by changing the value of slurm_config_updated
-    if flags.is_flag_set('slurm.dbd_host_updated') or flags.is_flag_set('config.changed'):
+    announce = {}
+    if 'dbd' in dirty or 'config' in dirty:
         ts = time.time()
         hookenv.log('Slurm configuration on controller was updated on %s, annoucing to nodes' % ts)
-        controller_conf.update({ 'slurm_config_updated': ts })
-        flags.clear_flag('slurm.dbd_host_updated')
+        announce['slurm_config_updated'] = ts
+    # a read-only view over the sections, nothing is copied however many
+    # nodes there are
+    layers = [sections[name] for name in controller.SECTIONS] + [announce]
+    controller_conf = controller.LayeredContext(*layers)
+    # parameters the slurm.conf template does not render go to the include
+    controller_conf = controller.LayeredContext(
+        *layers + [controller.managed_include(controller_conf)])
+    controller.save_context_sections(sections)
+    controller.clear_dirty()
 
     # a controller service is configurable if it is an active controller
     # or a backup controller that knows about an active controller
     is_configurable = is_active or (not is_active and peer_data)
+
+    # most triggers carry no effective change (e.g. a relation-changed
+    # with the same node data), so only render, restart and publish
+    # when the fingerprint of the context differs from the applied one
+    digests = controller.context_digests(controller_conf)
+    fingerprint = controller.config_fingerprint(digests, is_active)
+    publish = False
+    restarted = False
+    if not controller.fingerprint_changed(fingerprint) and (
+            not is_configurable or
+            host.service_running(helpers.SLURMCTLD_SERVICE)):
+        hookenv.log('Controller config unchanged ({}), skipping render and '
+                    'slurmctld restart'.format(fingerprint[:12]))
+    else:
+        hookenv.log('Controller config changed ({}), applying'.format(
+            fingerprint[:12]))
+        restarted = _apply(controller_conf, fingerprint, digests, is_active,
+                           is_configurable)
+        publish = True
+
+    # slurmctld runs the applied config from here on, even while
+    # publishing it waits below
+    if is_configurable:
+        flags.set_flag('slurm-controller.configured')
+    else:
+        flags.clear_flag('slurm-controller.configured')
+
+    if flags.is_flag_set('slurm-controller.publish_pending'):
+        # nodes and users are only pointed at a restarted slurmctld once
+        # it recovered its state; later hooks only check once
+        publish = True
+        timeout = controller.config().get('ready_timeout') if restarted else 0
+        if controller.wait_until_ready(
+                controller_conf['slurmctld_port'],
+                'primary' if is_active else 'backup', timeout) is None:
+            hookenv.status_set('waiting',
+                               'Waiting for slurmctld to become ready')
+            unitdata.kv().flush()
+            return
+        flags.clear_flag('slurm-controller.publish_pending')
+    if publish:
+        _publish(controller_conf, is_active, cluster_endpoint)
+
+    if is_configurable:
+        # flags set now are seen by handlers in the next hook only; the
+        # blocked status of replicate_state_save stays
+        if not flags.is_flag_set('slurm-controller.rrsync_missing'):
+            hookenv.status_set('active', controller.ready_status())
+    else:
+        hookenv.status_set('maintenance',
+                           'Backup controller is waiting for peer data')
+    # this runs after the dispatch, persist what it changed
+    unitdata.kv().flush()
+
+
+def _restart_slurmctld():
+    host.service_restart(helpers.SLURMCTLD_SERVICE)
+    controller.record_restart()
+    flags.set_flag('slurm-controller.publish_pending')
+
+
+def _apply(controller_conf, fingerprint, digests, is_active,
+           is_configurable):
+    '''Render the config and restart or reconfigure slurmctld, return
+    True if it was restarted.'''
+    role = controller.ROLES[is_active]
+    restarted = False
     if is_configurable:
         hookenv.log('The controller is configurable ({})'.format(role))
         # Setup slurm dirs and config
         helpers.create_state_save_location(context=controller_conf)
         helpers.render_slurm_config(context=controller_conf, active_controller=is_active)
-        flags.set_flag('slurm-controller.configured')
-        flags.clear_flag('slurm-controller.reconfigure')
-        flags.clear_flag('slurm-controller.munge_updated')
-        # restart controller process on any changes
-        # TODO: this could be optimized via goal-state hook by
-        # observing "joining" node units
-        host.service_restart(helpers.SLURMCTLD_SERVICE)
+        controller.write_topology(helpers.SLURM_CONFIG_DIR, controller_conf)
+        # the active and the backup controller listen on the same range
+        controller.open_slurmctld_ports(controller_conf['slurmctld_port'])
+        if (controller.needs_restart(controller.applied_context(),
+                                     controller_conf, digests) or
+                not host.service_running(helpers.SLURMCTLD_SERVICE)):
+            hookenv.log('Restarting slurmctld')
+            _restart_slurmctld()
+            restarted = True
+        elif controller.reconfigure_slurmctld():
+            hookenv.log('Reconfigured running slurmctld')
+        else:
+            _restart_slurmctld()
+            restarted = True
     else:
         hookenv.log('The controller is NOT configurable ({})'.format(role))
-        if not is_active:
-            hookenv.status_set('maintenance',
-                               'Backup controller is waiting for peer data')
+    controller.save_applied_config(fingerprint, digests, controller_conf)
+    return restarted
+
 
+def _publish(controller_conf, is_active, cluster_endpoint):
     # Send config to nodes
     if is_active:
         # TODO: wait until a peer acknowledges that it has cleared
         # its side of a node-facing relation - this needs to be done
         # in case an active controller is changed to a different one
         # to avoid split-brain conditions on node units
-        cluster_endpoint.send_controller_config(controller_conf)
+        if controller_conf.get('configless'):
+            # slurmd pulls slurm.conf from slurmctld, only tell nodes
+            # where to find it
+            published_conf = controller.configless_config(controller_conf)
+        else:
+            published_conf = controller_conf
+        controller.publish_controller_config(
+            cluster_endpoint, published_conf,
+            delta=controller.config().get('config_publish_mode') == 'delta')
     else:
         # otherwise make sure that all keys are cleared
         # this is relevant for a former active controller
-        cluster_endpoint.send_controller_config({
-            k: None for k in controller_conf.keys()
-        })
+        controller.clear_controller_config(cluster_endpoint, controller_conf)
+
+
+@reactive.when('elasticsearch.available')
+def export_job_completions(elasticsearch):
+    '''Ship job completion records to Elasticsearch in bulk requests,
+    (re)configuring the export service when the Elasticsearch units or the
+    jobcomp options change.'''
+    hosts = sorted('{}:{}'.format(unit['host'], unit['port'])
+                   for unit in elasticsearch.list_unit_data()
+                   if unit.get('host') and unit.get('port'))
+    if not hosts:
+        return
+    config = controller.config()
+    options = {k: config.get(k) for k in ('jobcomp_file', 'jobcomp_index',
+                                          'jobcomp_batch_size',
+                                          'jobcomp_flush_interval')}
+    if not reactive.data_changed('slurm-controller.jobcomp_export',
+                                 [hosts[0], options]):
+        return
+    controller.enable_jobcomp_export('http://{}'.format(hosts[0]), config)
+    flags.set_flag('slurm-controller.jobcomp_export')
+    controller.mark_dirty('jobcomp')
+    flags.set_flag('slurm-controller.dirty')
 
-    # clear the changed flag as it is not cleared automatically
-    flags.clear_flag('endpoint.slurm-cluster.changed')
+
+@reactive.when_not('elasticsearch.available')
+@reactive.when('slurm-controller.jobcomp_export')
+def stop_job_completion_export():
+    controller.disable_jobcomp_export()
+    flags.clear_flag('slurm-controller.jobcomp_export')
+    reactive.data_changed('slurm-controller.jobcomp_export', None)
+    controller.mark_dirty('jobcomp')
+    flags.set_flag('slurm-controller.dirty')
 
 
 @reactive.when('endpoint.slurm-cluster.joined')
 @reactive.when('slurm-controller.configured')
+@reactive.when_not('slurm-controller.publish_pending')
+@reactive.when_not('slurm-controller.rrsync_missing')
 def controller_ready(cluster):
-    hookenv.status_set('active', 'Ready')
+    hookenv.status_set('active', controller.ready_status())
 
 @reactive.when('endpoint.slurm-dbd-consumer.joined')
 #@reactive.when('endpoint.slurm-dbd-consumer.changed')
 @reactive.when_not('slurm-controller.dbdname-requested')
 def send_clustername():
-    clustername = hookenv.config().get('clustername')
+    clustername = controller.config().get('clustername')
     hookenv.log("ready to send %s on endpoint" % clustername)
     endpoint = endpoint_from_flag('endpoint.slurm-dbd-consumer.joined')
     endpoint.configure_dbd(clustername)
@@ -219,7 +625,7 @@ def send_clustername():
 
 @reactive.when('config.changed.clustername')
 def change_clustername():
-    new_clustername = hookenv.config().get('clustername')
+    new_clustername = controller.config().get('clustername')
     hookenv.log("detected charm config cluster name change to %s" % new_clustername)
     # will this be a race condition with configure_controller()?
     if os.path.exists('/var/spool/slurm.state/clustername'):
@@ -228,7 +634,8 @@ def change_clustername():
     flags.clear_flag('slurm-controller.dbdname-requested')
     flags.clear_flag('slurm-controller.dbdname-accepted')
     flags.clear_flag('config.changed.clustername')
-    flags.set_flag('slurm-controller.reconfigure')
+    controller.mark_dirty('all')
+    flags.set_flag('slurm-controller.dirty')
 
 @reactive.when('endpoint.slurm-dbd-consumer.dbd_host_updated')
 @reactive.when('leadership.is_leader')
@@ -237,20 +644,28 @@ def consume_dbd_host_change(dbd_consumer):
     dbd_host = dbd_consumer.dbd_host
     dbd_port = dbd_consumer.dbd_port
     dbd_ipaddr = dbd_consumer.dbd_ipaddr
-    if dbd_host:
-        leadership.leader_set(dbd_host=dbd_host)
-    if dbd_port:
-        leadership.leader_set(dbd_port=dbd_port)
-    if dbd_ipaddr:
-        leadership.leader_set(dbd_ipaddr=dbd_ipaddr)
+    # a single leader-set for all settings that were provided
+    settings = {k: v for k, v in (('dbd_host', dbd_host),
+                                  ('dbd_port', dbd_port),
+                                  ('dbd_ipaddr', dbd_ipaddr)) if v}
+    if settings:
+        controller.leader_set(settings)
     flags.clear_flag('endpoint.slurm-dbd-consumer.dbd_host_updated')
     # Announce to configure_controller that the nodes need new information
     flags.set_flag('slurm.dbd_host_updated')
 
-@reactive.when_file_changed('%s/slurm-%s.conf' % (helpers.SLURM_CONFIG_DIR, hookenv.config().get('clustername')))
+
+@reactive.when('slurm.installed')
 def included_config_changed():
-    # Seems it is not possible to have a @when('leadership.is_leader') together with when_file_changed()
-    if flags.is_flag_set('leadership.is_leader'):
-        hookenv.log('Should restart slurmctld due to changed file %s/slurm-%s.conf on disk' %
-                (helpers.SLURM_CONFIG_DIR, hookenv.config().get('clustername')))
-        flags.set_flag('slurm-controller.reconfigure')
+    '''Rebuild only the include section when an include fragment changed.
+    slurmctld is only restarted if the change touches a parameter that a
+    reconfigure does not apply. Fragments are checked by size and
+    modification time first, so this is cheap enough for every hook, and
+    it follows clustername changes.'''
+    _, _, changed = controller.scan_include_fragments(
+        helpers.SLURM_CONFIG_DIR)
+    if changed:
+        hookenv.log('Include fragments changed: {}'.format(
+            ', '.join(changed)))
+        controller.mark_dirty('include')
+        flags.set_flag('slurm-controller.dirty')
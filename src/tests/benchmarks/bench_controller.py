@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""Benchmark controller hook latency against synthetic clusters.
+
+Runs the reactive handlers with the stand-in Juju agent from stubs.py and
+times configure_controller for a full apply, a no-op relation-changed and a
+single node change, as well as get_partitions, set_node_weight_criteria and
+the slurm.conf render on their own. Agent calls and slurm-cluster payload
+bytes are counted per scenario. The peak RSS of the process is reported
+after each cluster size, so run sizes in ascending order; --memory adds
+the peak of the memory allocated by each scenario (slower).
+
+Usage::
+
+    python3 src/tests/benchmarks/bench_controller.py \\
+        --sizes 10,100,1000,10000 --output bench.json [--compare old.json] \\
+        [--memory]
+
+"""
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import resource
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+import stubs  # noqa: E402
+
+PARTITIONS = 4
+SHAPES = [
+    {'CPUs': '16', 'RealMemory': '64000', 'CoresPerSocket': '8'},
+    {'CPUs': '32', 'RealMemory': '128000', 'CoresPerSocket': '16'},
+    {'CPUs': '64', 'RealMemory': '512000', 'CoresPerSocket': '16'},
+]
+
+
+def synthetic_units(count):
+    units = {}
+    for i in range(count):
+        name = 'node%05d' % i
+        data = {
+            'hostname': name,
+            'partition': 'part%d' % (i % PARTITIONS),
+            'default': i % PARTITIONS == 0,
+            'timelimit': 'INFINITE',
+            'inventory': dict(SHAPES[i % len(SHAPES)], NodeName=name),
+        }
+        unit_name = 'slurm-node/%d' % i
+        units[unit_name] = stubs.Unit(unit_name, data)
+    return units
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def run_hook(reactive, name, relation=None, remote_unit=None, triggers=(),
+             memory=False):
+    stubs.start_hook(name, relation, remote_unit)
+    stubs.FLAGS.difference_update(['config.changed'])
+    stubs.FLAGS.update(triggers)
+    if memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    reactive.configure_controller()
+    # the apply step runs at the end of the hook
+    stubs.end_hook()
+    elapsed = time.perf_counter() - start
+    result = {
+        'seconds': round(elapsed, 5),
+        'agent_calls': sum(stubs.AGENT_CALLS.values()),
+        'agent_calls_by_tool': dict(stubs.AGENT_CALLS),
+        'payload_bytes': stubs.PAYLOAD['bytes'],
+    }
+    if memory:
+        result['peak_alloc_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+    return result
+
+
+def peak_rss_kb():
+    '''Peak resident set size of this process so far.'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def bench_size(reactive, count, memory=False):
+    import charms.slurm.controller as controller
+    stubs.KV.clear()
+    stubs.FLAGS.clear()
+    stubs.FLAGS.update(['endpoint.slurm-cluster.joined', 'slurm.installed',
+                        'munge.configured',
+                        'leadership.set.active_controller'])
+    stubs.LEADER_SETTINGS.clear()
+    stubs.LEADER_SETTINGS.update(active_controller=stubs.LOCAL_UNIT,
+                                 munge_key='bXVuZ2U=')
+    stubs.CONFIG['node_weight_criteria'] = 'RealMemory,CPUs'
+    stubs.CONFIG['compress_hostlists'] = True
+    endpoint = stubs.ClusterEndpoint(synthetic_units(count))
+    stubs.ENDPOINTS['endpoint.slurm-cluster.joined'] = endpoint
+
+    result = {'nodes': count}
+    result['full_apply'] = run_hook(reactive, 'config-changed',
+                                    triggers=['config.changed'],
+                                    memory=memory)
+    some_unit = sorted(endpoint.units)[count // 2]
+    changed = ['endpoint.slurm-cluster.changed']
+    result['noop_changed'] = run_hook(reactive, 'slurm-cluster-relation-'
+                                      'changed', 'slurm-cluster', some_unit,
+                                      changed, memory)
+    unit = endpoint.units[some_unit]
+    data = copy.deepcopy(unit.received)
+    data['inventory']['RealMemory'] = '96000'
+    endpoint.units[some_unit] = stubs.Unit(some_unit, data)
+    result['node_changed'] = run_hook(reactive, 'slurm-cluster-relation-'
+                                      'changed', 'slurm-cluster', some_unit,
+                                      changed, memory)
+
+    nodes = [copy.deepcopy(u.received) for u in endpoint.units.values()]
+    result['get_partitions_s'] = round(
+        timed(controller.get_partitions, nodes), 5)
+    stubs.start_hook('bench')
+    result['set_node_weight_criteria_s'] = round(timed(
+        controller.set_node_weight_criteria, 'RealMemory,CPUs', nodes), 5)
+    partitions = controller.get_partitions(nodes)
+    context = dict(stubs.CONFIG, nodes=nodes, partitions=partitions)
+    result['render_s'] = round(timed(
+        sys.modules['charms.slurm.helpers'].render_slurm_config, context), 5)
+    result['peak_rss_kb'] = peak_rss_kb()
+    return result
+
+
+def compare(results, baseline):
+    old = {r['nodes']: r for r in baseline['results']}
+    for new in results['results']:
+        prev = old.get(new['nodes'])
+        if not prev:
+            continue
+        for key in ('full_apply', 'noop_changed', 'node_changed'):
+            print('{:>6} nodes {:<13} {:>9.4f}s -> {:>9.4f}s  calls {:>6} '
+                  '-> {:>6}'.format(new['nodes'], key, prev[key]['seconds'],
+                                    new[key]['seconds'],
+                                    prev[key]['agent_calls'],
+                                    new[key]['agent_calls']))
+        if 'peak_rss_kb' in prev:
+            print('{:>6} nodes peak RSS    {:>9} kB -> {:>9} kB'.format(
+                new['nodes'], prev['peak_rss_kb'], new['peak_rss_kb']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='10,100,1000,10000')
+    parser.add_argument('--output', help='write results as JSON')
+    parser.add_argument('--compare', help='JSON results to compare with')
+    parser.add_argument('--memory', action='store_true',
+                        help='trace the memory allocated per scenario')
+    args = parser.parse_args()
+
+    render_dir = tempfile.mkdtemp(prefix='bench-slurm-controller-')
+    reactive = stubs.install(render_dir)
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': [bench_size(reactive, int(size), args.memory)
+                    for size in args.sizes.split(',')],
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""Benchmark hostlist compression on synthetic 10k-node inventories.
+
+Run with ``python3 src/tests/benchmarks/bench_hostlist.py [nodes]``.
+"""
+import os
+import sys
+import json
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'lib'))
+
+import charms.slurm.hostlist as hostlist  # noqa: E402
+
+SHAPES = [
+    {'CPUs': '16', 'RealMemory': '64000', 'CoresPerSocket': '8'},
+    {'CPUs': '32', 'RealMemory': '128000', 'CoresPerSocket': '16'},
+    {'CPUs': '64', 'RealMemory': '512000', 'CoresPerSocket': '16'},
+]
+
+
+def synthetic_nodes(count, seed=0):
+    rng = random.Random(seed)
+    nodes = []
+    for i in range(count):
+        name = 'node%05d' % i
+        shape = SHAPES[i * len(SHAPES) // count]
+        # sprinkle a few odd nodes so that groups are not perfectly contiguous
+        if rng.random() < 0.01:
+            shape = dict(shape, RealMemory='96000')
+        nodes.append({
+            'hostname': name,
+            'partition': 'part%d' % (i % 4),
+            'default': i % 4 == 0,
+            'timelimit': 'INFINITE',
+            'inventory': dict(shape, NodeName=name, Weight='1'),
+        })
+    return nodes
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main(count):
+    nodes = synthetic_nodes(count)
+    names = [n['hostname'] for n in nodes]
+    compressed, t_compress = timed(hostlist.compress, names)
+    _, t_expand = timed(hostlist.expand, compressed)
+    grouped, t_group = timed(hostlist.group_nodes, nodes)
+    _, t_ungroup = timed(hostlist.expand_nodes, grouped)
+    results = {
+        'nodes': count,
+        'compress_s': round(t_compress, 4),
+        'expand_s': round(t_expand, 4),
+        'group_nodes_s': round(t_group, 4),
+        'expand_nodes_s': round(t_ungroup, 4),
+        'nodename_lines': len(grouped),
+        'flat_bytes': len(json.dumps(nodes)),
+        'grouped_bytes': len(json.dumps(grouped)),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
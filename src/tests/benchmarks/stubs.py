@@ -0,0 +1,292 @@
+"""Local stand-in for the Juju agent and the layers the controller uses.
+
+Installs fake ``charmhelpers``, ``charms.reactive``, ``charms.leadership``
+and ``charms.slurm.helpers`` modules so that the reactive handlers can run
+outside of a Juju unit. Every call that would be a hook tool round-trip is
+counted in ``AGENT_CALLS`` and every byte sent over slurm-cluster in
+``PAYLOAD``.
+"""
+import os
+import sys
+import json
+import types
+import collections
+
+import yaml
+
+SRC = os.path.join(os.path.dirname(__file__), '..', '..')
+LOCAL_UNIT = 'slurm-controller/0'
+
+AGENT_CALLS = collections.Counter()
+PAYLOAD = collections.Counter()
+# last workload status set
+STATUS = {}
+
+
+class Hook(object):
+    '''State of the simulated hook, reset by start_hook().'''
+    name = 'config-changed'
+    relation = None
+    remote_unit = None
+    atexit = []
+
+
+# callbacks registered with hookenv.atstart, run by every start_hook() like
+# at the start of each charm process
+ATSTART = []
+
+
+FLAGS = set()
+LEADER_SETTINGS = {}
+KV = {}
+CONFIG = {}
+RENDER_DIR = None
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+def _tool(name, result=None):
+    def call(*args, **kwargs):
+        AGENT_CALLS[name] += 1
+        return result() if callable(result) else result
+    return call
+
+
+def _decorator(*args, **kwargs):
+    return lambda func: func
+
+
+class Storage(object):
+    '''In-memory unitdata.kv() that serializes like the sqlite one.'''
+
+    def get(self, key, default=None):
+        return json.loads(KV[key]) if key in KV else default
+
+    def set(self, key, value):
+        KV[key] = json.dumps(value)
+
+    def unset(self, key):
+        KV.pop(key, None)
+
+    def flush(self):
+        pass
+
+
+class Unit(object):
+
+    def __init__(self, unit_name, data):
+        self.unit_name = unit_name
+        self.received = data
+        self._raw = {k: json.dumps(v) for k, v in data.items()}
+
+    @property
+    def received_raw(self):
+        AGENT_CALLS['relation-get'] += 1
+        return self._raw
+
+
+class Relation(object):
+
+    def __init__(self, relation_id):
+        self.relation_id = relation_id
+
+
+class ClusterEndpoint(object):
+    '''slurm-cluster endpoint with synthetic node units.'''
+
+    endpoint_name = 'slurm-cluster'
+
+    def __init__(self, units):
+        self.units = units
+        self.relations = [Relation('slurm-cluster:1')]
+
+    @property
+    def all_joined_units(self):
+        AGENT_CALLS['relation-list'] += 1
+        return list(self.units.values())
+
+    def get_node_data(self):
+        return [u.received for u in self.all_joined_units]
+
+    def network_details(self):
+        AGENT_CALLS['network-get'] += 1
+        return {'hostname': 'controller-0', 'ingress_address': '10.0.0.1'}
+
+    def send_controller_config(self, conf):
+        AGENT_CALLS['relation-set'] += 1
+        PAYLOAD['bytes'] += len(json.dumps(conf, default=str))
+        PAYLOAD['sends'] += 1
+
+
+ENDPOINTS = {}
+
+
+def _render_slurm_config(context, active_controller=False):
+    '''Approximation of the layer:slurm slurm.conf template.'''
+    path = os.path.join(RENDER_DIR, 'slurm.conf')
+    with open(path, 'w') as f:
+        for key in sorted(k for k, v in context.items()
+                          if not isinstance(v, (list, dict))):
+            f.write('{}={}\n'.format(key, context[key]))
+        for node in context['nodes']:
+            f.write('NodeName={} {}\n'.format(
+                node['inventory']['NodeName'],
+                ' '.join('{}={}'.format(k, v) for k, v in
+                         sorted(node['inventory'].items())
+                         if k != 'NodeName')))
+        for name, partition in sorted(context['partitions'].items()):
+            f.write('PartitionName={} Nodes={} Default={}\n'.format(
+                name, ','.join(partition['hosts']),
+                'YES' if partition['default'] else 'NO'))
+    return path
+
+
+def _write_file(path, content, owner='root', group='root', perms=0o444):
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+def _status_set(workload_state, message):
+    AGENT_CALLS['status-set'] += 1
+    STATUS.update(state=workload_state, message=message)
+
+
+def _load_config():
+    with open(os.path.join(SRC, 'config.yaml')) as f:
+        options = yaml.safe_load(f)['options']
+    return {k: v.get('default') for k, v in options.items()}
+
+
+def _goal_state():
+    AGENT_CALLS['goal-state'] += 1
+    units = ENDPOINTS.get('endpoint.slurm-cluster.joined')
+    return {'relations': {'slurm-cluster': {
+        name: {'status': 'active'} for name in (units.units if units else [])
+    }}}
+
+
+def install(render_dir):
+    """Install the stand-in modules and import the reactive layer.
+
+    :return: the imported reactive module
+    """
+    global RENDER_DIR
+    RENDER_DIR = render_dir
+    if 'slurm_controller' in sys.modules:
+        sys.modules['charms.slurm.helpers'].SLURM_CONFIG_DIR = render_dir
+        return sys.modules['slurm_controller']
+    CONFIG.update(_load_config())
+    sys.path.insert(0, os.path.join(SRC, 'lib'))
+
+    hookenv = _module(
+        'charmhelpers.core.hookenv',
+        DEBUG='DEBUG', INFO='INFO', WARNING='WARNING', ERROR='ERROR',
+        log=_tool('juju-log'),
+        status_set=_status_set,
+        config=_tool('config-get', lambda: dict(CONFIG)),
+        local_unit=lambda: LOCAL_UNIT,
+        hook_name=lambda: Hook.name,
+        relation_type=lambda: Hook.relation,
+        remote_unit=lambda: Hook.remote_unit,
+        leader_get=_tool('leader-get', lambda: dict(LEADER_SETTINGS)),
+        goal_state=_goal_state,
+        atexit=lambda func, *a, **kw: Hook.atexit.append((func, a, kw)),
+        atstart=lambda func, *a, **kw: ATSTART.append((func, a, kw)),
+        open_port=_tool('open-port'),
+        close_port=_tool('close-port'),
+        relation_set=_tool('relation-set'),
+        charm_dir=lambda: SRC,
+        unit_private_ip=lambda: '10.0.0.1',
+    )
+    host = _module(
+        'charmhelpers.core.host',
+        service_restart=_tool('service-restart', True),
+        service_stop=_tool('service-stop', True),
+        service_running=lambda name: True,
+        write_file=_write_file,
+        mkdir=lambda path, *args, **kwargs: os.makedirs(path, exist_ok=True),
+    )
+    unitdata = _module('charmhelpers.core.unitdata', kv=Storage)
+    core = _module('charmhelpers.core', hookenv=hookenv, host=host,
+                   unitdata=unitdata)
+    _module('charmhelpers', core=core)
+
+    def leader_get(attribute=None):
+        AGENT_CALLS['leader-get'] += 1
+        return (dict(LEADER_SETTINGS) if attribute is None
+                else LEADER_SETTINGS.get(attribute))
+
+    def leader_set(settings=None, **kwargs):
+        AGENT_CALLS['leader-set'] += 1
+        LEADER_SETTINGS.update(settings or {}, **kwargs)
+
+    _module('charms.leadership', leader_get=leader_get,
+            leader_set=leader_set)
+
+    flags = _module(
+        'charms.reactive.flags',
+        register_trigger=lambda **kwargs: None,
+        set_flag=FLAGS.add,
+        clear_flag=FLAGS.discard,
+        is_flag_set=lambda flag: flag in FLAGS,
+    )
+    bus = _module('charms.reactive.bus', Handler=type(
+        'Handler', (object,), {'invoke': lambda self: None,
+                               'test': lambda self: True}))
+    relations = _module('charms.reactive.relations',
+                        endpoint_from_flag=ENDPOINTS.get)
+    _module('charms.reactive', flags=flags, relations=relations, bus=bus,
+            endpoint_from_flag=ENDPOINTS.get, hook=_decorator,
+            when=_decorator, when_not=_decorator, when_any=_decorator,
+            when_all=_decorator, when_file_changed=_decorator)
+    _module('charms.slurm.helpers',
+            SLURM_CONFIG_DIR=render_dir,
+            SLURMCTLD_SERVICE='slurmctld',
+            create_state_save_location=lambda context: None,
+            render_slurm_config=_render_slurm_config)
+
+    import charms.slurm.controller as controller
+    controller.reconfigure_slurmctld = _tool('scontrol', True)
+    controller.slurmctld_ready = _tool('scontrol', True)
+
+    sys.path.insert(0, os.path.join(SRC, 'reactive'))
+    import slurm_controller
+    return slurm_controller
+
+
+def reset():
+    '''Forget the unit, leadership, flag and config state, e.g. between
+    tests.'''
+    KV.clear()
+    FLAGS.clear()
+    LEADER_SETTINGS.clear()
+    ENDPOINTS.clear()
+    STATUS.clear()
+    CONFIG.clear()
+    CONFIG.update(_load_config())
+
+
+def start_hook(name, relation=None, remote_unit=None):
+    '''Begin a simulated hook, i.e. a fresh charm process.'''
+    import charms.slurm.controller as controller
+    Hook.name, Hook.relation, Hook.remote_unit = name, relation, remote_unit
+    Hook.atexit = []
+    controller.invalidate()
+    controller._agent_calls.clear()
+    controller._scheduled.clear()
+    AGENT_CALLS.clear()
+    PAYLOAD.clear()
+    for func, args, kwargs in ATSTART:
+        func(*args, **kwargs)
+
+
+def end_hook():
+    # last in, first out like charmhelpers
+    for func, args, kwargs in reversed(Hook.atexit):
+        func(*args, **kwargs)
+    Hook.atexit = []
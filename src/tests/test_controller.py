@@ -0,0 +1,476 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'benchmarks'))
+
+import stubs  # noqa: E402
+
+reactive = stubs.install(tempfile.mkdtemp(prefix='test-slurm-controller-'))
+
+import charms.slurm.controller as controller  # noqa: E402
+
+NODES = [{'hostname': 'node%d' % i, 'partition': 'batch', 'default': True,
+          'timelimit': 'INFINITE',
+          'inventory': {'NodeName': 'node%d' % i, 'CPUs': '4'}}
+         for i in (1, 2)]
+
+
+@pytest.fixture(autouse=True)
+def unit():
+    stubs.reset()
+    stubs.start_hook('config-changed')
+
+
+def _node_unit(i, **data):
+    name = 'node%d' % i
+    data = dict({'hostname': name, 'partition': 'batch', 'default': True,
+                 'timelimit': 'INFINITE',
+                 'inventory': {'NodeName': name, 'CPUs': '4'}}, **data)
+    return stubs.Unit('slurm-node/%d' % i, data)
+
+
+def _deploy(*units, leader=True):
+    """Set up a configurable active controller with the given node units.
+
+    :return: the slurm-cluster endpoint
+    """
+    stubs.FLAGS.update(reactive.APPLY_FLAGS)
+    if leader:
+        stubs.FLAGS.add('leadership.is_leader')
+    stubs.LEADER_SETTINGS.update(active_controller=stubs.LOCAL_UNIT,
+                                 munge_key='bXVuZ2U=')
+    endpoint = stubs.ClusterEndpoint({u.unit_name: u for u in units})
+    stubs.ENDPOINTS['endpoint.slurm-cluster.joined'] = endpoint
+    return endpoint
+
+
+def _hook(name, *triggers, **kwargs):
+    '''Run a hook that sets triggers, with the apply at its end.'''
+    stubs.start_hook(name, kwargs.get('relation'), kwargs.get('remote_unit'))
+    stubs.FLAGS.update(triggers)
+    reactive.configure_controller()
+    stubs.end_hook()
+    stubs.FLAGS.discard('config.changed')
+
+
+def test_config_is_read_once_per_hook():
+    assert controller.config()['clustername'] == \
+        controller.config()['clustername']
+    assert stubs.AGENT_CALLS['config-get'] == 1
+    assert controller.agent_calls()['config-get'] == 1
+
+    # a new hook reads it again
+    stubs.CONFIG['clustername'] = 'cluster2'
+    stubs.start_hook('config-changed')
+    assert controller.config()['clustername'] == 'cluster2'
+    assert stubs.AGENT_CALLS['config-get'] == 1
+
+
+def test_leader_get_is_invalidated_by_leader_set():
+    stubs.LEADER_SETTINGS.update(munge_key='a2V5', dbd_host='dbd-0')
+    assert controller.leader_get('munge_key') == 'a2V5'
+    assert controller.leader_get('dbd_host') == 'dbd-0'
+    assert controller.leader_get() == {'munge_key': 'a2V5',
+                                       'dbd_host': 'dbd-0'}
+    # a single leader-get for all settings
+    assert stubs.AGENT_CALLS['leader-get'] == 1
+
+    controller.leader_set(dbd_host='dbd-1')
+    assert controller.leader_get('dbd_host') == 'dbd-1'
+    assert stubs.AGENT_CALLS['leader-get'] == 2
+    calls = controller.agent_calls()
+    assert (calls['leader-get'], calls['leader-set']) == (2, 1)
+
+
+def test_agent_calls_are_reported_once_at_hook_end():
+    controller.config()
+    controller.leader_get()
+    controller.leader_get('munge_key')
+    assert [func for func, _, _ in stubs.Hook.atexit].count(
+        controller.report_agent_calls) == 1
+    stubs.end_hook()
+    stubs.start_hook('update-status')
+    assert 'leader-get' not in controller.agent_calls()
+
+
+def _context(**kwargs):
+    context = {'clustername': 'cluster1', 'slurmctld_port': 6817,
+               'scheduler_parameters': '', 'ready_timeout': 120,
+               'include': 'SchedulerParameters=defer\n'
+                          'PartitionName=debug Nodes=node1\n',
+               'nodes': NODES}
+    context.update(kwargs)
+    return context
+
+
+def _apply(context):
+    digests = controller.context_digests(context)
+    controller.save_applied_config(
+        controller.config_fingerprint(digests, True), digests, context)
+    return controller.applied_context()
+
+
+def test_needs_restart_by_key_class():
+    old = _apply(_context())
+    assert controller.needs_restart(None, _context())
+    assert not controller.needs_restart(old, _context())
+    # live on reconfigure
+    assert not controller.needs_restart(
+        old, _context(scheduler_parameters='bf_continue'))
+    # restart only and unclassified keys
+    assert controller.needs_restart(old, _context(slurmctld_port='6817-6820'))
+    assert controller.needs_restart(old, _context(new_parameter='x'))
+
+
+def test_charm_only_keys_are_left_out():
+    old = _apply(_context())
+    context = _context(ready_timeout=30, metrics_history_size=10,
+                       node_batch_max_wait=0, debug_log_file='/tmp/x',
+                       topology_map='leaf1=node1', topology_subnet_prefix=16)
+    digests = controller.context_digests(context)
+    assert 'ready_timeout' not in digests
+    assert controller.config_fingerprint(digests, True) == \
+        controller.config_fingerprint(
+            controller.context_digests(_context()), True)
+    assert not controller.needs_restart(old, context, digests)
+
+
+def test_needs_restart_for_changed_node_set():
+    old = _apply(_context())
+    weighted = [dict(n, inventory=dict(n['inventory'], Weight='2'))
+                for n in NODES]
+    assert not controller.needs_restart(old, _context(nodes=weighted))
+    assert controller.needs_restart(old, _context(nodes=NODES[:1]))
+
+
+def test_node_changes_across_node9_node10_reconfigure():
+    nodes = [dict(NODES[0], hostname='node%d' % i,
+                  inventory={'NodeName': 'node%d' % i, 'CPUs': '4'})
+             for i in range(1, 13)]
+    old = _apply(_context(nodes=nodes))
+    bigger = [dict(n, inventory=dict(n['inventory'], CPUs='16'))
+              for n in nodes]
+    assert not controller.needs_restart(old, _context(nodes=bigger))
+    assert controller.needs_restart(old, _context(nodes=nodes[:11]))
+
+
+def test_needs_restart_for_include_parameters():
+    old = _apply(_context())
+    # partitions and live parameters are applied with a reconfigure
+    assert not controller.needs_restart(old, _context(
+        include='SchedulerParameters=bf_continue\n'
+                'PartitionName=debug Nodes=node[1-2]\n'))
+    assert not controller.needs_restart(old, _context(
+        include='SchedulerParameters=defer\n'))
+    # restart only parameters are not
+    assert controller.needs_restart(old, _context(
+        include=_context()['include'] + 'SlurmctldPort=7000\n'))
+    assert controller.needs_restart(old, _context(
+        include=_context()['include'] + 'NodeName=gpu1 CPUs=8\n'))
+
+
+class Endpoint(object):
+    '''slurm-cluster endpoint keeping the published relation data.'''
+
+    def __init__(self, relation_ids=('slurm-cluster:1',)):
+        self.relations = [stubs.Relation(r) for r in relation_ids]
+        self.data = {}
+        self.sent = []
+
+    def send_controller_config(self, payload):
+        self.sent.append(dict(payload))
+        for key, value in payload.items():
+            if value is None:
+                self.data.pop(key, None)
+            else:
+                self.data[key] = value
+
+    def received(self):
+        '''What a node sees, with the compressed keys decoded.'''
+        return {k: controller.decode_value(v) for k, v in self.data.items()}
+
+
+PUBLISHED = {'clustername': 'cluster1', 'slurmctld_port': 6817,
+             'nodes': NODES, 'partitions': {'batch': {'hosts': ['node1']}}}
+
+
+def test_encode_round_trip():
+    encoded = controller.encode_value(PUBLISHED['nodes'])
+    assert encoded.startswith(controller.COMPRESSED_PREFIX)
+    assert controller.decode_value(encoded) == PUBLISHED['nodes']
+    assert controller.decode_value('plain') == 'plain'
+    assert controller.decode_value(6817) == 6817
+
+
+def test_delta_publishes_changed_keys_only():
+    endpoint = Endpoint()
+    assert controller.publish_controller_config(endpoint, PUBLISHED, True)
+    first = endpoint.sent[-1]
+    assert first['config_generation'] == 1
+    assert first['config_compressed_keys'] == ['nodes', 'partitions']
+    assert first['nodes'].startswith(controller.COMPRESSED_PREFIX)
+    received = endpoint.received()
+    assert received['nodes'] == NODES
+    assert received['clustername'] == 'cluster1'
+
+    # nothing changed, nothing sent
+    assert controller.publish_controller_config(
+        endpoint, PUBLISHED, True) == 0
+    assert len(endpoint.sent) == 1
+
+    conf = dict(PUBLISHED, slurmctld_port=6818)
+    controller.publish_controller_config(endpoint, conf, True)
+    assert endpoint.sent[-1] == {
+        'slurmctld_port': 6818, 'config_generation': 2,
+        'config_compressed_keys': ['nodes', 'partitions']}
+
+    # a new relation gets everything
+    endpoint.relations.append(stubs.Relation('slurm-cluster:2'))
+    controller.publish_controller_config(endpoint, conf, True)
+    assert set(endpoint.sent[-1]) >= set(conf)
+
+
+def test_delta_clears_removed_keys():
+    endpoint = Endpoint()
+    controller.publish_controller_config(endpoint, PUBLISHED, True)
+    conf = {k: v for k, v in PUBLISHED.items() if k != 'partitions'}
+    controller.publish_controller_config(endpoint, conf, True)
+    assert endpoint.sent[-1]['partitions'] is None
+    assert endpoint.sent[-1]['config_compressed_keys'] == ['nodes']
+    assert 'partitions' not in endpoint.data
+
+
+def test_switching_publish_modes():
+    endpoint = Endpoint()
+    controller.publish_controller_config(endpoint, PUBLISHED, True)
+    # full mode sends plain values and clears the delta bookkeeping
+    controller.publish_controller_config(endpoint, PUBLISHED, False)
+    assert endpoint.data == PUBLISHED
+    # back to delta starts over with everything
+    controller.publish_controller_config(endpoint, PUBLISHED, True)
+    assert set(endpoint.sent[-1]) == set(PUBLISHED) | {
+        'config_generation', 'config_compressed_keys'}
+    assert endpoint.received() == dict(
+        PUBLISHED, config_generation=2,
+        config_compressed_keys=['nodes', 'partitions'])
+
+    # keys of the previous config are cleared after a switch, e.g. to
+    # configless mode
+    configless = controller.configless_config(PUBLISHED)
+    controller.publish_controller_config(endpoint, configless, False)
+    assert endpoint.data == configless
+
+
+def test_unchanged_hook_skips_render_restart_and_publish(monkeypatch):
+    endpoint = _deploy(_node_unit(1), _node_unit(2))
+    renders = []
+    monkeypatch.setattr(reactive.helpers, 'render_slurm_config',
+                        lambda **kwargs: renders.append(kwargs))
+    _hook('config-changed', 'config.changed')
+    assert len(renders) == 1
+    assert stubs.AGENT_CALLS['service-restart'] == 1
+    assert stubs.PAYLOAD['sends'] == 1
+
+    # a relation-changed with the same node data changes nothing
+    _hook('slurm-cluster-relation-changed', 'endpoint.slurm-cluster.changed',
+          relation='slurm-cluster', remote_unit='slurm-node/1')
+    assert len(renders) == 1
+    assert stubs.AGENT_CALLS['service-restart'] == 0
+    assert stubs.AGENT_CALLS['scontrol'] == 0
+    assert not stubs.PAYLOAD.get('sends')
+
+    # a departed node changes the node set: render, restart and publish
+    del endpoint.units['slurm-node/2']
+    _hook('slurm-cluster-relation-departed',
+          'endpoint.slurm-cluster.changed', relation='slurm-cluster',
+          remote_unit='slurm-node/2')
+    assert len(renders) == 2
+    assert [n['hostname'] for n in renders[-1]['context']['nodes']] == \
+        ['node1']
+    assert stubs.AGENT_CALLS['service-restart'] == 1
+    assert stubs.PAYLOAD['sends'] == 1
+
+
+def test_node_change_is_kept_until_applied():
+    endpoint = _deploy(_node_unit(1), _node_unit(2))
+    _hook('config-changed', 'config.changed')
+
+    # node1 changes in a hook that cannot apply, munge is not ready
+    stubs.FLAGS.discard('munge.configured')
+    endpoint.units['slurm-node/1'] = _node_unit(1, inventory={
+        'NodeName': 'node1', 'CPUs': '16'})
+    stubs.start_hook('slurm-cluster-relation-changed', 'slurm-cluster',
+                     'slurm-node/1')
+    reactive.note_node_change()
+    stubs.FLAGS.add('endpoint.slurm-cluster.changed')
+    stubs.end_hook()
+
+    # a later hook of another unit applies it
+    stubs.FLAGS.add('munge.configured')
+    _hook('slurm-cluster-relation-changed', relation='slurm-cluster',
+          remote_unit='slurm-node/2')
+    cpus = {n['hostname']: n['inventory']['CPUs']
+            for n in controller.context_sections()['nodes']['nodes']}
+    assert cpus == {'node1': '16', 'node2': '4'}
+
+
+def test_managed_parameters_go_to_the_include():
+    include = controller.managed_include({
+        'scheduler_parameters': 'bf_continue', 'max_job_count': 50000,
+        'jobcomp_type': 'jobcomp/filetxt', 'tree_width': '',
+        'include': 'SchedulerParameters=defer\n'})['include']
+    # the operator's fragments come last and win
+    assert include.splitlines()[1:] == [
+        'SchedulerParameters=bf_continue', 'MaxJobCount=50000',
+        'JobCompType=jobcomp/filetxt', 'SchedulerParameters=defer']
+    assert controller.managed_include({'include': 'x'}) == {}
+
+
+def test_configless_renders_enable_configless(monkeypatch):
+    stubs.CONFIG['configless'] = True
+    _deploy(_node_unit(1))
+    renders = []
+    monkeypatch.setattr(reactive.helpers, 'render_slurm_config',
+                        lambda **kwargs: renders.append(kwargs))
+    _hook('config-changed', 'config.changed')
+    include = renders[-1]['context']['include'].splitlines()
+    assert 'SlurmctldParameters=enable_configless' in include
+
+
+def test_node_batch_opens_on_scale_out_only():
+    # 21 units expected, one of them never reports
+    assert controller.node_batch_pending(10, 21, 600, 60, now=0)
+    assert controller.node_batch_pending(20, 21, 600, 60, now=30)
+    # cut short after settle
+    assert not controller.node_batch_pending(20, 21, 600, 60, now=90)
+    # and not opened again for the same units
+    assert not controller.node_batch_pending(20, 21, 600, 60, now=100)
+    assert not controller.node_batch_pending(20, 21, 600, 60, now=1000)
+    # until more units are expected
+    assert controller.node_batch_pending(20, 25, 600, 60, now=1010)
+    assert not controller.node_batch_pending(24, 25, 600, 60, now=1700)
+    assert not controller.node_batch_pending(24, 25, 600, 60, now=1710)
+
+
+def test_node_batch_disabled():
+    assert not controller.node_batch_pending(1, 2, 0, 60, now=0)
+    assert not controller.node_batch_pending(1, None, 600, 60, now=0)
+
+
+def test_batched_apply_keeps_controller_configured():
+    endpoint = _deploy(_node_unit(1), _node_unit(2))
+    _hook('config-changed', 'config.changed')
+    assert 'slurm-controller.configured' in stubs.FLAGS
+    fingerprint = stubs.KV[controller.FINGERPRINT_KEY]
+
+    # a third unit joins but has not reported its inventory yet
+    endpoint.units['slurm-node/3'] = stubs.Unit('slurm-node/3', {})
+    _hook('slurm-cluster-relation-joined', 'endpoint.slurm-cluster.changed',
+          relation='slurm-cluster', remote_unit='slurm-node/3')
+    assert 'slurm-controller.node_batch_pending' in stubs.FLAGS
+    assert 'slurm-controller.configured' in stubs.FLAGS
+    assert stubs.STATUS == {'state': 'waiting',
+                            'message': 'Waiting for 2/3 nodes'}
+    assert stubs.KV[controller.FINGERPRINT_KEY] == fingerprint
+
+    endpoint.units['slurm-node/3'] = _node_unit(3)
+    _hook('slurm-cluster-relation-changed',
+          'endpoint.slurm-cluster.changed', relation='slurm-cluster',
+          remote_unit='slurm-node/3')
+    assert 'slurm-controller.node_batch_pending' not in stubs.FLAGS
+    assert stubs.STATUS['state'] == 'active'
+    assert controller.applied_context()['node_names'] == ['node[1-3]']
+
+
+def test_publish_waits_for_restarted_slurmctld(monkeypatch):
+    _deploy(_node_unit(1))
+    stubs.CONFIG['ready_timeout'] = 0
+    monkeypatch.setattr(controller, 'slurmctld_ready',
+                        lambda port, role: False)
+    _hook('config-changed', 'config.changed')
+    assert 'slurm-controller.publish_pending' in stubs.FLAGS
+    # slurmctld runs the config, only the nodes are not told yet
+    assert 'slurm-controller.configured' in stubs.FLAGS
+    assert stubs.STATUS == {'state': 'waiting',
+                            'message': 'Waiting for slurmctld to become '
+                                       'ready'}
+    assert not stubs.PAYLOAD.get('sends')
+
+    # a later hook finds it ready and publishes without a restart
+    monkeypatch.setattr(controller, 'slurmctld_ready',
+                        lambda port, role: True)
+    _hook('update-status')
+    assert 'slurm-controller.publish_pending' not in stubs.FLAGS
+    assert 'slurm-controller.configured' in stubs.FLAGS
+    assert stubs.PAYLOAD['sends'] == 1
+    assert stubs.STATUS['state'] == 'active'
+
+
+def test_decision_log_detail_file_is_rotated(tmpdir, monkeypatch):
+    path = str(tmpdir.join('decisions.log'))
+    monkeypatch.setattr(controller.DecisionLog, 'MAX_DETAIL_BYTES', 200)
+    decisions = controller.DecisionLog('weights', detail_file=path)
+    for run in range(10):
+        for i in range(5):
+            decisions.record('node%d' % i, 'Weight=%d' % run)
+        decisions.flush()
+    assert os.path.getsize(path) < 400
+    assert os.path.exists(path + '.1')
+    with open(path) as f:
+        assert 'node4: Weight=9' in f.read()
+    assert not os.path.exists(path + '.2')
+
+
+def test_backup_controller_follows_leader_dbd_settings():
+    _deploy(_node_unit(1), leader=False)
+    stubs.LEADER_SETTINGS['active_controller'] = 'slurm-controller/1'
+    _hook('config-changed', 'config.changed')
+    assert controller.context_sections()['dbd'] == {}
+
+    # the leader stored the settings of a joined slurmdbd
+    stubs.LEADER_SETTINGS.update(dbd_host='dbd-0', dbd_port='6819',
+                                 dbd_ipaddr='10.0.0.9')
+    stubs.FLAGS.add('endpoint.slurm-dbd-consumer.joined')
+    _hook('leader-settings-changed', 'leadership.changed.dbd_host',
+          'leadership.changed.dbd_port', 'leadership.changed.dbd_ipaddr')
+    assert controller.context_sections()['dbd'] == {
+        'dbd_host': 'dbd-0', 'dbd_port': '6819', 'dbd_ipaddr': '10.0.0.9'}
+
+    stubs.FLAGS.discard('endpoint.slurm-dbd-consumer.joined')
+    _hook('slurm-dbd-consumer-relation-departed',
+          'endpoint.slurm-dbd-consumer.departed')
+    assert controller.context_sections()['dbd'] == {}
+    assert 'endpoint.slurm-dbd-consumer.departed' not in stubs.FLAGS
+
+
+def test_munge_key_follows_leader():
+    _deploy(_node_unit(1))
+    _hook('config-changed', 'config.changed')
+    stubs.LEADER_SETTINGS['munge_key'] = 'bmV3'
+    _hook('leader-settings-changed', 'leadership.changed.munge_key')
+    assert controller.context_sections()['munge'] == {'munge_key': 'bmV3'}
+
+
+class HAEndpoint(object):
+
+    def __init__(self, **peer_data):
+        self.peer_data = peer_data
+
+
+def test_failover_probe_does_not_need_configured(monkeypatch):
+    _deploy(_node_unit(1))
+    stubs.ENDPOINTS['endpoint.slurm-controller-ha.joined'] = HAEndpoint(
+        hostname='ctl-1', unit_name='slurm-controller/1')
+    # the restarted active controller never came back
+    monkeypatch.setattr(controller, 'ping_slurmctld', lambda timeout: {
+        'primary': {'host': 'ctl-0', 'up': False},
+        'backup': {'host': 'ctl-1', 'up': True}})
+    assert 'slurm-controller.configured' not in stubs.FLAGS
+    for _ in range(stubs.CONFIG['failover_probe_failures']):
+        stubs.start_hook('update-status')
+        reactive.probe_active_controller()
+    assert stubs.LEADER_SETTINGS['active_controller'] == 'slurm-controller/1'
+    assert 'slurm-controller.dirty' in stubs.FLAGS
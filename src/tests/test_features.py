@@ -0,0 +1,59 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+import charms.slurm.features as features  # noqa: E402
+import charms.slurm.hostlist as hostlist  # noqa: E402
+
+RULES = ('RealMemory>=262144:bigmem CPUs<32:small cpu_model~epyc:epyc '
+         'cpu_flags~avx512:avx512 CoresPerSocket:cores{}')
+
+
+def _node(name, memory, cpus, cores, **inventory):
+    inventory.update(NodeName=name, RealMemory=str(memory), CPUs=str(cpus),
+                     CoresPerSocket=str(cores))
+    return {'hostname': name, 'partition': 'batch', 'default': True,
+            'timelimit': 'INFINITE', 'inventory': inventory}
+
+
+def test_node_features():
+    rules = features.parse_rules(RULES)
+    values = {'RealMemory': '524288', 'CPUs': '128', 'CoresPerSocket': '64',
+              'cpu_model': 'AMD EPYC 7763', 'cpu_flags': 'fpu sse avx2'}
+    assert features.node_features(values, rules) == ['bigmem', 'epyc',
+                                                     'cores64']
+    values = {'RealMemory': '64000', 'CPUs': '16', 'cpu_flags': 'avx512f'}
+    assert features.node_features(values, rules) == ['small', 'avx512']
+
+
+def test_string_comparison_and_bad_values():
+    rules = features.parse_rules('Arch=x86_64:x86 CPUs>=8:many')
+    assert features.node_features({'Arch': 'x86_64', 'CPUs': 'n/a'},
+                                  rules) == ['x86']
+
+
+def test_bad_rules():
+    for text in ('RealMemory>=1', 'RealMemory>=1:bad/name', 'a:{x}'):
+        with pytest.raises(ValueError):
+            features.parse_rules(text)
+
+
+def test_features_render_as_compressed_groups():
+    nodes = [_node('node%02d' % i, 512000 if i >= 4 else 64000, 64, 16)
+             for i in range(8)]
+    nodes[0]['inventory']['Features'] = 'ib'
+    attributes = {'node%02d' % i: {'cpu_flags': 'avx512f'}
+                  for i in range(2, 8)}
+    rules = features.parse_rules(RULES)
+    assert features.set_features(nodes, attributes, rules) == 8
+    grouped = {n['inventory']['NodeName']: n['inventory']['Features']
+               for n in hostlist.group_nodes(nodes)}
+    assert grouped == {
+        'node00': 'ib,cores16',
+        'node01': 'cores16',
+        'node[02-03]': 'avx512,cores16',
+        'node[04-07]': 'bigmem,avx512,cores16',
+    }
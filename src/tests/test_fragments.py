@@ -0,0 +1,77 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+import charms.slurm.fragments as fragments  # noqa: E402
+
+
+def _write(path, text, mtime=None):
+    path.write(text, ensure=True)
+    if mtime is not None:
+        os.utime(str(path), ns=(mtime, mtime))
+
+
+def test_fragment_order(tmpdir):
+    _write(tmpdir.join('slurm.conf.d', '20-b.conf'), 'B=1')
+    _write(tmpdir.join('slurm.conf.d', '10-a.conf'), 'A=1\n')
+    _write(tmpdir.join('slurm.conf.d', 'notes.txt'), 'ignored')
+    _write(tmpdir.join('slurm-cluster.conf'), 'C=1\n')
+    paths = fragments.fragment_paths(str(tmpdir), 'cluster')
+    assert [os.path.basename(p) for p in paths] == [
+        'slurm-cluster.conf', '10-a.conf', '20-b.conf']
+    cache, changed = fragments.scan(paths, {})
+    assert changed == sorted(paths)
+    assert fragments.include_text(paths, cache) == 'C=1\nA=1\nB=1\n'
+
+
+def test_only_changed_fragments_are_reported(tmpdir):
+    a = tmpdir.join('slurm.conf.d', 'a.conf')
+    b = tmpdir.join('slurm.conf.d', 'b.conf')
+    _write(a, 'A=1\n', 10 ** 9)
+    _write(b, 'B=1\n', 10 ** 9)
+    paths = fragments.fragment_paths(str(tmpdir), 'cluster')
+    cache, _ = fragments.scan(paths, {})
+
+    # touched but identical content is not a change
+    _write(a, 'A=1\n', 2 * 10 ** 9)
+    cache, changed = fragments.scan(paths, cache)
+    assert changed == []
+
+    _write(b, 'B=2\n', 3 * 10 ** 9)
+    cache, changed = fragments.scan(paths, cache)
+    assert changed == [str(b)]
+
+    a.remove()
+    paths = fragments.fragment_paths(str(tmpdir), 'cluster')
+    cache, changed = fragments.scan(paths, cache)
+    assert changed == [str(a)]
+    assert fragments.include_text(paths, cache) == 'B=2\n'
+
+
+def test_unchanged_stat_is_not_read(tmpdir):
+    a = tmpdir.join('slurm.conf.d', 'a.conf')
+    _write(a, 'A=1\n', 10 ** 9)
+    paths = [str(a)]
+    cache, _ = fragments.scan(paths, {})
+    cache[str(a)]['text'] = 'cached'
+    cache, changed = fragments.scan(paths, cache)
+    assert changed == []
+    assert cache[str(a)]['text'] == 'cached'
+
+
+def test_parameters():
+    assert fragments.parameters(
+        '# comment\n'
+        'SchedulerParameters=defer,bf_continue  # trailing\n'
+        'KillWait=30 MinJobAge=2\n'
+        'NodeName=gpu[1-2] CPUs=8 Gres=gpu:4\n'
+        'PartitionName=gpu Nodes=gpu[1-2] Default=NO\n'
+        'Include /etc/slurm/extra.conf\n') == {
+        'schedulerparameters': 'defer,bf_continue',
+        'killwait': '30',
+        'minjobage': '2',
+        'nodename=gpu[1-2]': 'NodeName=gpu[1-2] CPUs=8 Gres=gpu:4',
+        'partitionname=gpu': 'PartitionName=gpu Nodes=gpu[1-2] Default=NO',
+        'include': 'Include /etc/slurm/extra.conf',
+    }
@@ -0,0 +1,57 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+import charms.slurm.health as health  # noqa: E402
+
+
+def test_parse_ping():
+    output = ('Slurmctld(primary) at ctl-0 is DOWN\n'
+              'Slurmctld(backup) at ctl-1 is UP\n')
+    assert health.parse_ping(output) == {
+        'primary': {'host': 'ctl-0', 'up': False},
+        'backup': {'host': 'ctl-1', 'up': True},
+    }
+
+
+def test_parse_ping_combined_format():
+    output = 'Slurmctld(primary/backup) at ctl-0/ctl-1 is UP/DOWN\n'
+    assert health.parse_ping(output) == {
+        'primary': {'host': 'ctl-0', 'up': True},
+        'backup': {'host': 'ctl-1', 'up': False},
+    }
+    assert health.parse_ping('garbage') == {}
+
+
+def test_failover_after_consecutive_failures():
+    state = None
+    for now in (10, 20):
+        state = health.update_state(state, False, now)
+        assert not health.should_fail_over(state, 3, True)
+    state = health.update_state(state, None, 30)
+    assert state == {'failures': 3, 'since': 10}
+    assert health.should_fail_over(state, 3, True)
+    assert not health.should_fail_over(state, 3, False)
+    assert not health.should_fail_over(state, 0, True)
+
+
+def test_successful_probe_resets():
+    state = health.update_state(None, False, 10)
+    assert health.update_state(state, True, 20) == {'failures': 0,
+                                                    'since': None}
+
+
+def test_in_control():
+    both_up = health.parse_ping('Slurmctld(primary) at ctl-0 is UP\n'
+                                'Slurmctld(backup) at ctl-1 is UP\n')
+    assert health.in_control(both_up, 'ctl-0')
+    assert health.in_control(both_up, 'ctl-0.maas')
+    assert not health.in_control(both_up, 'ctl-1')
+
+    # the backup slurmctld took over before the charm failed over
+    took_over = health.parse_ping('Slurmctld(primary) at ctl-0 is DOWN\n'
+                                  'Slurmctld(backup) at ctl-1 is UP\n')
+    assert health.in_control(took_over, 'ctl-1')
+    assert not health.in_control(took_over, 'ctl-0')
+    assert not health.in_control({}, 'ctl-0')
@@ -0,0 +1,82 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+import charms.slurm.hostlist as hostlist  # noqa: E402
+
+
+def _node(name, cpus='8', memory='32000', partition='batch'):
+    return {
+        'hostname': name,
+        'partition': partition,
+        'default': True,
+        'timelimit': 'INFINITE',
+        'inventory': {'NodeName': name, 'CPUs': cpus,
+                      'RealMemory': memory, 'CoresPerSocket': '4'},
+    }
+
+
+def test_compress_padded_range():
+    names = ['node%03d' % i for i in range(1, 513)]
+    assert hostlist.compress(names) == ['node[001-512]']
+
+
+def test_compress_gaps_and_plain_names():
+    names = ['node1', 'node2', 'node3', 'node7', 'node10', 'login', 'gpu5']
+    assert hostlist.compress(names) == ['gpu5', 'login', 'node[1-3,7,10]']
+
+
+def test_compress_keeps_padding_apart():
+    assert hostlist.compress(['n01', 'n02', 'n3', 'n100']) == \
+        ['n[01-02]', 'n[3,100]']
+
+
+def test_compress_joins_unpadded_of_same_width():
+    names = ['node%03d' % i for i in range(95, 100)] + ['node100']
+    assert hostlist.compress(names) == ['node[095-100]']
+
+
+def test_compress_suffix():
+    assert hostlist.compress(['rack1-ib', 'rack2-ib']) == ['rack[1-2]-ib']
+
+
+def test_expand():
+    assert hostlist.expand('node[001-003,007],gpu7') == \
+        ['node001', 'node002', 'node003', 'node007', 'gpu7']
+    assert hostlist.expand('r[1-2]n[1-2]') == \
+        ['r1n1', 'r1n2', 'r2n1', 'r2n2']
+
+
+def test_round_trip():
+    names = ['c%04d' % i for i in range(0, 3000, 3)] + ['gpu1', 'gpu2']
+    assert sorted(hostlist.expand(hostlist.compress(names))) == sorted(names)
+
+
+def test_group_nodes_round_trip():
+    nodes = ([_node('node%03d' % i) for i in range(1, 101)] +
+             [_node('big%02d' % i, cpus='64', memory='512000')
+              for i in range(1, 5)] +
+             [_node('node101', partition='debug')])
+    grouped = hostlist.group_nodes(nodes)
+    assert [g['inventory']['NodeName'] for g in grouped] == \
+        ['node[001-100]', 'big[01-04]', 'node101']
+    assert grouped[1]['inventory']['CPUs'] == '64'
+
+    def key(n):
+        return n['hostname']
+    assert sorted(hostlist.expand_nodes(grouped), key=key) == \
+        sorted(nodes, key=key)
+
+
+def test_group_nodes_keeps_names_paired_with_hosts():
+    nodes = [_node('node1'), _node('node2')]
+    for node, hostname in zip(nodes, ['host-b', 'host-a']):
+        node['hostname'] = hostname
+    grouped = hostlist.group_nodes(nodes + [_node('node3'), _node('node4')])
+    assert [(g['inventory']['NodeName'], g['hostname']) for g in grouped] == \
+        [('node1', 'host-b'), ('node2', 'host-a'), ('node[3-4]', 'node[3-4]')]
+    assert [(n['inventory']['NodeName'], n['hostname'])
+            for n in hostlist.expand_nodes(grouped)] == [
+        ('node1', 'host-b'), ('node2', 'host-a'), ('node3', 'node3'),
+        ('node4', 'node4')]
@@ -0,0 +1,108 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'benchmarks'))
+
+import stubs  # noqa: E402
+
+stubs.install(tempfile.mkdtemp(prefix='test-slurm-controller-'))
+
+import charms.slurm.inventory as inventory  # noqa: E402
+
+
+def _unit(i, partition='batch', cpus='4'):
+    name = 'node%d' % i
+    return stubs.Unit('slurm-node/%d' % i, {
+        'hostname': name, 'partition': partition, 'default': True,
+        'timelimit': 'INFINITE',
+        'inventory': {'NodeName': name, 'CPUs': cpus}})
+
+
+@pytest.fixture
+def endpoint():
+    stubs.reset()
+    stubs.start_hook('install')
+    endpoint = stubs.ClusterEndpoint({u.unit_name: u for u in (
+        _unit(1), _unit(2), _unit(3, partition='debug'))})
+    index = inventory.InventoryIndex()
+    assert index.update(endpoint)
+    index.save()
+    return endpoint
+
+
+def _update(endpoint, remote_unit=None, full=False):
+    stubs.start_hook('slurm-cluster-relation-changed', 'slurm-cluster',
+                     remote_unit)
+    index = inventory.InventoryIndex()
+    index.update(endpoint, full)
+    index.save()
+    return index
+
+
+def test_first_update_reads_all_units(endpoint):
+    index = inventory.InventoryIndex()
+    assert [n['hostname'] for n in index.nodes] == ['node1', 'node2', 'node3']
+    assert index.partitions == {
+        'batch': {'hosts': ['node1', 'node2'], 'default': True,
+                  'timelimit': 'INFINITE'},
+        'debug': {'hosts': ['node3'], 'default': True,
+                  'timelimit': 'INFINITE'}}
+
+
+def test_only_the_remote_unit_is_read_again(endpoint):
+    endpoint.units['slurm-node/2'] = _unit(2, cpus='8')
+    endpoint.units['slurm-node/3'] = _unit(3, partition='debug', cpus='8')
+    index = _update(endpoint, 'slurm-node/2')
+    assert index.read == 1
+    assert index.changed == {'slurm-node/2'}
+    cpus = {n['hostname']: n['inventory']['CPUs'] for n in index.nodes}
+    # node3 changed too, but its hook has not run yet
+    assert cpus == {'node1': '4', 'node2': '8', 'node3': '4'}
+
+    index = _update(endpoint, full=True)
+    assert index.read == 3
+    assert index.changed == {'slurm-node/3'}
+
+
+def test_marked_units_are_read_in_a_later_hook(endpoint):
+    endpoint.units['slurm-node/3'] = _unit(3, partition='debug', cpus='8')
+    inventory.mark_stale('slurm-node/3')
+    index = _update(endpoint, 'slurm-node/1')
+    assert index.read == 2
+    assert index.changed == {'slurm-node/3'}
+    # and only once
+    assert _update(endpoint).read == 0
+
+
+def test_unchanged_data_is_skipped_by_hash(endpoint):
+    index = _update(endpoint, 'slurm-node/1')
+    assert index.read == 1
+    assert not index.changed
+    assert not index.update(endpoint)
+
+
+def test_departed_units_are_removed(endpoint):
+    del endpoint.units['slurm-node/3']
+    index = _update(endpoint)
+    assert index.read == 0
+    assert index.departed == {'slurm-node/3'}
+    assert set(index.partitions) == {'batch'}
+
+    # moving to another partition removes the node from the old one
+    endpoint.units['slurm-node/2'] = _unit(2, partition='debug')
+    index = _update(endpoint, 'slurm-node/2')
+    assert index.partitions['batch']['hosts'] == ['node1']
+    assert index.partitions['debug']['hosts'] == ['node2']
+
+
+def test_older_index_version_is_rebuilt(endpoint):
+    stored = stubs.Storage().get(inventory.INDEX_KEY)
+    stored['version'] = inventory.INDEX_VERSION - 1
+    stubs.Storage().set(inventory.INDEX_KEY, stored)
+    index = _update(endpoint)
+    assert index.read == 3
+    assert len(index.changed) == 3
+    assert set(index.partitions) == {'batch', 'debug'}
@@ -0,0 +1,139 @@
+import os
+import sys
+import json
+import threading
+import http.server
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+import charms.slurm.jobcomp as jobcomp  # noqa: E402
+
+RECORD = ('JobId={} UserId=alice(1000) GroupId=alice(1000) Name=sim '
+          'JobState=COMPLETED Partition=batch TimeLimit=60 '
+          'NodeList=node[001-004] NodeCnt=4 ProcCnt=64 '
+          'WorkDir=/home/alice/my runs ExitCode=0:0\n')
+
+
+class BulkStandIn(http.server.BaseHTTPRequestHandler):
+    '''Elasticsearch stand-in recording the bulk requests. statuses are
+    the item statuses of the next requests, by JobId.'''
+    requests = []
+    statuses = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        lines = body.decode('utf-8').splitlines()
+        docs = [json.loads(line) for line in lines]
+        self.requests.append((self.path, self.headers['Content-Type'], docs))
+        statuses = self.statuses.pop(0) if self.statuses else {}
+        items = [{'index': {'_id': action['index'].get('_id'),
+                            'status': statuses.get(doc['JobId'], 201)}}
+                 for action, doc in zip(docs[::2], docs[1::2])]
+        response = json.dumps({
+            'errors': any(i['index']['status'] >= 300 for i in items),
+            'items': items}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def elasticsearch():
+    BulkStandIn.requests = []
+    BulkStandIn.statuses = []
+    server = http.server.HTTPServer(('127.0.0.1', 0), BulkStandIn)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:%d' % server.server_port
+    server.shutdown()
+
+
+def _append(path, first, count):
+    with open(path, 'a') as f:
+        for job_id in range(first, first + count):
+            f.write(RECORD.format(job_id))
+
+
+def test_parse_record():
+    record = jobcomp.parse_record(RECORD.format(42))
+    assert record['JobId'] == 42
+    assert record['NodeCnt'] == 4
+    assert record['NodeList'] == 'node[001-004]'
+    assert record['WorkDir'] == '/home/alice/my runs'
+    assert jobcomp.parse_record('\n') == {}
+
+
+def test_records_are_shipped_in_batches(tmpdir, elasticsearch):
+    path, state = str(tmpdir.join('jobcomp.log')), str(tmpdir.join('state'))
+    _append(path, 1, 25)
+    source = jobcomp.JobcompFile(path, state)
+    shipper = jobcomp.BulkShipper(elasticsearch, 'jobs', batch_size=10,
+                                  flush_interval=3600)
+
+    # two full batches go out, the rest waits for the flush interval
+    assert jobcomp.ship(source, shipper) == 20
+    # an action and a source line per record
+    assert [len(docs) for _, _, docs in BulkStandIn.requests] == [20, 20]
+    path_, content_type, docs = BulkStandIn.requests[0]
+    assert path_ == '/_bulk'
+    assert content_type == 'application/x-ndjson'
+    assert docs[0] == {'index': {'_index': 'jobs', '_id': '1-'}}
+    assert docs[1]['JobId'] == 1
+
+    assert jobcomp.ship(source, shipper, final=True) == 5
+    assert len(BulkStandIn.requests) == 3
+
+    # a restarted shipper continues after the shipped records
+    _append(path, 26, 2)
+    source = jobcomp.JobcompFile(path, state)
+    assert jobcomp.ship(source, shipper, final=True) == 2
+    assert [d['JobId'] for d in BulkStandIn.requests[-1][2][1::2]] == [26, 27]
+
+
+def test_partial_batch_is_flushed_when_due(tmpdir, elasticsearch):
+    path, state = str(tmpdir.join('jobcomp.log')), str(tmpdir.join('state'))
+    _append(path, 1, 3)
+    source = jobcomp.JobcompFile(path, state)
+    shipper = jobcomp.BulkShipper(elasticsearch, batch_size=10,
+                                  flush_interval=0)
+    assert jobcomp.ship(source, shipper) == 3
+    assert len(BulkStandIn.requests) == 1
+
+
+def test_document_id_is_stable():
+    record = jobcomp.parse_record(RECORD.format(42).replace(
+        'ExitCode', 'StartTime=2024-05-01T10:00:00 ExitCode'))
+    assert jobcomp.document_id(record) == '42-2024-05-01T10:00:00'
+    assert jobcomp.document_id({'Name': 'sim'}) is None
+
+
+def test_only_throttled_records_are_retried(tmpdir, elasticsearch):
+    path, state = str(tmpdir.join('jobcomp.log')), str(tmpdir.join('state'))
+    _append(path, 1, 4)
+    BulkStandIn.statuses = [{1: 400, 2: 429, 3: 503}, {}]
+    shipper = jobcomp.BulkShipper(elasticsearch, batch_size=4,
+                                  retry_delay=0)
+    assert jobcomp.ship(jobcomp.JobcompFile(path, state), shipper) == 4
+    # the invalid record is dropped, only 429 and 5xx are sent again
+    assert [d['JobId'] for d in BulkStandIn.requests[1][2][1::2]] == [2, 3]
+    assert shipper.rejected == 1
+    assert shipper.pending == []
+
+
+def test_failing_batch_is_not_committed(tmpdir, elasticsearch):
+    path, state = str(tmpdir.join('jobcomp.log')), str(tmpdir.join('state'))
+    _append(path, 1, 2)
+    BulkStandIn.statuses = [{2: 503}] * 3
+    shipper = jobcomp.BulkShipper(elasticsearch, batch_size=2, retries=2,
+                                  retry_delay=0)
+    with pytest.raises(IOError):
+        jobcomp.ship(jobcomp.JobcompFile(path, state), shipper)
+    assert len(BulkStandIn.requests) == 3
+    assert [r['JobId'] for r in shipper.pending] == [2]
+    assert jobcomp.JobcompFile(path, state).offset == 0
@@ -0,0 +1,74 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+import charms.slurm.metrics as metrics  # noqa: E402
+
+DATA = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def _sdiag():
+    with open(os.path.join(DATA, 'sdiag.txt')) as f:
+        return f.read()
+
+
+def test_parse_sdiag():
+    samples = metrics.parse_sdiag(_sdiag())
+    assert samples['slurmctld_server_threads'] == 3
+    assert samples['slurmctld_agent_threads'] == 2
+    assert samples['slurmctld_jobs_submitted_total'] == 1234
+    assert samples['slurmctld_jobs_pending'] == 30
+    assert samples['slurmctld_schedule_cycle_max_seconds'] == 0.05
+    assert samples['slurmctld_schedule_cycles_total'] == 500
+    assert samples['slurmctld_backfill_cycle_last_seconds'] == 0.15
+    assert samples['slurmctld_backfill_cycles_total'] == 50
+    assert samples['slurmctld_backfill_jobs_total'] == 100
+    assert samples['slurmctld_rpc_total{type="REQUEST_SUBMIT_BATCH_JOB"}'] \
+        == 1234
+    assert samples['slurmctld_rpc_user_seconds_total{user="alice"}'] == 3.085
+
+
+def test_textfile():
+    samples = metrics.parse_sdiag(_sdiag())
+    samples.update(metrics.parse_show_config(
+        'MaxJobCount             = 10000\n'
+        'MessageTimeout          = 10 sec\n'
+        'SchedulerType           = sched/backfill\n'))
+    text = metrics.textfile(samples)
+    assert '# TYPE slurmctld_rpc_total counter\n' in text
+    assert 'slurmctld_rpc_total{type="REQUEST_PING"}' not in text
+    assert 'slurmctld_config{name="MessageTimeout"} 10\n' in text
+    assert 'SchedulerType' not in text
+    assert text.count('# HELP slurmctld_rpc_total ') == 1
+
+
+def test_history_ring_buffer_and_summary(tmpdir):
+    path = str(tmpdir.join('history.json'))
+    base = metrics.parse_sdiag(_sdiag())
+    rpc = 'slurmctld_rpc_total{type="REQUEST_SUBMIT_BATCH_JOB"}'
+    for i in range(5):
+        samples = dict(base)
+        samples['slurmctld_jobs_submitted_total'] = 1234 + 60 * i
+        samples['slurmctld_jobs_pending'] = 30 + i
+        samples[rpc] = 1234 + 60 * i
+        samples[rpc.replace('_total', '_seconds_total')] = 3.085 + 0.15 * i
+        metrics.append_history(samples, 3, now=60.0 * i, path=path)
+    history = metrics.load_history(path)
+    assert [s['time'] for s in history] == [120.0, 180.0, 240.0]
+
+    summary = metrics.summarize(history, top=1)
+    assert summary['snapshots'] == 3
+    assert summary['rates_per_minute']['slurmctld_jobs_submitted_total'] == 60
+    assert summary['gauges']['slurmctld_jobs_pending'] == {
+        'last': 34, 'min': 32, 'max': 34}
+    assert summary['top_rpcs'] == [{'type': 'REQUEST_SUBMIT_BATCH_JOB',
+                                    'count': 120, 'mean_ms': 2.5}]
+
+
+def test_counter_reset_is_skipped():
+    history = [{'time': 0, 'samples': {'slurmctld_jobs_started_total': 100}},
+               {'time': 60, 'samples': {'slurmctld_jobs_started_total': 5}},
+               {'time': 120, 'samples': {'slurmctld_jobs_started_total': 25}}]
+    summary = metrics.summarize(history)
+    assert summary['rates_per_minute']['slurmctld_jobs_started_total'] == 10
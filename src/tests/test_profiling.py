@@ -0,0 +1,62 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'benchmarks'))
+
+import stubs  # noqa: E402
+
+stubs.install(tempfile.mkdtemp(prefix='test-slurm-controller-'))
+
+import charmhelpers.core.hookenv as hookenv  # noqa: E402
+import charms.slurm.controller as controller  # noqa: E402
+import charms.slurm.profiling as profiling  # noqa: E402
+from charms.reactive.bus import Handler  # noqa: E402
+
+
+def configure_something():
+    controller.invalidate()
+    controller.config()
+    hookenv.log('configuring')
+    hookenv.status_set('active', 'Ready')
+
+
+@pytest.fixture
+def handler(tmpdir, monkeypatch):
+    stubs.reset()
+    stubs.start_hook('config-changed')
+    monkeypatch.setattr(profiling, 'PROFILE_DIR', str(tmpdir))
+    monkeypatch.setattr(profiling, 'PROFILE_LOG',
+                        str(tmpdir.join('handlers.jsonl')))
+    monkeypatch.setattr(profiling, '_logger', None)
+    # undo the instrumentation after the test
+    monkeypatch.setattr(Handler, '_slurm_profiling', False, raising=False)
+    monkeypatch.setattr(Handler, 'invoke', lambda self: self._action())
+    for attr in profiling.HOOKENV_TOOLS:
+        monkeypatch.setattr(hookenv, attr, getattr(hookenv, attr))
+    handler = Handler()
+    handler._action = configure_something
+    return handler
+
+
+def test_profiling_is_opt_in(handler, tmpdir):
+    profiling.install()
+    assert not Handler._slurm_profiling
+    handler.invoke()
+    assert not tmpdir.listdir()
+
+
+def test_handlers_are_recorded(handler, tmpdir):
+    stubs.CONFIG['profile_handlers'] = True
+    controller.invalidate()
+    profiling.install()
+    handler.invoke()
+    records = profiling.load_records()
+    assert [(r['handler'], r['kind']) for r in records] == [
+        ('test_profiling:configure_something', 'invoke')]
+    # config-get, juju-log and status-set
+    assert records[0]['agent_calls'] == 3
+    assert len(tmpdir.listdir(lambda p: p.ext == '.prof')) == 1
+    assert profiling.slowest()[0]['mean_agent_calls'] == 3
@@ -0,0 +1,95 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'benchmarks'))
+
+import stubs  # noqa: E402
+
+stubs.install(tempfile.mkdtemp(prefix='test-slurm-controller-'))
+
+import charms.slurm.replication as replication  # noqa: E402
+
+KEY = 'ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIPeer root@ctl-1'
+
+
+@pytest.fixture
+def ssh_dir(tmpdir, monkeypatch):
+    monkeypatch.setattr(replication, 'SSH_DIR', str(tmpdir))
+    monkeypatch.setattr(replication, 'AUTHORIZED_KEYS',
+                        str(tmpdir.join('authorized_keys')))
+    monkeypatch.setattr(replication, 'rrsync', lambda: '/usr/bin/rrsync')
+    return tmpdir
+
+
+def test_peer_key_is_restricted_to_rrsync(ssh_dir):
+    ssh_dir.join('authorized_keys').write('ssh-rsa AAAA operator\n')
+    replication.authorize_peer(KEY, '/var/spool/slurm.state/', '10.0.0.2')
+    assert ssh_dir.join('authorized_keys').read().splitlines() == [
+        'ssh-rsa AAAA operator',
+        'restrict,from="10.0.0.2",command="/usr/bin/rrsync -wo '
+        '/var/spool/slurm.state" ssh-ed25519 '
+        'AAAAC3NzaC1lZDI1NTE5AAAAIPeer slurm-controller-state-sync']
+
+    # a new peer key replaces the old one
+    replication.authorize_peer(KEY.replace('Peer', 'New'),
+                               '/var/spool/slurm.state')
+    lines = ssh_dir.join('authorized_keys').read().splitlines()
+    assert len(lines) == 2
+    assert lines[1].startswith('restrict,command="/usr/bin/rrsync -wo ')
+    assert 'AAAAC3NzaC1lZDI1NTE5AAAAINew' in lines[1]
+
+
+def test_push_is_gated_on_the_controller_in_control(tmpdir, monkeypatch):
+    calls = []
+    monkeypatch.setattr(replication, 'SCRIPT', str(tmpdir.join('sync')))
+    monkeypatch.setattr(replication, 'UNIT_DIR', str(tmpdir))
+    monkeypatch.setattr(replication, '_systemctl',
+                        lambda *args: calls.append(args))
+    replication.enable('/var/spool/slurm.state/', '10.0.0.2', 30)
+
+    lines = tmpdir.join('sync').read().splitlines()
+    gate = [i for i, line in enumerate(lines) if 'health.py' in line]
+    push = [i for i, line in enumerate(lines) if 'rsync' in line]
+    assert len(gate) == 1 and lines[gate[0]].endswith('|| exit 0')
+    assert gate[0] < push[0]
+    assert 'root@10.0.0.2:./' in tmpdir.join('sync').read()
+    assert ('restart', 'slurm-state-sync.timer') in calls
+
+    # an unchanged script does not restart the timer
+    del calls[:]
+    replication.enable('/var/spool/slurm.state/', '10.0.0.2', 30)
+    assert calls == []
+
+
+def test_missing_rrsync_is_not_authorized(tmpdir, monkeypatch):
+    monkeypatch.setattr(replication, 'AUTHORIZED_KEYS',
+                        str(tmpdir.join('authorized_keys')))
+    for name in ('RRSYNC', 'RRSYNC_EXAMPLE', 'LOCAL_RRSYNC'):
+        monkeypatch.setattr(replication, name, str(tmpdir.join(name)))
+    assert replication.rrsync() is None
+    with pytest.raises(OSError):
+        replication.authorize_peer(KEY, '/var/spool/slurm.state')
+    assert not tmpdir.join('authorized_keys').exists()
+
+
+def test_pushes_only_trust_the_peer_host_key(ssh_dir, monkeypatch):
+    ssh_dir.join('ssh_host_ed25519_key.pub').write(
+        'ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIHost root@ctl-1\n')
+    monkeypatch.setattr(replication, 'HOST_KEYS', (
+        str(ssh_dir.join('missing.pub')),
+        str(ssh_dir.join('ssh_host_ed25519_key.pub'))))
+    host_key = replication.host_key()
+    assert host_key == 'ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIHost'
+
+    monkeypatch.setattr(replication, 'KNOWN_HOSTS',
+                        str(ssh_dir.join('known_hosts')))
+    replication.trust_peer('10.0.0.2', host_key)
+    assert ssh_dir.join('known_hosts').read() == \
+        '10.0.0.2 ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIHost\n'
+    # the host key is pre-seeded, accept-new needs OpenSSH 7.6 and xenial
+    # ships 7.2
+    assert 'StrictHostKeyChecking=yes' in replication.script(
+        '/var/spool/slurm.state', '10.0.0.2')
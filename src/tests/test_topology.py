@@ -0,0 +1,66 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+import charms.slurm.topology as topology  # noqa: E402
+
+
+def test_leaf_switch():
+    assert topology.leaf_switch({'switch': 'ib sw/1'}) == 'ib-sw-1'
+    assert topology.leaf_switch({'ingress-address': '10.1.2.3'}) == \
+        'net-10-1-2-0'
+    assert topology.leaf_switch({'ingress-address': '10.1.2.3'}, 16) == \
+        'net-10-1-0-0'
+    assert topology.leaf_switch({}) == topology.UNASSIGNED
+
+
+def test_auto_topology_groups_by_subnet():
+    attributes = {'node%02d' % i: {'ingress-address': '10.0.%d.%d' %
+                                   (i // 4, i)} for i in range(8)}
+    leaves, parents = topology.build(
+        attributes, lambda n: topology.leaf_switch(attributes[n]))
+    assert topology.render(leaves, parents) == (
+        'SwitchName=net-10-0-0-0 Nodes=node[00-03]\n'
+        'SwitchName=net-10-0-1-0 Nodes=node[04-07]\n'
+        'SwitchName=root Switches=net-10-0-0-0,net-10-0-1-0\n')
+
+
+def test_mapped_topology():
+    mapping = topology.parse_map('leaf1=node[1-2] leaf2=node[3-4] '
+                                 'spine=leaf[1-2]')
+    leaves, parents = topology.build(
+        ['node1', 'node2', 'node3', 'node5'], lambda n: 'leaf9', mapping)
+    assert topology.render(leaves, parents) == (
+        'SwitchName=leaf1 Nodes=node[1-2]\n'
+        'SwitchName=leaf2 Nodes=node3\n'
+        'SwitchName=leaf9 Nodes=node5\n'
+        'SwitchName=spine Switches=leaf[1-2]\n'
+        'SwitchName=root Switches=leaf9,spine\n')
+
+
+def test_empty_switches_are_pruned_bottom_up():
+    mapping = topology.parse_map('leaf1=node[1-2] leaf2=node[3-4] '
+                                 'spine1=leaf1 spine2=leaf2 '
+                                 'core=spine[1-2]')
+    leaves, parents = topology.build(['node1', 'node2'], lambda n: 'leaf9',
+                                     mapping)
+    assert parents == {'spine1': ['leaf1'], 'core': ['spine1']}
+    assert topology.render(leaves, parents) == (
+        'SwitchName=leaf1 Nodes=node[1-2]\n'
+        'SwitchName=core Switches=spine1\n'
+        'SwitchName=spine1 Switches=leaf1\n')
+
+
+def test_single_switch_needs_no_root():
+    leaves, parents = topology.build(['a1', 'a2'], lambda n: 'sw')
+    assert topology.render(leaves, parents) == 'SwitchName=sw Nodes=a[1-2]\n'
+
+
+def test_bad_map():
+    with pytest.raises(ValueError):
+        topology.parse_map('leaf1')
+    with pytest.raises(ValueError):
+        topology.parse_map('bad/name=node1')
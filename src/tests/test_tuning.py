@@ -0,0 +1,68 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+import charms.slurm.tuning as tuning  # noqa: E402
+
+
+def _config(**options):
+    config = {'performance_profile': 'default', 'slurmctld_port': 6817,
+              'scheduler_parameters': '', 'max_job_count': 0,
+              'message_timeout': 0, 'tree_width': 0,
+              'slurmctld_port_range': '', 'expected_submit_rate': 0}
+    config.update(options)
+    return config
+
+
+def test_default_profile_adds_nothing():
+    assert tuning.scheduling_context(_config(), 5000, 3) == {}
+
+
+def test_large_cluster_scales_with_nodes():
+    small = tuning.scheduling_context(
+        _config(performance_profile='large-cluster'), 100, 2)
+    large = tuning.scheduling_context(
+        _config(performance_profile='large-cluster'), 10000, 2)
+    assert small['tree_width'] == 50
+    assert large['tree_width'] == 100
+    assert large['message_timeout'] > small['message_timeout']
+    assert large['max_job_count'] == 200000
+    assert large['slurmctld_port'] == '6817-6818'
+
+
+def test_overrides_win():
+    context = tuning.scheduling_context(
+        _config(performance_profile='high-throughput',
+                scheduler_parameters='defer', tree_width=16), 200, 1)
+    assert context['scheduler_parameters'] == 'defer'
+    assert context['tree_width'] == 16
+    assert context['max_job_count'] == 100000
+    assert context['slurmctld_port'] == '6817-6820'
+
+
+def test_unknown_profile():
+    with pytest.raises(ValueError):
+        tuning.scheduling_context(_config(performance_profile='fast'), 1, 1)
+
+
+def test_auto_port_range():
+    config = _config(slurmctld_port_range='auto', expected_submit_rate=600)
+    assert tuning.scheduling_context(config, 100, 1) == \
+        {'slurmctld_port': '6817-6820'}
+    config['expected_submit_rate'] = 100000
+    assert tuning.scheduling_context(config, 100, 1)['slurmctld_port'] == \
+        '6817-6824'
+
+
+def test_explicit_port_range_wins():
+    config = _config(performance_profile='high-throughput',
+                     slurmctld_port_range='7000-7001')
+    assert tuning.scheduling_context(config, 10, 1)['slurmctld_port'] == \
+        '7000-7001'
+    assert tuning.ports('7000-7001') == [7000, 7001]
+    with pytest.raises(ValueError):
+        tuning.scheduling_context(_config(slurmctld_port_range='7001-7000'),
+                                  10, 1)
@@ -0,0 +1,54 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lib'))
+
+import charms.slurm.weights as weights  # noqa: E402
+
+
+def _node(name, **inventory):
+    inventory = {k: str(v) for k, v in inventory.items()}
+    return {'hostname': name, 'inventory': dict(inventory, NodeName=name)}
+
+
+def test_single_criterion_distinct_values():
+    nodes = [_node('a', RealMemory=64000), _node('b', RealMemory=16000),
+             _node('c', RealMemory=64000), _node('d')]
+    node_weights, missing = weights.compute_weights(nodes, ['RealMemory'])
+    assert node_weights == [3, 2, 3, 1]
+    assert missing == {'RealMemory': ['d']}
+
+
+def test_criteria_break_ties_in_order():
+    nodes = [_node('a', RealMemory=64000, CPUs=32),
+             _node('b', RealMemory=64000, CPUs=16),
+             _node('c', RealMemory=16000, CPUs=64)]
+    node_weights, _ = weights.compute_weights(nodes, ['RealMemory', 'CPUs'])
+    assert node_weights == [3, 2, 1]
+
+
+def test_explicit_buckets():
+    nodes = [_node(str(m), RealMemory=m)
+             for m in (8000, 16000, 65536, 100000, 300000)]
+    buckets = weights.parse_buckets('RealMemory=65536,262144',
+                                    ['RealMemory'])
+    node_weights, _ = weights.compute_weights(nodes, ['RealMemory'], buckets)
+    assert node_weights == [1, 1, 2, 2, 3]
+
+
+def test_quantile_buckets_are_compact():
+    nodes = [_node(str(i), RealMemory=1000 + i) for i in range(10000)]
+    buckets = weights.parse_buckets('4', ['RealMemory'])
+    node_weights, _ = weights.compute_weights(nodes, ['RealMemory'], buckets)
+    assert sorted(set(node_weights)) == [1, 2, 3, 4]
+    assert node_weights.count(1) == 2500
+
+
+@pytest.mark.parametrize('criteria,buckets', [
+    ('', ''), ('Memory', ''), ('CPUs', 'CPUs=qx'), ('CPUs', 'RealMemory=q2'),
+])
+def test_invalid_configuration(criteria, buckets):
+    with pytest.raises(ValueError):
+        weights.parse_buckets(buckets, weights.parse_criteria(criteria))